@@ -4,7 +4,16 @@ Library providing convenient classes and methods for writing data to files.
 """
 import logging
 import json
+import numbers
+import os
 import pickle
+import platform
+import struct
+import zipfile
+from collections.abc import MutableMapping
+from io import BytesIO
+
+import numpy as np
 
 try:
     import yaml
@@ -30,6 +39,28 @@ class Serializer():
         """ Override for unmarshalling """
         raise NotImplementedError()
 
+    @staticmethod
+    def to_builtin(input_data):
+        """ Return columnar alignments as a standard dict for serializers
+            which can't write them directly """
+        if isinstance(input_data, ColumnarAlignments):
+            return dict(input_data.items())
+        return input_data
+
+    @classmethod
+    def load(cls, filename):
+        """ Read and unmarshal the given file
+            Override for custom loading logic """
+        with open(filename, cls.roptions) as s_file:
+            return cls.unmarshal(s_file.read())
+
+    @classmethod
+    def save(cls, filename, data):
+        """ Marshal and write data to the given file
+            Override for custom saving logic """
+        with open(filename, cls.woptions) as s_file:
+            s_file.write(cls.marshal(data))
+
 
 class YAMLSerializer(Serializer):
     """ YAML Serializer """
@@ -39,7 +70,7 @@ class YAMLSerializer(Serializer):
 
     @classmethod
     def marshal(cls, input_data):
-        return yaml.dump(input_data, default_flow_style=False)
+        return yaml.dump(cls.to_builtin(input_data), default_flow_style=False)
 
     @classmethod
     def unmarshal(cls, input_string):
@@ -54,7 +85,7 @@ class JSONSerializer(Serializer):
 
     @classmethod
     def marshal(cls, input_data):
-        return json.dumps(input_data, indent=2)
+        return json.dumps(cls.to_builtin(input_data), indent=2)
 
     @classmethod
     def unmarshal(cls, input_string):
@@ -69,19 +100,353 @@ class PickleSerializer(Serializer):
 
     @classmethod
     def marshal(cls, input_data):
-        return pickle.dumps(input_data)
+        return pickle.dumps(cls.to_builtin(input_data))
 
     @classmethod
     def unmarshal(cls, input_bytes):  # pylint: disable=arguments-differ
         return pickle.loads(input_bytes)
 
 
+class NPZSerializer(Serializer):
+    """ Columnar numpy serializer for alignments data.
+        See ColumnarAlignments for the layout """
+    ext = "npz"
+    woptions = "wb"
+    roptions = "rb"
+    # Columns which are always read into memory. The rest are memory mapped
+    in_memory = ("meta", "frames", "face_offsets", "extra_keys", "raw_faces")
+
+    @classmethod
+    def marshal(cls, input_data):
+        buffer = BytesIO()
+        np.savez(buffer, **ColumnarAlignments.to_columns(input_data))
+        return buffer.getvalue()
+
+    @classmethod
+    def unmarshal(cls, input_bytes):  # pylint: disable=arguments-differ
+        with np.load(BytesIO(input_bytes)) as npz:
+            columns = {key: npz[key] for key in npz.files}
+        return ColumnarAlignments(columns)
+
+    @classmethod
+    def load(cls, filename):
+        """ Memory map the face columns from the file. Windows can't replace
+            a file which is mapped, so it is read into memory there """
+        if platform.system() == "Windows":
+            return super().load(filename)
+        return ColumnarAlignments(cls.map_columns(filename))
+
+    @classmethod
+    def save(cls, filename, data):
+        """ Write to a temporary file and swap it in, as the existing file
+            may be memory mapped """
+        columns = ColumnarAlignments.to_columns(data)
+        tmp_file = "{}.tmp".format(filename)
+        with open(tmp_file, cls.woptions) as s_file:
+            np.savez(s_file, **columns)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def map_columns(cls, filename):
+        """ Return the columns held in the npz file, with any columns which
+            are stored uncompressed memory mapped from the file """
+        columns = dict()
+        with zipfile.ZipFile(filename) as archive, open(filename, "rb") as raw_file:
+            for info in archive.infolist():
+                key = os.path.splitext(info.filename)[0]
+                array = None
+                if info.compress_type == zipfile.ZIP_STORED and key not in cls.in_memory:
+                    array = cls.map_member(filename, raw_file, info)
+                if array is None:
+                    with archive.open(info) as member:
+                        array = np.lib.format.read_array(member)
+                columns[key] = array
+        logger.debug("Mapped columns: %s", {key: val.shape for key, val in columns.items()})
+        return columns
+
+    @staticmethod
+    def map_member(filename, raw_file, info):
+        """ Memory map an uncompressed .npy member of a zip file. Returns None
+            if the member can't be mapped """
+        # Local file header is 30 bytes followed by the filename and extra field
+        raw_file.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", raw_file.read(4))
+        raw_file.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(raw_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw_file)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw_file)
+        else:
+            return None
+        if dtype.hasobject or not np.prod(shape):
+            return None
+        return np.memmap(filename,
+                         dtype=dtype,
+                         mode="r",
+                         offset=raw_file.tell(),
+                         shape=shape,
+                         order="F" if fortran_order else "C")
+
+
+class ColumnarAlignments(MutableMapping):
+    """ Dictionary of frame names to lists of face alignments, backed by
+        contiguous numpy columns. Frames are only built into lists of dicts
+        when they are accessed, after which they behave as a normal dict entry.
+
+        Columns:
+            frames:             Frame names, in order
+            face_offsets:       Faces for frame i are rows
+                                face_offsets[i]:face_offsets[i + 1]
+            boxes:              (faces, 4) x, w, y, h
+            dims:               (faces, 2) frame_dims, where has_dims is set
+            hashes:             Face hashes, where has_hash is set
+            landmarks:          (points, 2) landmarksXY for all faces. Points
+                                for face i are rows
+                                landmark_offsets[i]:landmark_offsets[i + 1]
+            extra_keys:         JSON of {face index: {key: value}} for any keys
+                                not held in columns
+            raw_faces:          JSON of {face index: alignment} for faces which
+                                don't fit the columns, including any with non
+                                integer boxes, dims or landmarks
+            meta:               JSON of format information """
+    column_keys = ("x", "w", "y", "h", "frame_dims", "landmarksXY", "hash")
+
+    def __init__(self, columns):
+        self._columns = columns
+        self._meta = self.from_json(columns["meta"])
+        self._extra_keys = self.from_json(columns["extra_keys"])
+        self._raw_faces = self.from_json(columns["raw_faces"])
+        frames = columns["frames"].tolist()
+        self._index = {frame: idx for idx, frame in enumerate(frames)}
+        # Ordered keys (values unused) and the frames built so far
+        self._keys = dict.fromkeys(frames)
+        self._built = dict()
+
+    # << MAPPING >> #
+    def __getitem__(self, key):
+        if key in self._built:
+            return self._built[key]
+        if key not in self._keys:
+            raise KeyError(key)
+        retval = self.build_frame(self._index[key])
+        self._built[key] = retval
+        return retval
+
+    def __setitem__(self, key, value):
+        self._built[key] = value
+        self._keys.setdefault(key, None)
+
+    def __delitem__(self, key):
+        del self._keys[key]
+        self._built.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    # << BUILDING FRAMES >> #
+    def build_frame(self, row):
+        """ Build the list of face alignments for the given frame row """
+        offsets = self._columns["face_offsets"]
+        return [self.build_face(idx) for idx in range(offsets[row], offsets[row + 1])]
+
+    def build_face(self, idx):
+        """ Build the alignment dict for the given face row """
+        key = str(idx)
+        if key in self._raw_faces:
+            return self._raw_faces[key]
+        columns = self._columns
+        face = dict(zip(("x", "w", "y", "h"), columns["boxes"][idx].tolist()))
+        if columns["has_dims"][idx]:
+            dims = columns["dims"][idx].tolist()
+            face["frame_dims"] = tuple(dims) if self._meta["tuple_dims"] else dims
+        start, end = columns["landmark_offsets"][idx:idx + 2]
+        points = columns["landmarks"][start:end].tolist()
+        if self._meta["tuple_points"]:
+            points = [tuple(point) for point in points]
+        face["landmarksXY"] = points
+        if columns["has_hash"][idx]:
+            face["hash"] = columns["hashes"][idx].decode("ascii")
+        face.update(self._extra_keys.get(key, dict()))
+        return face
+
+    # << COLUMN QUERIES >> #
+    # Answer queries over every face from the columns, so that frames that have not been
+    # accessed do not need to be built. Frames that have been built may have been changed,
+    # so they are checked directly.
+
+    def unbuilt_rows(self):
+        """ Return a boolean mask of the frame rows which are only held in the columns """
+        retval = np.ones(len(self._index), dtype="bool")
+        new_frames = 0
+        for frame in self._built:
+            row = self._index.get(frame, None)
+            if row is None:
+                new_frames += 1
+            else:
+                retval[row] = False
+        if len(self._keys) - new_frames != len(self._index):
+            for frame, row in self._index.items():
+                if frame not in self._keys:
+                    retval[row] = False
+        return retval
+
+    def count_faces(self):
+        """ Return the total number of faces """
+        counts = np.diff(self._columns["face_offsets"])
+        retval = int(counts[self.unbuilt_rows()].sum())
+        retval += sum(len(faces) for faces in self._built.values())
+        return retval
+
+    def select_frames(self, face_test, face_mask):
+        """ Return the frames, in order, holding any face that passes face_test.
+
+            face_mask is the result of face_test for every face row in the
+            columns. Frames which have been built are tested with face_test """
+        offsets = self._columns["face_offsets"]
+        face_rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        hits = np.zeros(len(offsets) - 1, dtype="bool")
+        hits[face_rows[face_mask]] = True
+        hits &= self.unbuilt_rows()
+        selected = set(self._columns["frames"][hits].tolist())
+        selected.update(frame for frame, faces in self._built.items()
+                        if any(face_test(face) for face in faces))
+        return [frame for frame in self._keys if frame in selected]
+
+    def frames_missing(self, key):
+        """ Return the frames, in order, with any face that does not hold the
+            given key """
+        flags = {"frame_dims": "has_dims", "hash": "has_hash"}
+        num_faces = len(self._columns["boxes"])
+        if key in flags:
+            mask = ~self._columns[flags[key]]
+        elif key in self.column_keys:
+            mask = np.zeros(num_faces, dtype="bool")
+        else:
+            mask = np.ones(num_faces, dtype="bool")
+            for idx, extras in self._extra_keys.items():
+                mask[int(idx)] = key not in extras
+        for idx, face in self._raw_faces.items():
+            mask[int(idx)] = key not in face
+        return self.select_frames(lambda face: key not in face, mask)
+
+    def frames_with_value(self, key):
+        """ Return the frames, in order, with any face that holds a value
+            which is not empty for the given key. The key must not be one that is
+            held in the columns """
+        mask = np.zeros(len(self._columns["boxes"]), dtype="bool")
+        for idx, extras in self._extra_keys.items():
+            mask[int(idx)] = bool(extras.get(key, None))
+        for idx, face in self._raw_faces.items():
+            mask[int(idx)] = bool(face.get(key, None))
+        return self.select_frames(lambda face: face.get(key, None), mask)
+
+    # << BUILDING COLUMNS >> #
+    @classmethod
+    def is_columnar(cls, face):
+        """ Return whether a face alignment can be held in the columns. The
+            columns are integer, so that values load back as the same type """
+        def is_int(value):
+            return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+        def is_pair(value):
+            return (isinstance(value, (list, tuple))
+                    and len(value) == 2
+                    and all(is_int(val) for val in value))
+
+        return (isinstance(face, dict)
+                and all(is_int(face.get(key, None)) for key in ("x", "w", "y", "h"))
+                and isinstance(face.get("landmarksXY", None), (list, tuple))
+                and all(is_pair(point) for point in face["landmarksXY"])
+                and ("frame_dims" not in face or is_pair(face["frame_dims"]))
+                and ("hash" not in face or (isinstance(face["hash"], str)
+                                            and len(face["hash"]) <= 40
+                                            and all(ord(char) < 128
+                                                    for char in face["hash"]))))
+
+    @classmethod
+    def to_columns(cls, data):
+        """ Return the columns for a dictionary of frame names to lists of
+            face alignments """
+        frames = list()
+        face_offsets = [0]
+        boxes, dims, has_dims, hashes, has_hash = list(), list(), list(), list(), list()
+        points, landmark_offsets = list(), [0]
+        extra_keys, raw_faces = dict(), dict()
+        meta = {"version": 1, "tuple_points": None, "tuple_dims": None}
+        for frame, faces in data.items():
+            frames.append(frame)
+            for face in faces:
+                idx = len(boxes)
+                if not cls.is_columnar(face):
+                    raw_faces[str(idx)] = face
+                    face = {"x": 0, "w": 0, "y": 0, "h": 0, "landmarksXY": list()}
+                boxes.append([face["x"], face["w"], face["y"], face["h"]])
+                has_dims.append("frame_dims" in face)
+                dims.append(face.get("frame_dims", (0, 0)))
+                has_hash.append("hash" in face)
+                hashes.append(face.get("hash", "").encode("ascii"))
+                points.extend(face["landmarksXY"])
+                landmark_offsets.append(len(points))
+                if meta["tuple_points"] is None and face["landmarksXY"]:
+                    meta["tuple_points"] = isinstance(face["landmarksXY"][0], tuple)
+                if meta["tuple_dims"] is None and "frame_dims" in face:
+                    meta["tuple_dims"] = isinstance(face["frame_dims"], tuple)
+                extras = {key: val for key, val in face.items() if key not in cls.column_keys}
+                if extras and str(idx) not in raw_faces:
+                    extra_keys[str(idx)] = extras
+            face_offsets.append(len(boxes))
+
+        return {"meta": cls.to_json(meta),
+                "frames": np.array(frames, dtype=str),
+                "face_offsets": np.array(face_offsets, dtype="int64"),
+                "boxes": cls.to_array(boxes, (-1, 4)),
+                "dims": cls.to_array(dims, (-1, 2)),
+                "has_dims": np.array(has_dims, dtype="bool"),
+                "hashes": np.array(hashes, dtype="S40"),
+                "has_hash": np.array(has_hash, dtype="bool"),
+                "landmarks": cls.to_array(points, (-1, 2)),
+                "landmark_offsets": np.array(landmark_offsets, dtype="int64"),
+                "extra_keys": cls.to_json(extra_keys),
+                "raw_faces": cls.to_json(raw_faces)}
+
+    @staticmethod
+    def to_array(values, shape):
+        """ Return the integer values of a column as an int64 array """
+        return np.array(values, dtype="int64").reshape(shape)
+
+    @staticmethod
+    def to_json(data):
+        """ Return data as a uint8 array of JSON """
+        def default(obj):
+            """ Numpy types held in pickled alignments """
+            if isinstance(obj, np.ndarray):
+                return obj.tolist()
+            if isinstance(obj, np.generic):
+                return obj.item()
+            raise TypeError("{} is not JSON serializable".format(type(obj)))
+        return np.frombuffer(json.dumps(data, default=default).encode("utf-8"), dtype="uint8")
+
+    @staticmethod
+    def from_json(array):
+        """ Return the data held in a uint8 array of JSON """
+        return json.loads(array.tobytes().decode("utf-8"))
+
+
 def get_serializer(serializer):
     """ Return requested serializer """
     if serializer == "json":
         return JSONSerializer
     if serializer == "pickle":
         return PickleSerializer
+    if serializer == "npz":
+        return NPZSerializer
     if serializer == "yaml" and yaml is not None:
         return YAMLSerializer
     if serializer == "yaml" and yaml is None:
@@ -96,6 +461,8 @@ def get_serializer_from_ext(ext):
         return JSONSerializer
     if ext == ".p":
         return PickleSerializer
+    if ext == ".npz":
+        return NPZSerializer
     if ext in (".yaml", ".yml") and yaml is not None:
         return YAMLSerializer
     if ext in (".yaml", ".yml") and yaml is None:
@@ -2,14 +2,16 @@
 """ Alignments file functions for reading, writing and manipulating
     a serialized alignments file """
 
+import json
 import logging
 import os
 from datetime import datetime
+from itertools import islice
 
 import cv2
 
 from lib import Serializer
-from lib.utils import rotate_landmarks
+from lib.utils import rotate_alignments
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -23,8 +25,10 @@ class Alignments():
                     decide the serializer, and the serializer argument will
                     be ignored.
         serializer: If provided, this will be the format that the data is
-                    saved in (if data is to be saved). Can be 'json', 'pickle'
-                    or 'yaml'
+                    saved in (if data is to be saved). Can be 'json', 'pickle',
+                    'yaml' or 'npz'. The npz format holds the faces in numpy
+                    columns which are memory mapped and only built into
+                    alignments as each frame is accessed
     """
     # pylint: disable=too-many-public-methods
     def __init__(self, folder, filename="alignments", serializer="json"):
@@ -32,8 +36,11 @@ class Alignments():
                      self.__class__.__name__, folder, filename, serializer)
         self.serializer = self.get_serializer(filename, serializer)
         self.file = self.get_location(folder, filename)
+        self.journal_file = "{}.journal".format(self.file)
 
         self.data = self.load()
+        # Number of frames, in insertion order, held in the file or journal
+        self.journaled = len(self.data)
         logger.debug("Initialized %s", self.__class__.__name__)
 
     # << PROPERTIES >> #
@@ -48,10 +55,25 @@ class Alignments():
     @property
     def faces_count(self):
         """ Return current faces count """
-        retval = sum(len(faces) for faces in self.data.values())
+        if self._faces_count is None and isinstance(self.data, Serializer.ColumnarAlignments):
+            self._faces_count = self.data.count_faces()
+        elif self._faces_count is None:
+            self._faces_count = sum(len(faces) for faces in self.data.values())
+        retval = self._faces_count
         logger.trace(retval)
         return retval
 
+    @property
+    def data(self):
+        """ The alignments as a dict of frame name to list of face alignments """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        """ Replacing the alignments invalidates the indexes """
+        self._data = data
+        self.invalidate_indexes()
+
     @property
     def have_alignments_file(self):
         """ Return whether an alignments file exists """
@@ -59,13 +81,24 @@ class Alignments():
         logger.trace(retval)
         return retval
 
+    @property
+    def have_journal(self):
+        """ Return whether a checkpoint journal exists """
+        retval = os.path.exists(self.journal_file)
+        logger.trace(retval)
+        return retval
+
     @property
     def hashes_to_frame(self):
         """ Return a dict of each face_hash with their parent
             frame name and their index in the frame """
-        return{face["hash"]: (frame_name, idx)
-               for frame_name, faces in self.data.items()
-               for idx, face in enumerate(faces)}
+        if self._hash_index is None:
+            logger.debug("Building face hash index")
+            self._hash_index = {face["hash"]: (frame_name, idx)
+                                for frame_name, faces in self.data.items()
+                                for idx, face in enumerate(faces)
+                                if "hash" in face}
+        return self._hash_index
 
     # << INIT FUNCTIONS >> #
 
@@ -80,12 +113,12 @@ class Alignments():
         logger.debug("Getting serializer: (filename: '%s', serializer: '%s')",
                      filename, serializer)
         extension = os.path.splitext(filename)[1]
-        if extension in (".json", ".p", ".yaml", ".yml"):
+        if extension in (".json", ".p", ".yaml", ".yml", ".npz"):
             logger.debug("Serializer set from file extension: '%s'", extension)
             retval = Serializer.get_serializer_from_ext(extension)
-        elif serializer not in ("json", "pickle", "yaml"):
+        elif serializer not in ("json", "pickle", "yaml", "npz"):
             raise ValueError("Error: {} is not a valid serializer. Use "
-                             "'json', 'pickle' or 'yaml'")
+                             "'json', 'pickle', 'yaml' or 'npz'")
         else:
             logger.debug("Serializer set from argument: '%s'", serializer)
             retval = Serializer.get_serializer(serializer)
@@ -96,7 +129,7 @@ class Alignments():
         """ Return the path to alignments file """
         logger.debug("Getting location: (folder: '%s', filename: '%s')", folder, filename)
         extension = os.path.splitext(filename)[1]
-        if extension in (".json", ".p", ".yaml", ".yml"):
+        if extension in (".json", ".p", ".yaml", ".yml", ".npz"):
             logger.debug("File extension set from filename: '%s'", extension)
             location = os.path.join(str(folder), filename)
         else:
@@ -113,17 +146,19 @@ class Alignments():
         """ Load the alignments data
             Override for custom loading logic """
         logger.debug("Loading alignments")
-        if not self.have_alignments_file:
+        if not self.have_alignments_file and not self.have_journal:
             raise ValueError("Error: Alignments file not found at "
                              "{}".format(self.file))
 
-        try:
-            logger.info("Reading alignments from: '%s'", self.file)
-            with open(self.file, self.serializer.roptions) as align:
-                data = self.serializer.unmarshal(align.read())
-        except IOError as err:
-            logger.error("'%s' not read: %s", self.file, err.strerror)
-            exit(1)
+        data = dict()
+        if self.have_alignments_file:
+            try:
+                logger.info("Reading alignments from: '%s'", self.file)
+                data = self.serializer.load(self.file)
+            except IOError as err:
+                logger.error("'%s' not read: %s", self.file, err.strerror)
+                exit(1)
+        data = self.load_journal(data)
         logger.debug("Loaded alignments")
         return data
 
@@ -134,15 +169,78 @@ class Alignments():
         logger.debug("Re-loaded alignments")
 
     def save(self):
-        """ Write the serialized alignments file """
+        """ Write the serialized alignments file. Any checkpoint journal is
+            compacted into the file and removed """
         logger.debug("Saving alignments")
         try:
             logger.info("Writing alignments to: '%s'", self.file)
-            with open(self.file, self.serializer.woptions) as align:
-                align.write(self.serializer.marshal(self.data))
+            self.serializer.save(self.file, self.data)
             logger.debug("Saved alignments")
         except IOError as err:
             logger.error("'%s' not written: %s", self.file, err.strerror)
+            return
+        if self.have_journal:
+            logger.debug("Removing compacted journal: '%s'", self.journal_file)
+            os.remove(self.journal_file)
+        self.journaled = len(self.data)
+
+    # < Checkpoint Journal > #
+    # Rewriting the whole file at each checkpoint of a long extract gets slower as the
+    # alignments grow. Checkpoints instead append the frames added since the last one
+    # to a journal of JSON lines, which is replayed over the file on load and removed
+    # once the alignments are saved in full.
+
+    def checkpoint(self):
+        """ Append the frames added since the last checkpoint to the journal.
+
+            Frames must only be added, not changed or deleted, between
+            checkpoints """
+        frames = [(frame, self.data[frame])
+                  for frame in islice(self.data, self.journaled, None)]
+        logger.debug("Checkpointing %s frames to: '%s'", len(frames), self.journal_file)
+        if not frames:
+            return
+        try:
+            with open(self.journal_file, "a") as journal:
+                journal.write("".join("{}\n".format(json.dumps([frame, faces]))
+                                      for frame, faces in frames))
+                journal.flush()
+                os.fsync(journal.fileno())
+        except IOError as err:
+            logger.error("'%s' not written: %s", self.journal_file, err.strerror)
+            return
+        self.journaled += len(frames)
+
+    def load_journal(self, data):
+        """ Replay the frames held in the checkpoint journal over the given
+            data and return it """
+        if not self.have_journal:
+            return data
+        logger.info("Recovering frames from checkpoint journal: '%s'", self.journal_file)
+        count = 0
+        with open(self.journal_file, "r") as journal:
+            for line in journal:
+                try:
+                    frame, faces = json.loads(line)
+                except ValueError:
+                    # The final entry may be incomplete if the process was killed mid-write
+                    logger.warning("Ignoring incomplete journal entry")
+                    break
+                data[frame] = faces
+                count += 1
+        logger.info("Recovered %s frames from checkpoint journal", count)
+        return data
+
+    def set_journal_aside(self):
+        """ Move an existing checkpoint journal out of the way, so that it is
+            not replayed over new alignments """
+        if not self.have_journal:
+            return
+        now = datetime.now().strftime("%Y%m%d_%H%M%S")
+        dst = "{}_{}".format(self.journal_file, now)
+        logger.warning("Found a checkpoint journal from an interrupted run. Moving it to '%s'. "
+                       "Use Skip Existing to resume from it", dst)
+        os.rename(self.journal_file, dst)
 
     def backup(self):
         """ Backup copy of old alignments """
@@ -191,8 +289,15 @@ class Alignments():
     def get_full_frame_name(self, frame):
         """ Return a frame with extension for when the extension is
             not known """
-        retval = next(key for key in self.data.keys()
-                      if key.startswith(frame))
+        if self._stem_index is None:
+            logger.debug("Building frame name index")
+            self._stem_index = dict()
+            for key in self.data.keys():
+                self._stem_index.setdefault(os.path.splitext(key)[0], key)
+        retval = self._stem_index.get(frame, None)
+        if retval is None:
+            retval = next(key for key in self.data.keys()
+                          if key.startswith(frame))
         logger.trace("Requested: '%s', Returning: '%s'", frame, retval)
         return retval
 
@@ -202,8 +307,52 @@ class Alignments():
         logger.trace(retval)
         return retval
 
+    # << INDEXES >> #
+    # Looking up a face by hash, a frame by name without extension or counting the faces
+    # would otherwise scan the whole of the alignments for every call. The indexes are
+    # built on first use and kept up to date by the manipulation methods below. Code that
+    # alters self.data in place by any other means must call invalidate_indexes.
+
+    def invalidate_indexes(self):
+        """ Drop the indexes so that they are rebuilt on next use """
+        logger.trace("Invalidating indexes")
+        self._hash_index = None
+        self._stem_index = None
+        self._faces_count = None
+
+    def index_faces(self, frame, start=0):
+        """ Index the hashes of a frame's faces from the given face index on """
+        if self._hash_index is None:
+            return
+        faces = self.data.get(frame, list())
+        for idx in range(start, len(faces)):
+            f_hash = faces[idx].get("hash", None)
+            if f_hash is not None:
+                self._hash_index[f_hash] = (frame, idx)
+
+    def unindex_face(self, frame, idx):
+        """ Remove a face's hash from the index if it points at this face """
+        if self._hash_index is None:
+            return
+        f_hash = self.data[frame][idx].get("hash", None)
+        if f_hash is not None and self._hash_index.get(f_hash, None) == (frame, idx):
+            del self._hash_index[f_hash]
+
     # << MANIPULATION >> #
 
+    def delete_frame(self, frame):
+        """ Delete a frame and all of it's faces """
+        logger.debug("Deleting frame: '%s'", frame)
+        for idx in range(self.count_faces_in_frame(frame)):
+            self.unindex_face(frame, idx)
+        if self._faces_count is not None:
+            self._faces_count -= self.count_faces_in_frame(frame)
+        stem = os.path.splitext(frame)[0]
+        if self._stem_index is not None and self._stem_index.get(stem, None) == frame:
+            # Another frame may share the name with a different extension. Rebuild on next use
+            self._stem_index = None
+        del self.data[frame]
+
     def delete_face_at_index(self, frame, idx):
         """ Delete the face alignment for given frame at given index """
         logger.debug("Deleting face %s for frame '%s'", idx, frame)
@@ -211,22 +360,34 @@ class Alignments():
         if idx + 1 > self.count_faces_in_frame(frame):
             logger.debug("No face to delete: (frame: '%s', idx %s)", frame, idx)
             return False
+        self.unindex_face(frame, idx)
         del self.data[frame][idx]
+        # Faces after the deleted face move down one index
+        self.index_faces(frame, start=idx)
+        if self._faces_count is not None:
+            self._faces_count -= 1
         logger.debug("Deleted face: (frame: '%s', idx %s)", frame, idx)
         return True
 
     def add_face(self, frame, alignment):
         """ Add a new face for a frame and return it's index """
         logger.debug("Adding face to frame: '%s'", frame)
-        self.data[frame].append(alignment)
+        if frame not in self.data and self._stem_index is not None:
+            self._stem_index.setdefault(os.path.splitext(frame)[0], frame)
+        self.data.setdefault(frame, list()).append(alignment)
         retval = self.count_faces_in_frame(frame) - 1
+        self.index_faces(frame, start=retval)
+        if self._faces_count is not None:
+            self._faces_count += 1
         logger.debug("Returning new face index: %s", retval)
         return retval
 
     def update_face(self, frame, idx, alignment):
         """ Replace a face for given frame and index """
         logger.debug("Updating face %s for frame '%s'", idx, frame)
+        self.unindex_face(frame, idx)
         self.data[frame][idx] = alignment
+        self.index_faces(frame, start=idx)
 
     def filter_hashes(self, hashlist, filter_out=False):
         """ Filter in or out faces that match the hashlist
@@ -235,15 +396,22 @@ class Alignments():
             filter_out=False: Remove faces that are not in the hashlist
         """
         hashset = set(hashlist)
+        removed = 0
         for filename, frame in self.data.items():
             for idx, face in reversed(list(enumerate(frame))):
                 if ((filter_out and face.get("hash", None) in hashset) or
                         (not filter_out and face.get("hash", None) not in hashset)):
                     logger.verbose("Filtering out face: (filename: %s, index: %s)", filename, idx)
                     del frame[idx]
+                    removed += 1
                 else:
                     logger.trace("Not filtering out face: (filename: %s, index: %s)",
                                  filename, idx)
+        if removed:
+            # Remaining faces have been re-indexed throughout. Rebuild the hashes on next use
+            self._hash_index = None
+            if self._faces_count is not None:
+                self._faces_count -= removed
 
     # << GENERATORS >> #
 
@@ -278,6 +446,10 @@ class Alignments():
         """ Return a list of frames that do not contain the original frame
             height and width attributes """
         logger.debug("Getting alignments without frame_dims")
+        if isinstance(self.data, Serializer.ColumnarAlignments):
+            keys = self.data.frames_missing("frame_dims")
+            logger.debug("Got alignments without frame_dims: %s", len(keys))
+            return keys
         keys = list()
         for key, val in self.data.items():
             for alignment in val:
@@ -309,6 +481,10 @@ class Alignments():
             Looks for an 'r' value in the alignments file that
             is not zero """
         logger.debug("Getting alignments containing legacy rotations")
+        if isinstance(self.data, Serializer.ColumnarAlignments):
+            keys = self.data.frames_with_value("r")
+            logger.debug("Got alignments containing legacy rotations: %s", len(keys))
+            return keys
         keys = list()
         for key, val in self.data.items():
             if any(alignment.get("r", None) for alignment in val):
@@ -323,18 +499,32 @@ class Alignments():
             NB: The original frame dimensions must be passed in otherwise
             the transformation cannot be performed """
         logger.trace("Rotating existing landmarks for frame: '%s'", frame_name)
-        for face in self.get_faces_in_frame(frame_name):
-            angle = face.get("r", 0)
-            if not angle:
-                logger.trace("Landmarks do not require rotation: '%s'", frame_name)
-                return
-            logger.trace("Rotating landmarks: (frame: '%s', angle: %s)", frame_name, angle)
-            dims = face["frame_dims"]
-            r_mat = self.get_original_rotation_matrix(dims, angle)
-            rotate_landmarks(face, r_mat)
-            del face["r"]
+        self.rotate_legacy_landmarks([frame_name])
         logger.trace("Rotatated existing landmarks for frame: '%s'", frame_name)
 
+    def rotate_legacy_landmarks(self, frame_names):
+        """ Backwards compatability fix. Rotates the landmarks for all faces in
+            the given frames to their correct position and deletes r.
+
+            Faces are grouped by frame dimensions and angle, so that each
+            rotation matrix is built once and each group is rotated in one go """
+        logger.debug("Rotating existing landmarks for %s frames", len(frame_names))
+        groups = dict()
+        for frame_name in frame_names:
+            for face in self.get_faces_in_frame(frame_name):
+                angle = face.get("r", 0)
+                if not angle:
+                    continue
+                groups.setdefault((tuple(face["frame_dims"]), angle), list()).append(face)
+        for (dims, angle), faces in groups.items():
+            logger.trace("Rotating landmarks: (dims: %s, angle: %s, faces: %s)",
+                         dims, angle, len(faces))
+            r_mat = self.get_original_rotation_matrix(dims, angle)
+            rotate_alignments(faces, r_mat)
+            for face in faces:
+                del face["r"]
+        logger.debug("Rotated existing landmarks: (groups: %s)", len(groups))
+
     @staticmethod
     def get_original_rotation_matrix(dimensions, angle):
         """ Calculate original rotation matrix and invert """
@@ -362,6 +552,10 @@ class Alignments():
     def get_legacy_no_hashes(self):
         """ Get alignments without face hashes """
         logger.debug("Getting alignments without face hashes")
+        if isinstance(self.data, Serializer.ColumnarAlignments):
+            keys = self.data.frames_missing("hash")
+            logger.debug("Got alignments without face hashes: %s", len(keys))
+            return keys
         keys = list()
         for key, val in self.data.items():
             for alignment in val:
@@ -382,4 +576,6 @@ class Alignments():
                            "faces folder. Check your sources for frame '%s'.",
                            abs(count_match), msg, frame_name)
         for idx, i_hash in hashes.items():
+            self.unindex_face(frame_name, idx)
             faces[idx]["hash"] = i_hash
+        self.index_faces(frame_name)
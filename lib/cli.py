@@ -147,6 +147,23 @@ class FileFullPaths(FullPaths):
         return [(name, getattr(self, name)) for name in names]
 
 
+class FilesFullPaths(FileFullPaths):
+    """
+    Class that gui uses to determine if you need to open a file. Takes one
+    or more files.
+
+    see lib/gui/utils.py FileHandler for current GUI filetypes
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, option_strings, dest, nargs="+", filetypes=None, **kwargs):
+        super(FilesFullPaths, self).__init__(option_strings, dest, filetypes=filetypes, **kwargs)
+        self.nargs = nargs
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, [os.path.abspath(os.path.expanduser(value))
+                                       for value in values])
+
+
 class SaveFileFullPaths(FileFullPaths):
     """
     Class that gui uses to determine if you need to save a file.
@@ -309,16 +326,21 @@ class ExtractConvertArgs(FaceSwapArgs):
                               "action": DirFullPaths,
                               "dest": "input_dir",
                               "default": "input",
-                              "help": "Input directory. A directory "
-                                      "containing the files you wish to "
-                                      "process. Defaults to 'input'"})
+                              "help": "Input directory or video. Either a "
+                                      "directory containing the image files "
+                                      "you wish to process or a video file. "
+                                      "Video frames are read directly from "
+                                      "the video. Defaults to 'input'"})
         argument_list.append({"opts": ("-o", "--output-dir"),
                               "action": DirFullPaths,
                               "dest": "output_dir",
                               "default": "output",
                               "help": "Output directory. This is where the "
-                                      "converted files will be stored. "
-                                      "Defaults to 'output'"})
+                                      "converted files will be stored. For "
+                                      "convert, this can instead be a video "
+                                      "file to write the converted frames "
+                                      "straight to video. Defaults to "
+                                      "'output'"})
         argument_list.append({"opts": ("-al", "--alignments"),
                               "action": FileFullPaths,
                               "filetypes": 'alignments',
@@ -366,11 +388,14 @@ class ExtractArgs(ExtractConvertArgs):
                               "type": str.lower,
                               "dest": "serializer",
                               "default": "json",
-                              "choices": ("json", "pickle", "yaml"),
+                              "choices": ("json", "pickle", "yaml", "npz"),
                               "help": "Serializer for alignments file. If "
                                       "yaml is chosen and not available, then "
                                       "json will be used as the default "
-                                      "fallback."})
+                                      "fallback. 'npz' is a compact binary "
+                                      "format which loads quickly and is "
+                                      "memory mapped, for very large "
+                                      "alignments files."})
         argument_list.append({
             "opts": ("-D", "--detector"),
             "type": str,
@@ -503,6 +528,40 @@ class ExtractArgs(ExtractConvertArgs):
                                       "default. WARNING: Don't interrupt the "
                                       "script when writing the file because "
                                       "it might get corrupted."})
+        argument_list.append({"opts": ("-wk", "--workers"),
+                              "type": int,
+                              "dest": "workers",
+                              "default": 0,
+                              "help": "The number of detector/aligner pairs "
+                                      "to shard the frames across. Each "
+                                      "worker runs on it's own GPU (or it's "
+                                      "own share of the CPU cores on hosts "
+                                      "without a GPU). Default is 0 (one "
+                                      "worker per GPU, or one per 4 CPU "
+                                      "cores up to 4)"})
+        argument_list.append({"opts": ("-ti", "--track-interval"),
+                              "type": int,
+                              "dest": "track_interval",
+                              "default": 0,
+                              "help": "For consecutive video frames. Only run "
+                                      "the detector every this many frames, "
+                                      "tracking the faces from the previous "
+                                      "frame with optical flow in between. "
+                                      "The detector is also run whenever a "
+                                      "face can't be tracked confidently or "
+                                      "the previous frame had no faces. Not "
+                                      "supported by dlib-hog. Default is 0 "
+                                      "(detect every frame)"})
+        argument_list.append({"opts": ("-ndc", "--no-detect-cache"),
+                              "action": "store_true",
+                              "dest": "no_detect_cache",
+                              "default": False,
+                              "help": "Don't use the detection cache. By "
+                                      "default the faces found by the "
+                                      "detector are cached in the input "
+                                      "folder, so that re-extracting the "
+                                      "same frames with the same detector "
+                                      "settings skips detection"})
         return argument_list
 
 
@@ -587,6 +646,16 @@ class ConvertArgs(ExtractConvertArgs):
                               "type": int,
                               "default": 1,
                               "help": "Number of GPUs to use for conversion"})
+        argument_list.append({"opts": ("-bs", "--batch-size"),
+                              "type": int,
+                              "dest": "batch_size",
+                              "default": 16,
+                              "help": "Number of faces to swap in a single "
+                                      "model prediction. Frames are held in "
+                                      "memory until their faces are swapped, "
+                                      "so up to this many frames are held at "
+                                      "once. Lower this if you run out of "
+                                      "memory"})
         argument_list.append({"opts": ("-fr", "--frame-ranges"),
                               "nargs": "+",
                               "type": str,
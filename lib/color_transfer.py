@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+""" Color transfer between swapped and original faces for the faceswap
+    converters """
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def adjust_avg_color(old_face, new_face):
+    """ Shift the mean of each channel of the new face to the mean of the
+        old face, clipped to the uint8 range. The new face is updated in
+        place """
+    channels = new_face.shape[-1]
+    old_avg = old_face.reshape(-1, channels).mean(axis=0)
+    new_avg = new_face.reshape(-1, channels).mean(axis=0)
+    # Truncate towards zero, as the adjustment is a whole number of levels
+    diff = (old_avg - new_avg).astype(np.int16)
+    logger.trace("Average color adjustment: %s", diff)
+    new_face[...] = np.clip(new_face + diff, 0, 255)
+
+
+def get_hist_lut(s_counts, t_counts):
+    """ Return the 256 entry lookup table that maps source values to the
+        template values at the same quantile, from the histograms of the
+        source and template """
+    s_total = s_counts.sum()
+    t_total = t_counts.sum()
+    if not s_total or not t_total:
+        return np.arange(256, dtype="float64")
+    s_quantiles = np.cumsum(s_counts) / s_total
+    t_values = np.flatnonzero(t_counts)
+    t_quantiles = np.cumsum(t_counts)[t_values] / t_total
+    return np.interp(s_quantiles, t_quantiles, t_values)
+
+
+def color_hist_match(src_im, tar_im, mask=None):
+    """ Match the histogram of each channel of the source images to the
+        target images.
+
+        src_im, tar_im: uint8 images of shape (height, width, channels) or
+                        batches of shape (faces, height, width, channels)
+        mask:           Optional weights for each pixel, broadcastable to
+                        the images. Only masked pixels are counted for the
+                        histograms, but the whole image is remapped """
+    single = src_im.ndim == 3
+    if single:
+        src_im = src_im[None]
+        tar_im = tar_im[None]
+        mask = None if mask is None else mask[None]
+    num, channels = src_im.shape[0], src_im.shape[-1]
+
+    # Give every channel of every face its own 256 bins, so that all of the
+    # histograms are counted in a single pass
+    offsets = (np.arange(num * channels) * 256).reshape((num, 1, 1, channels))
+    src_bins = (src_im + offsets).ravel()
+    tar_bins = (tar_im + offsets).ravel()
+    weights = None if mask is None else np.broadcast_to(mask, src_im.shape).ravel()
+    bins = num * channels * 256
+    s_counts = np.bincount(src_bins, weights=weights, minlength=bins).reshape((-1, 256))
+    t_counts = np.bincount(tar_bins, weights=weights, minlength=bins).reshape((-1, 256))
+
+    luts = np.concatenate([get_hist_lut(s_count, t_count)
+                           for s_count, t_count in zip(s_counts, t_counts)])
+    matched = luts[src_bins].reshape(src_im.shape).astype(src_im.dtype)
+    return matched[0] if single else matched
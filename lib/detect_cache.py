@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+""" Persistent cache of face detector results for faceswap
+
+    Detection is the most expensive part of extraction, but the boxes found
+    for a frame only depend on the frame itself and the detector settings.
+    Results are cached against a hash of the frame's pixels and a signature
+    of the detector name, version, model files and parameters, so re-running
+    extract with a different aligner, size or alignment option can skip
+    straight to alignment.
+
+    The cache is a single file held in the input folder which holds the
+    results of every detector configuration that has been run on it. """
+
+import json
+import logging
+import os
+from hashlib import sha1
+
+from dlib import rectangle as d_rectangle  # pylint: disable=no-name-in-module
+
+from lib import Serializer
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class DetectCache():
+    """ On disk cache of detected face boxes
+
+        folder:     The folder to store the cache file in
+        detector:   The loaded detector plugin
+        params:     dict of any detector parameters that alter output """
+    filename = ".faceswap_detections"
+
+    def __init__(self, folder, detector, params=None):
+        logger.debug("Initializing %s: (folder: '%s', detector: '%s', params: %s)",
+                     self.__class__.__name__, folder, detector.__module__, params)
+        self.serializer = Serializer.get_serializer("pickle")
+        self.file = os.path.join(str(folder),
+                                 "{}.{}".format(self.filename, self.serializer.ext))
+        self.signature = self.get_signature(detector, params)
+        self.data = self.load()
+        self.detections = self.data.setdefault(self.signature, dict())
+        # Frame hashes of cache misses awaiting their detection results
+        self.pending = dict()
+        self.hits = 0
+        self.changed = False
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    @staticmethod
+    def get_signature(detector, params):
+        """ Return a key for the detector configuration. Made up of the
+            plugin name and version, the model files and the parameters """
+        model_files = list()
+        model_path = detector.model_path
+        if model_path and os.path.isdir(model_path):
+            model_files = [os.path.join(model_path, fname)
+                           for fname in sorted(os.listdir(model_path))]
+        elif model_path and os.path.isfile(model_path):
+            model_files = [model_path]
+        config = {"detector": detector.__module__.split(".")[-1],
+                  "version": detector.version,
+                  "rotation": detector.rotation,
+                  "models": [(os.path.basename(fname), os.path.getsize(fname))
+                             for fname in model_files
+                             if os.path.isfile(fname)],
+                  "params": params if params else dict()}
+        retval = json.dumps(config, sort_keys=True)
+        logger.debug("Detection cache signature: %s", retval)
+        return retval
+
+    # << I/O >> #
+    def load(self):
+        """ Load the cache file if it exists """
+        if not os.path.exists(self.file):
+            logger.debug("No detection cache at: '%s'", self.file)
+            return dict()
+        try:
+            with open(self.file, self.serializer.roptions) as cache:
+                data = self.serializer.unmarshal(cache.read())
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning("Detection cache could not be read and will be rebuilt: %s", err)
+            return dict()
+        logger.verbose("Loaded detection cache: '%s'", self.file)
+        return data
+
+    def save(self):
+        """ Write the cache file if it has been updated """
+        if not self.changed:
+            logger.debug("Detection cache not changed. Not saving")
+            return
+        logger.verbose("Writing detection cache: '%s' (frames: %s, cache hits: %s)",
+                       self.file, len(self.detections), self.hits)
+        try:
+            with open(self.file, self.serializer.woptions) as cache:
+                cache.write(self.serializer.marshal(self.data))
+            self.changed = False
+        except IOError as err:
+            logger.error("'%s' not written: %s", self.file, err.strerror)
+
+    # << CACHE ACCESS >> #
+    @staticmethod
+    def hash_frame(image):
+        """ Return the sha1 hash of the frame's pixels """
+        return sha1(image).hexdigest()
+
+    def get(self, filename, image):
+        """ Return the cached dlib rectangles for the given frame, or None if
+            the frame has not been detected with this configuration """
+        frame_hash = self.hash_frame(image)
+        faces = self.detections.get(frame_hash, None)
+        if faces is None:
+            logger.trace("Detection cache miss: '%s'", filename)
+            self.pending[filename] = frame_hash
+            return None
+        logger.trace("Detection cache hit: '%s'", filename)
+        self.hits += 1
+        return [d_rectangle(*face) for face in faces]
+
+    def add(self, filename, detected_faces):
+        """ Store the dlib rectangles detected for a cache miss """
+        frame_hash = self.pending.pop(filename, None)
+        if frame_hash is None:
+            return
+        logger.trace("Adding to detection cache: '%s'", filename)
+        self.detections[frame_hash] = [(face.left(), face.top(), face.right(), face.bottom())
+                                       for face in detected_faces]
+        self.changed = True
+
+    def discard(self, filename):
+        """ Drop a cache miss whose faces did not come from the detector """
+        if self.pending.pop(filename, None) is not None:
+            logger.trace("Discarding pending detection: '%s'", filename)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+""" Cached face hashing for faceswap
+
+    Faces are matched to their alignments by the sha1 hash of their decoded
+    pixels. Reading and hashing a large faces folder takes minutes, so the
+    hashes are held in a cache file in the faces folder, keyed by each
+    file's name, size and modification time. Only new or changed faces are
+    hashed, and large batches are hashed in a process pool. """
+
+import logging
+import multiprocessing as mp
+import os
+
+from tqdm import tqdm
+
+from lib import Serializer
+from lib.utils import hash_image_file
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class FaceHashes():
+    """ Hashes of the face images held in a folder
+
+        folder:     The folder holding the faces. The cache file is stored here
+        processes:  The number of processes to hash faces with. Default: all cores """
+    filename = ".faceswap_hashes"
+    # Batches smaller than this are hashed in the current process, as it is quicker
+    # than spawning a pool
+    min_pool_batch = 64
+
+    def __init__(self, folder, processes=None):
+        logger.debug("Initializing %s: (folder: '%s', processes: %s)",
+                     self.__class__.__name__, folder, processes)
+        self.folder = str(folder)
+        self.serializer = Serializer.get_serializer("pickle")
+        self.file = os.path.join(self.folder,
+                                 "{}.{}".format(self.filename, self.serializer.ext))
+        self.processes = processes if processes else mp.cpu_count()
+        self.data = self.load()
+        self.changed = False
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    # << I/O >> #
+    def load(self):
+        """ Load the cache file if it exists """
+        if not os.path.exists(self.file):
+            logger.debug("No face hash cache at: '%s'", self.file)
+            return dict()
+        try:
+            with open(self.file, self.serializer.roptions) as cache:
+                data = self.serializer.unmarshal(cache.read())
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning("Face hash cache could not be read and will be rebuilt: %s", err)
+            return dict()
+        logger.verbose("Loaded face hash cache: '%s'", self.file)
+        return data
+
+    def save(self):
+        """ Write the cache file if it has been updated. Faces that are no
+            longer in the folder are dropped from the cache """
+        if not self.changed:
+            logger.debug("Face hash cache not changed. Not saving")
+            return
+        existing = set(os.listdir(self.folder))
+        self.data = {name: val for name, val in self.data.items() if name in existing}
+        logger.verbose("Writing face hash cache: '%s' (faces: %s)", self.file, len(self.data))
+        try:
+            with open(self.file, self.serializer.woptions) as cache:
+                cache.write(self.serializer.marshal(self.data))
+            self.changed = False
+        except IOError as err:
+            logger.warning("'%s' not written: %s", self.file, err.strerror)
+
+    # << HASHING >> #
+    @staticmethod
+    def get_key(filename):
+        """ Return the size and modification time of a file """
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def get_hashes(self, filenames, desc="Hashing Faces"):
+        """ Return a dict of the given full paths of files in the folder to
+            the sha1 hash of their pixels """
+        retval = dict()
+        to_hash = list()
+        for filename in filenames:
+            key = self.get_key(filename)
+            cached = self.data.get(os.path.basename(filename), None)
+            if cached is not None and cached[0] == key:
+                retval[filename] = cached[1]
+            else:
+                to_hash.append((filename, key))
+        logger.verbose("Face hashes cached: %s, to hash: %s", len(retval), len(to_hash))
+        if not to_hash:
+            return retval
+
+        for (filename, key), f_hash in tqdm(zip(to_hash, self.hash_files(to_hash)),
+                                            desc=desc,
+                                            total=len(to_hash)):
+            retval[filename] = f_hash
+            self.data[os.path.basename(filename)] = (key, f_hash)
+        self.changed = True
+        self.save()
+        return retval
+
+    def hash_files(self, to_hash):
+        """ Yield the hash of each file in order, from a process pool for
+            large batches """
+        filenames = [filename for filename, _ in to_hash]
+        if len(filenames) < self.min_pool_batch or self.processes == 1:
+            logger.debug("Hashing %s faces in process", len(filenames))
+            for filename in filenames:
+                yield hash_image_file(filename)
+            return
+        processes = min(self.processes, len(filenames) // self.min_pool_batch + 1)
+        chunksize = max(1, min(64, len(filenames) // (processes * 4)))
+        logger.debug("Hashing %s faces in pool: (processes: %s, chunksize: %s)",
+                     len(filenames), processes, chunksize)
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(processes=processes) as pool:
+            for f_hash in pool.imap(hash_image_file, filenames, chunksize=chunksize):
+                yield f_hash
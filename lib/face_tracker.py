@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+""" Optical flow face tracker for faceswap extract
+
+    Propagates the face boxes found in one frame to the next by tracking
+    feature points inside each box with pyramidal Lucas-Kanade optical flow.
+    Used to skip the detector on frames in between detections when
+    extracting from consecutive video frames.
+
+    Tracking confidence is the share of points which survive a forward-
+    backward flow check. The tracker asks for a detection when the detection
+    interval is reached, when the previous frame had no faces, when the
+    confidence of any face drops below the threshold, or when the frame is
+    not the one directly after the reference frame. """
+
+import logging
+
+import cv2
+import numpy as np
+
+from dlib import rectangle as d_rectangle  # pylint: disable=no-name-in-module
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class FaceTracker():
+    """ Track face boxes between consecutive frames
+
+        interval:       Maximum number of frames between detections
+        min_confidence: Minimum share of points tracked for a face to be
+                        considered tracked
+        max_error:      Maximum forward-backward error in pixels for a point
+                        to be considered tracked """
+    def __init__(self, interval, min_confidence=0.6, max_error=1.0):
+        logger.debug("Initializing %s: (interval: %s, min_confidence: %s, max_error: %s)",
+                     self.__class__.__name__, interval, min_confidence, max_error)
+        self.interval = interval
+        self.min_confidence = min_confidence
+        self.max_error = max_error
+        self.lk_params = dict(winSize=(21, 21),
+                              maxLevel=3,
+                              criteria=(cv2.TERM_CRITERIA_EPS  # pylint: disable=no-member
+                                        | cv2.TERM_CRITERIA_COUNT,  # pylint: disable=no-member
+                                        30, 0.01))
+        self.prev_gray = None
+        self.prev_faces = list()
+        self.prev_index = None
+        self.since_detect = 0
+        self.tracked_count = 0
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    @staticmethod
+    def to_gray(image):
+        """ Return the grayscale version of a BGR frame """
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)  # pylint: disable=no-member
+
+    def update(self, image, detected_faces, index):
+        """ Set the reference frame, it's position in the input and boxes
+            from a detection """
+        self.prev_gray = self.to_gray(image)
+        self.prev_faces = list(detected_faces)
+        self.prev_index = index
+        self.since_detect = 0
+
+    def track(self, image, index):
+        """ Return the face boxes tracked into the frame at the given
+            position in the input as a list of dlib rectangles, or None if the
+            frame should be detected """
+        if (self.prev_gray is None
+                or index is None
+                or self.prev_index is None
+                or index != self.prev_index + 1
+                or not self.prev_faces
+                or self.since_detect + 1 >= self.interval
+                or self.prev_gray.shape != image.shape[:2]):
+            return None
+        gray = self.to_gray(image)
+        tracked = list()
+        for face in self.prev_faces:
+            new_face = self.track_face(face, gray)
+            if new_face is None:
+                logger.trace("Tracking confidence dropped. Re-detecting")
+                return None
+            tracked.append(new_face)
+        self.prev_gray = gray
+        self.prev_faces = tracked
+        self.prev_index = index
+        self.since_detect += 1
+        self.tracked_count += 1
+        logger.trace("Tracked faces: %s", tracked)
+        return tracked
+
+    def track_face(self, face, gray):
+        """ Track one face box into the next frame. Returns the new box or
+            None if it could not be tracked with enough confidence """
+        height, width = gray.shape
+        left, top = max(0, face.left()), max(0, face.top())
+        right, bottom = min(width, face.right()), min(height, face.bottom())
+        if right - left < 8 or bottom - top < 8:
+            return None
+        mask = np.zeros_like(gray)
+        mask[top:bottom, left:right] = 255
+        points = cv2.goodFeaturesToTrack(  # pylint: disable=no-member
+            self.prev_gray, maxCorners=64, qualityLevel=0.01, minDistance=3, mask=mask)
+        if points is None or len(points) < 8:
+            return None
+
+        # pylint: disable=no-member
+        fwd, status_fwd, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None,
+                                                      **self.lk_params)
+        bwd, status_bwd, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, fwd, None,
+                                                      **self.lk_params)
+        error = np.abs(points - bwd).reshape(-1, 2).max(axis=1)
+        good = (status_fwd.ravel() == 1) & (status_bwd.ravel() == 1) & (error < self.max_error)
+        confidence = good.sum() / len(points)
+        logger.trace("Tracking confidence: %s", confidence)
+        if confidence < self.min_confidence:
+            return None
+
+        old_pts = points.reshape(-1, 2)[good]
+        new_pts = fwd.reshape(-1, 2)[good]
+        shift = np.median(new_pts - old_pts, axis=0)
+        old_spread = np.linalg.norm(old_pts - old_pts.mean(axis=0), axis=1)
+        new_spread = np.linalg.norm(new_pts - new_pts.mean(axis=0), axis=1)
+        valid = old_spread > 0
+        scale = np.median(new_spread[valid] / old_spread[valid]) if valid.any() else 1.0
+
+        center_x = (face.left() + face.right()) / 2 + shift[0]
+        center_y = (face.top() + face.bottom()) / 2 + shift[1]
+        half_w = (face.right() - face.left()) * scale / 2
+        half_h = (face.bottom() - face.top()) * scale / 2
+        return d_rectangle(int(round(center_x - half_w)), int(round(center_y - half_h)),
+                           int(round(center_x + half_w)), int(round(center_y + half_h)))
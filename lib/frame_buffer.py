@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+""" Shared memory frame buffer for faceswap
+
+    Holds a fixed number of frame sized slots in a block of shared memory
+    so that frames can be passed between processes without pickling the
+    pixels through a Manager queue. Only a small handle is put to the queue
+    and the receiving process maps the same memory zero-copy.
+
+    The buffer must be passed to a child process at spawn time (as a
+    kwarg to lib.multithreading.SpawnProcess). It cannot be sent through
+    a queue or to a process pool.
+
+    Slots are acquired and released in the process that created the buffer
+    only. Child processes must treat the mapped frames as read-only. """
+
+import ctypes
+import logging
+import multiprocessing as mp
+import queue as Queue
+
+import numpy as np
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class FrameBuffer():
+    """ Ring buffer of frame slots held in shared memory
+
+        slots:      The number of frames that can be held at any one time
+        slot_size:  The size of each slot in bytes """
+    def __init__(self, slots, slot_size):
+        logger.debug("Initializing %s: (slots: %s, slot_size: %s)",
+                     self.__class__.__name__, slots, slot_size)
+        ctx = mp.get_context("spawn")
+        self.slots = slots
+        self.slot_size = slot_size
+        self._buffer = ctx.RawArray(ctypes.c_uint8, slots * slot_size)
+        self._array = None
+        self._free = Queue.Queue()
+        for idx in range(slots):
+            self._free.put(idx)
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def __getstate__(self):
+        """ The free slot list only lives in the owning process and the numpy
+            view is rebuilt on first access in the child """
+        state = self.__dict__.copy()
+        state["_array"] = None
+        state["_free"] = None
+        return state
+
+    @property
+    def array(self):
+        """ Flat uint8 numpy view of the whole shared buffer """
+        if self._array is None:
+            self._array = np.frombuffer(self._buffer, dtype=np.uint8)
+        return self._array
+
+    def put(self, image):
+        """ Copy an image into a free slot and return it's handle.
+
+            Returns None if the image will not fit in a slot or no slot is
+            currently free. The caller should then send the image itself """
+        if image.nbytes > self.slot_size:
+            logger.trace("Image too large for frame buffer: (image: %s, slot: %s)",
+                         image.nbytes, self.slot_size)
+            return None
+        try:
+            slot = self._free.get(block=False)
+        except Queue.Empty:
+            logger.trace("No free frame buffer slots")
+            return None
+        handle = {"slot": slot, "shape": image.shape, "dtype": image.dtype.str}
+        self.get(handle)[...] = image
+        logger.trace("Put image to frame buffer: %s", handle)
+        return handle
+
+    def get(self, handle):
+        """ Return a zero-copy view of the image held in the given slot """
+        start = handle["slot"] * self.slot_size
+        dtype = np.dtype(handle["dtype"])
+        count = int(np.prod(handle["shape"])) * dtype.itemsize
+        return self.array[start:start + count].view(dtype).reshape(handle["shape"])
+
+    def release(self, handle):
+        """ Return the slot to the free list """
+        logger.trace("Releasing frame buffer slot: %s", handle["slot"])
+        self._free.put(handle["slot"])
+
+    # <<< QUEUE ITEM METHODS >>> #
+    def attach(self, item):
+        """ Add the image back into an item received from a queue """
+        if isinstance(item, dict) and item.get("frame_slot", None) is not None:
+            item["image"] = self.get(item["frame_slot"])
+        return item
+
+    @staticmethod
+    def detach(item):
+        """ Remove the image from an item that is about to be put to a queue,
+            if the image is held in the frame buffer """
+        if isinstance(item, dict) and item.get("frame_slot", None) is not None:
+            item.pop("image", None)
+        return item
+
+    def release_item(self, item):
+        """ Release the slot held by a queue item and remove the handle """
+        handle = item.pop("frame_slot", None)
+        if handle is not None:
+            self.release(handle)
@@ -187,3 +187,17 @@ class GPUStats():
         if self.logger:
             self.logger.debug("GPU Card with most free VRAM: %s", retval)
         return retval
+
+    def get_card(self, card_id):
+        """ Return the available VRAM for the given card, in the same
+            format as get_card_most_free """
+        if self.device_count == 0:
+            return self.get_card_most_free()
+        free_vram = self.get_free()
+        retval = {"card_id": card_id,
+                  "device": self.devices[card_id],
+                  "free": free_vram[card_id],
+                  "total": self.vram[card_id]}
+        if self.logger:
+            self.logger.debug("GPU Card %s: %s", card_id, retval)
+        return retval
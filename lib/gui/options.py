@@ -104,6 +104,7 @@ class CliOptions():
         if action in (cli.FullPaths,
                       cli.DirFullPaths,
                       cli.FileFullPaths,
+                      cli.FilesFullPaths,
                       cli.SaveFileFullPaths,
                       cli.ContextFullPaths):
             sysbrowser, filetypes = self.set_sysbrowser(action,
@@ -121,7 +122,7 @@ class CliOptions():
             for the passed in action """
         sysbrowser = "folder"
         filetypes = "default" if not filetypes else filetypes
-        if action == cli.FileFullPaths:
+        if action in (cli.FileFullPaths, cli.FilesFullPaths):
             sysbrowser = "load"
         elif action == cli.SaveFileFullPaths:
             sysbrowser = "save"
@@ -44,6 +44,7 @@ class FileHandler():
                           "alignments": (("JSON", "*.json"),
                                          ("Pickle", "*.p"),
                                          ("YAML", "*.yaml"),
+                                         ("Numpy", "*.npz"),
                                          all_files),
                           "config": (("Faceswap config files", "*.fsw"),
                                      all_files),
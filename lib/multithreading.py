@@ -6,6 +6,7 @@ import multiprocessing as mp
 import queue as Queue
 import sys
 import threading
+from collections import deque
 from lib.logger import LOG_QUEUE, set_root_logger
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -170,23 +171,34 @@ class MultiThread():
 
 class BackgroundGenerator(threading.Thread):
     """ Run a queue in the background. From:
-        https://stackoverflow.com/questions/7323664/ """
+        https://stackoverflow.com/questions/7323664/
+
+        Errors raised by the generator are re-raised from iterator """
     # See below why prefetch count is flawed
     def __init__(self, generator, prefetch=1):
         threading.Thread.__init__(self)
         self.queue = Queue.Queue(maxsize=prefetch)
         self.generator = generator
         self.daemon = True
+        self.err = None
         self.start()
 
     def run(self):
         """ Put until queue size is reached.
             Note: put blocks only if put is called while queue has already
             reached max size => this makes 2 prefetched items! One in the
-            queue, one waiting for insertion! """
-        for item in self.generator:
-            self.queue.put(item)
-        self.queue.put(None)
+            queue, one waiting for insertion!
+
+            The end marker is always put, so that the iterator does not block
+            forever if the generator fails. This includes exit() being called
+            from within the generator """
+        try:
+            for item in self.generator:
+                self.queue.put(item)
+        except BaseException:  # pylint: disable=broad-except
+            self.err = sys.exc_info()
+        finally:
+            self.queue.put(None)
 
     def iterator(self):
         """ Iterate items out of the queue """
@@ -195,6 +207,23 @@ class BackgroundGenerator(threading.Thread):
             if next_item is None:
                 break
             yield next_item
+        if self.err:
+            logger.debug("Error in background generator: %s", self.err[1])
+            raise self.err[1].with_traceback(self.err[2])
+
+
+def pool_imap(pool, target, iterable, prefetch):
+    """ Yield the result of target for each item of iterable, in order, from
+        a multiprocessing Pool or ThreadPool. Unlike Pool.imap, at most
+        prefetch items are handed to the pool ahead of the results being
+        consumed, so memory use is bounded """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(target, (item, )))
+        if len(pending) >= prefetch:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 def terminate_processes():
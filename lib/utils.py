@@ -3,9 +3,12 @@
 
 import logging
 import os
+import struct
 import warnings
 
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
+from itertools import chain
 from pathlib import Path
 from re import finditer
 from time import time
@@ -14,6 +17,7 @@ import cv2
 import numpy as np
 
 import dlib
+from tqdm import tqdm
 
 from lib.faces_detect import DetectedFace
 from lib.training_data import TrainingDataGenerator
@@ -24,6 +28,8 @@ logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 # Global variables
 _image_extensions = [  # pylint: disable=invalid-name
     ".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff"]
+_lossless_extensions = [  # pylint: disable=invalid-name
+    ".bmp", ".png", ".tif", ".tiff"]
 _video_extensions = [  # pylint: disable=invalid-name
     ".avi", ".flv", ".mkv", ".mov", ".mp4", ".mpeg", ".webm"]
 
@@ -60,6 +66,93 @@ def get_image_paths(directory):
     return dir_contents
 
 
+def get_image_dimensions(filenames, desc=None):
+    """ Return a dict of each image file to it's (height, width). The
+        dimensions are read from the image headers where possible, in a thread
+        pool as reading is bound by I/O. Progress is shown if desc is given """
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        dimensions = executor.map(read_image_dimensions, filenames)
+        if desc is not None:
+            dimensions = tqdm(dimensions, desc=desc, total=len(filenames))
+        retval = dict(zip(filenames, dimensions))
+    logger.debug("Read dimensions for %s images", len(retval))
+    return retval
+
+
+def read_image_dimensions(filename):
+    """ Return the (height, width) of an image.
+
+        Read from the header for PNG, BMP and JPEG images without decoding
+        them. Other formats, or headers that can't be read, are decoded """
+    dims = None
+    try:
+        with open(filename, "rb") as image:
+            header = image.read(26)
+            if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+                width, height = struct.unpack(">II", header[16:24])
+                dims = (height, width)
+            elif header.startswith(b"BM") and struct.unpack("<I", header[14:18])[0] >= 40:
+                width, height = struct.unpack("<ii", header[18:26])
+                dims = (abs(height), width)
+            elif header.startswith(b"\xff\xd8"):
+                image.seek(2)
+                dims = read_jpeg_dimensions(image)
+    except (IOError, struct.error) as err:
+        logger.trace("Unable to read header: (filename: '%s', error: %s)", filename, err)
+        dims = None
+    if dims is None:
+        logger.trace("Decoding image for dimensions: '%s'", filename)
+        dims = cv2.imread(filename).shape[:2]  # pylint: disable=no-member
+    logger.trace("filename: '%s', dimensions: %s", filename, dims)
+    return dims
+
+
+def read_jpeg_dimensions(image):
+    """ Walk the markers of an open JPEG file to the start of frame and return
+        the (height, width), as it would be loaded with any EXIF orientation
+        applied. Returns None if the frame header is not found """
+    orientation = 1
+    while True:
+        marker = image.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        code = marker[1]
+        if code == 0xff:
+            # Fill byte
+            image.seek(-1, os.SEEK_CUR)
+            continue
+        if code in (0x01, 0xd8) or 0xd0 <= code <= 0xd7:
+            # Markers without a segment
+            continue
+        if code in (0xd9, 0xda):
+            # End of image or start of scan before a frame header
+            return None
+        length = struct.unpack(">H", image.read(2))[0]
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">xHH", image.read(5))
+            return (width, height) if orientation in (5, 6, 7, 8) else (height, width)
+        if code == 0xe1:
+            orientation = read_exif_orientation(image.read(length - 2), orientation)
+            continue
+        image.seek(length - 2, os.SEEK_CUR)
+
+
+def read_exif_orientation(segment, default=1):
+    """ Return the orientation tag from a JPEG APP1 segment, if it holds one """
+    if not segment.startswith(b"Exif\x00\x00"):
+        return default
+    tiff = segment[6:]
+    endian = "<" if tiff[:2] == b"II" else ">"
+    offset = struct.unpack(endian + "I", tiff[4:8])[0]
+    count = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+    for idx in range(count):
+        entry = offset + 2 + idx * 12
+        tag = struct.unpack(endian + "H", tiff[entry:entry + 2])[0]
+        if tag == 0x0112:
+            return struct.unpack(endian + "H", tiff[entry + 8:entry + 10])[0]
+    return default
+
+
 def hash_image_file(filename):
     """ Return the filename with it's sha1 hash """
     img = cv2.imread(filename)  # pylint: disable=no-member
@@ -70,10 +163,16 @@ def hash_image_file(filename):
 
 def hash_encode_image(image, extension):
     """ Encode the image, get the hash and return the hash with
-        encoded image """
+        encoded image
+
+        The hash is of the decoded pixels. For lossless formats these are the
+        pixels of the source image, so the encoded image is not decoded """
     img = cv2.imencode(extension, image)[1]  # pylint: disable=no-member
-    f_hash = sha1(
-        cv2.imdecode(img, cv2.IMREAD_UNCHANGED)).hexdigest()  # pylint: disable=no-member
+    if extension.lower() in _lossless_extensions and image.dtype == np.uint8:
+        f_hash = sha1(np.ascontiguousarray(image)).hexdigest()
+    else:
+        f_hash = sha1(
+            cv2.imdecode(img, cv2.IMREAD_UNCHANGED)).hexdigest()  # pylint: disable=no-member
     return f_hash, img
 
 
@@ -109,6 +208,24 @@ def set_system_verbosity():
             warnings.simplefilter(action='ignore', category=warncat)
 
 
+def set_process_device(device=None, cpu_cores=None):
+    """ Pin the current process to a GPU and/or a set of CPU cores.
+
+        device:     The index of the GPU, as reported by GPUStats, that should
+                    be the only GPU visible to the process
+        cpu_cores:  List of the CPU core indices the process may run on
+
+        Must be called in the child process before any CUDA library
+        is initialized """
+    logger.debug("Setting process device: (device: %s, cpu_cores: %s)", device, cpu_cores)
+    if device is not None:
+        # Match CUDA's device numbering to NVML's
+        os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+    if cpu_cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_cores)
+
+
 def add_alpha_channel(image, intensity=100):
     """ Add an alpha channel to an image
 
@@ -131,6 +248,61 @@ def add_alpha_channel(image, intensity=100):
     return image_bgra.astype(d_type)
 
 
+def rotate_faces(boxes, landmarks, rotation_matrix):
+    """ Rotate the bounding boxes and landmarks of faces found in a rotated
+        image back to their positions in the original image.
+
+        boxes:      (faces, 4) left, top, right, bottom of each bounding box
+        landmarks:  List of (points, 2) landmarks for each face. Can be empty
+
+        Returns the (faces, 4) left, top, right, bottom of the rotated boxes,
+        following the x, y planes, and a list of the rotated landmarks.
+        Points are handled as int32 """
+    logger.trace("Rotating faces: (rotation_matrix: %s, faces: %s)", rotation_matrix, len(boxes))
+    rotation_matrix = cv2.invertAffineTransform(  # pylint: disable=no-member
+        rotation_matrix)
+    boxes = np.array(boxes).astype(np.int32).reshape(-1, 4)
+    corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(1, -1, 2)
+    corners = cv2.transform(corners,  # pylint: disable=no-member
+                            rotation_matrix).reshape(-1, 4, 2)
+    # Bounding box should follow x, y planes, so get min/max
+    # for non-90 degree rotations
+    rotated_boxes = np.concatenate((corners.min(axis=1), corners.max(axis=1)), axis=1)
+
+    lengths = [len(points) for points in landmarks]
+    rotated_landmarks = [np.zeros((0, 2), dtype=np.int32) for _ in landmarks]
+    if any(lengths):
+        # Flattening the nested lists is quicker than having numpy parse their structure
+        points = np.fromiter(chain.from_iterable(chain.from_iterable(landmarks)),
+                             dtype=np.float64,
+                             count=sum(lengths) * 2).astype(np.int32)
+        points = cv2.transform(points.reshape(1, -1, 2),  # pylint: disable=no-member
+                               rotation_matrix).reshape(-1, 2)
+        rotated_landmarks = np.split(points, np.cumsum(lengths)[:-1])
+    return rotated_boxes, rotated_landmarks
+
+
+def rotate_alignments(faces, rotation_matrix):
+    """ Rotate the landmarks and bounding boxes of a list of Alignments dicts,
+        found in the same rotated image, in place """
+    boxes = [[face.get("x", 0),
+              face.get("y", 0),
+              face.get("x", 0) + face.get("w", 0),
+              face.get("y", 0) + face.get("h", 0)] for face in faces]
+    landmarks = [face.get("landmarksXY", None) or list() for face in faces]
+    rotated_boxes, rotated_landmarks = rotate_faces(boxes, landmarks, rotation_matrix)
+    # Release the original landmarks, so each is freed as it is replaced
+    del landmarks
+    for face, box, points in zip(faces, rotated_boxes.tolist(), rotated_landmarks):
+        face["x"] = box[0]
+        face["y"] = box[1]
+        face["w"] = box[2] - box[0]
+        face["h"] = box[3] - box[1]
+        face["r"] = 0
+        if len(points):
+            face["landmarksXY"] = list(map(tuple, points.tolist()))
+
+
 def rotate_landmarks(face, rotation_matrix):
     """ Rotate the landmarks and bounding box for faces
         found in rotated images.
@@ -138,74 +310,39 @@ def rotate_landmarks(face, rotation_matrix):
     logger.trace("Rotating landmarks: (rotation_matrix: %s, type(face): %s",
                  rotation_matrix, type(face))
     if isinstance(face, DetectedFace):
-        bounding_box = [[face.x, face.y],
-                        [face.x + face.w, face.y],
-                        [face.x + face.w, face.y + face.h],
-                        [face.x, face.y + face.h]]
-        landmarks = face.landmarksXY
+        bounding_box = [face.x, face.y, face.x + face.w, face.y + face.h]
+        landmarks = face.landmarksXY if face.landmarksXY else list()
 
     elif isinstance(face, dict):
-        bounding_box = [[face.get("x", 0), face.get("y", 0)],
-                        [face.get("x", 0) + face.get("w", 0),
-                         face.get("y", 0)],
-                        [face.get("x", 0) + face.get("w", 0),
-                         face.get("y", 0) + face.get("h", 0)],
-                        [face.get("x", 0),
-                         face.get("y", 0) + face.get("h", 0)]]
-        landmarks = face.get("landmarksXY", list())
+        rotate_alignments([face], rotation_matrix)
+        logger.trace("Rotated landmarks: %s", face.get("landmarksXY", list()))
+        return face
 
     elif isinstance(face,
                     dlib.rectangle):  # pylint: disable=c-extension-no-member
-        bounding_box = [[face.left(), face.top()],
-                        [face.right(), face.top()],
-                        [face.right(), face.bottom()],
-                        [face.left(), face.bottom()]]
+        bounding_box = [face.left(), face.top(), face.right(), face.bottom()]
         landmarks = list()
     else:
         raise ValueError("Unsupported face type")
 
     logger.trace("Original landmarks: %s", landmarks)
 
-    rotation_matrix = cv2.invertAffineTransform(  # pylint: disable=no-member
-        rotation_matrix)
-    rotated = list()
-    for item in (bounding_box, landmarks):
-        if not item:
-            continue
-        points = np.array(item, np.int32)
-        points = np.expand_dims(points, axis=0)
-        transformed = cv2.transform(points,  # pylint: disable=no-member
-                                    rotation_matrix).astype(np.int32)
-        rotated.append(transformed.squeeze())
-
-    # Bounding box should follow x, y planes, so get min/max
-    # for non-90 degree rotations
-    pt_x = min([pnt[0] for pnt in rotated[0]])
-    pt_y = min([pnt[1] for pnt in rotated[0]])
-    pt_x1 = max([pnt[0] for pnt in rotated[0]])
-    pt_y1 = max([pnt[1] for pnt in rotated[0]])
+    rotated_boxes, rotated = rotate_faces([bounding_box], [landmarks], rotation_matrix)
+    pt_x, pt_y, pt_x1, pt_y1 = rotated_boxes[0].tolist()
 
     if isinstance(face, DetectedFace):
-        face.x = int(pt_x)
-        face.y = int(pt_y)
-        face.w = int(pt_x1 - pt_x)
-        face.h = int(pt_y1 - pt_y)
+        face.x = pt_x
+        face.y = pt_y
+        face.w = pt_x1 - pt_x
+        face.h = pt_y1 - pt_y
         face.r = 0
-        if len(rotated) > 1:
-            rotated_landmarks = [tuple(point) for point in rotated[1].tolist()]
+        rotated_landmarks = face.landmarksXY
+        if landmarks:
+            rotated_landmarks = list(map(tuple, rotated[0].tolist()))
             face.landmarksXY = rotated_landmarks
-    elif isinstance(face, dict):
-        face["x"] = int(pt_x)
-        face["y"] = int(pt_y)
-        face["w"] = int(pt_x1 - pt_x)
-        face["h"] = int(pt_y1 - pt_y)
-        face["r"] = 0
-        if len(rotated) > 1:
-            rotated_landmarks = [tuple(point) for point in rotated[1].tolist()]
-            face["landmarksXY"] = rotated_landmarks
     else:
         rotated_landmarks = dlib.rectangle(  # pylint: disable=c-extension-no-member
-            int(pt_x), int(pt_y), int(pt_x1), int(pt_y1))
+            pt_x, pt_y, pt_x1, pt_y1)
         face = rotated_landmarks
 
     logger.trace("Rotated landmarks: %s", rotated_landmarks)
@@ -7,11 +7,15 @@
 import cv2
 import numpy as np
 
+from lib.color_transfer import adjust_avg_color
 from lib.utils import add_alpha_channel
 
 
 class Convert():
     """ Adjust Converter """
+    padding = 48
+    face_size = 256
+
     def __init__(self, encoder, smooth_mask=True, avg_color_adjust=True,
                  draw_transparent=False, **kwargs):
         self.encoder = encoder
@@ -22,32 +26,59 @@ class Convert():
 
     def patch_image(self, frame, detected_face, size):
         """ Patch swapped face onto original image """
+        prepared = self.prepare_face(frame, detected_face, size)
+        prediction = self.predict([prepared["feed"]])[0]
+        return self.apply_face(frame, prepared, prediction)
+
+    def prepare_face(self, frame, detected_face, size):
+        """ Return the aligned face to feed the model, along with the items
+            needed to patch the swapped face back onto the frame """
         # pylint: disable=no-member
-        # assert image.shape == (256, 256, 3)
-        padding = 48
-        face_size = 256
-        detected_face.load_aligned(frame, face_size, padding,
+        detected_face.load_aligned(frame, self.face_size, self.padding,
                                    align_eyes=False)
-        src_face = detected_face.aligned_face
+        crop = slice(self.padding, self.face_size - self.padding)
+        old_face = detected_face.aligned_face[crop, crop].copy()
 
-        crop = slice(padding, face_size - padding)
-        process_face = src_face[crop, crop]
-        old_face = process_face.copy()
-
-        process_face = cv2.resize(process_face,
+        process_face = cv2.resize(old_face,
                                   (size, size),
                                   interpolation=cv2.INTER_AREA)
-        process_face = np.expand_dims(process_face, 0)
+        return {"detected_face": detected_face,
+                "old_face": old_face,
+                "crop": crop,
+                "feed": process_face / 255.0}
+
+    def predict(self, feeds):
+        """ Swap a batch of aligned faces in a single call to the model.
+            Returns the model output for each face """
+        return self.encoder(np.stack(feeds))
+
+    def apply_faces(self, frame, faces):
+        """ Patch the swapped faces of a frame onto the frame from a list of
+            (prepared face, model output) """
+        for prepared, prediction in faces:
+            frame = self.apply_face(frame, prepared, prediction)
+        return frame
+
+    def apply_face(self, frame, prepared, prediction):
+        """ Patch the swapped face from the model output onto the frame """
+        # pylint: disable=no-member
+        detected_face = prepared["detected_face"]
+        old_face = prepared["old_face"]
+        crop = prepared["crop"]
+        # Re-align from the frame as it is now, so that the padding around the
+        # face holds any faces already patched onto the frame
+        detected_face.load_aligned(frame, self.face_size, self.padding,
+                                   align_eyes=False)
+        src_face = detected_face.aligned_face
 
-        new_face = self.encoder(process_face / 255.0)[0]
-        new_face = np.clip(new_face * 255, 0, 255).astype(src_face.dtype)
+        new_face = np.clip(prediction * 255, 0, 255).astype(src_face.dtype)
         new_face = cv2.resize(
             new_face,
-            (face_size - padding * 2, face_size - padding * 2),
+            old_face.shape[1::-1],
             interpolation=cv2.INTER_CUBIC)
 
         if self.use_avg_color_adjust:
-            self.adjust_avg_color(old_face, new_face)
+            adjust_avg_color(old_face, new_face)
         if self.use_smooth_mask:
             self.smooth_mask(old_face, new_face)
 
@@ -67,23 +98,6 @@ class Convert():
             borderMode=cv2.BORDER_TRANSPARENT)
         return new_image
 
-    @staticmethod
-    def adjust_avg_color(old_face, new_face):
-        """ Perform average color adjustment """
-        for i in range(new_face.shape[-1]):
-            old_avg = old_face[:, :, i].mean()
-            new_avg = new_face[:, :, i].mean()
-            diff_int = (int)(old_avg - new_avg)
-            for int_h in range(new_face.shape[0]):
-                for int_w in range(new_face.shape[1]):
-                    temp = (new_face[int_h, int_w, i] + diff_int)
-                    if temp < 0:
-                        new_face[int_h, int_w, i] = 0
-                    elif temp > 255:
-                        new_face[int_h, int_w, i] = 255
-                    else:
-                        new_face[int_h, int_w, i] = temp
-
     @staticmethod
     def smooth_mask(old_face, new_face):
         """ Smooth the mask """
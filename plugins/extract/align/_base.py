@@ -15,6 +15,10 @@
      "image": <source image>,
      "detected_faces": <list of dlibRectangles>,
      "landmarks": <list of landmarks>}
+
+    If a shared memory frame buffer is in use, "image" is mapped in from,
+    and removed again before output to, the "frame_slot" handle held in
+    the item. See lib.frame_buffer.FrameBuffer
     """
 
 import logging
@@ -22,9 +26,11 @@ import os
 import traceback
 
 from io import StringIO
+from queue import Empty as QueueEmpty
 
 from lib.aligner import Extract
 from lib.gpu_stats import GPUStats
+from lib.utils import set_process_device
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -42,6 +48,14 @@ class Aligner():
         # See lib.queue_manager.QueueManager for getting queues
         self.queues = {"in": None, "out": None}
 
+        # The GPU this process is pinned to. None uses the card with the
+        # most free VRAM. Set from the device kwarg
+        self.device = None
+
+        # Shared memory frame buffer. See lib.frame_buffer.FrameBuffer
+        # Images arrive as slot handles if this is set
+        self.frame_buffer = None
+
         #  Path to model if required
         self.model_path = self.set_model_path()
 
@@ -71,6 +85,9 @@ class Aligner():
         self.init = kwargs["event"]
         self.queues["in"] = kwargs["in_queue"]
         self.queues["out"] = kwargs["out_queue"]
+        self.device = kwargs.get("device", None)
+        set_process_device(self.device, kwargs.get("cpu_cores", None))
+        self.frame_buffer = kwargs.get("frame_buffer", None)
 
     def align(self, *args, **kwargs):
         """ Process landmarks
@@ -107,14 +124,19 @@ class Aligner():
         logger.trace("Item out: %s", {key: val
                                       for key, val in output.items()
                                       if key != "image"})
+        if self.frame_buffer is not None:
+            self.frame_buffer.detach(output)
         self.queues["out"].put((output))
 
     # <<< MISC METHODS >>> #
-    @staticmethod
-    def get_vram_free():
-        """ Return free and total VRAM on card with most VRAM free"""
+    def get_vram_free(self):
+        """ Return free and total VRAM on the pinned card, or the card with
+            most VRAM free if not pinned """
         stats = GPUStats()
-        vram = stats.get_card_most_free()
+        if self.device is None:
+            vram = stats.get_card_most_free()
+        else:
+            vram = stats.get_card(self.device)
         logger.verbose("Using device %s with %sMB free of %sMB",
                        vram["device"],
                        int(vram["free"]),
@@ -124,17 +146,52 @@ class Aligner():
     def get_item(self):
         """ Yield one item from the queue """
         while True:
-            item = self.queues["in"].get()
-            if isinstance(item, dict):
-                logger.trace("Item in: %s", {key: val
-                                             for key, val in item.items()
-                                             if key != "image"})
-                # Pass Detector failures straight out and quit
-                if item.get("exception", None):
-                    self.queues["out"].put(item)
-                    exit(1)
-            else:
-                logger.trace("Item in: %s", item)
+            item = self.check_item(self.queues["in"].get())
             yield item
             if item == "EOF":
                 break
+
+    def get_batch(self, batch_size):
+        """ Get a batch of items from the queue holding up to batch_size
+            frames or faces, whichever is reached first.
+
+            Blocks for the first item only, and then takes whatever is already
+            waiting in the queue. Callers that put one item and wait for the
+            result (e.g. the manual and sort tools) are never held up.
+
+            First item in output tuple indicates whether the queue is
+            exhausted. Second item is the batch """
+        exhausted = False
+        batch = list()
+        faces_count = 0
+        while len(batch) < batch_size and faces_count < batch_size:
+            try:
+                item = self.queues["in"].get(block=not batch)
+            except QueueEmpty:
+                break
+            item = self.check_item(item)
+            if item == "EOF":
+                exhausted = True
+                break
+            batch.append(item)
+            faces_count += len(item["detected_faces"])
+        logger.trace("Returning batch: (frames: %s, faces: %s, exhausted: %s)",
+                     len(batch), faces_count, exhausted)
+        return exhausted, batch
+
+    def check_item(self, item):
+        """ Attach the frame to an item taken from the queue and pass
+            Detector failures straight out """
+        if self.frame_buffer is not None:
+            self.frame_buffer.attach(item)
+        if isinstance(item, dict):
+            logger.trace("Item in: %s", {key: val
+                                         for key, val in item.items()
+                                         if key != "image"})
+            # Pass Detector failures straight out and quit
+            if item.get("exception", None):
+                self.queues["out"].put(item)
+                exit(1)
+        else:
+            logger.trace("Item in: %s", item)
+        return item
@@ -15,6 +15,10 @@ class Align(Aligner):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.vram = 2240
+        # Approximate additional VRAM required for each extra face in a batch
+        self.vram_per_face = 128
+        self.max_batch_size = 32
+        self.batch_size = 1
         self.reference_scale = 195.0
         self.model = None
         self.test = None
@@ -34,50 +38,77 @@ class Align(Aligner):
         logger.info("Initializing Face Alignment Network...")
         logger.debug("fan initialize: (args: %s kwargs: %s)", args, kwargs)
 
-        card_id, _, vram_total = self.get_vram_free()
+        card_id, vram_free, vram_total = self.get_vram_free()
         if card_id == -1:
             self.init.set()
             raise ValueError("No Graphics Card Detected! FAN is not currently supported on CPU. "
                              "Use another aligner.")
 
-        if vram_total <= self.vram:
+        self.batch_size = self.get_batch_size(vram_free)
+        vram_required = self.vram + (self.batch_size - 1) * self.vram_per_face
+        if vram_total <= vram_required:
             tf_ratio = 1.0
         else:
-            tf_ratio = self.vram / vram_total
-        logger.verbose("Reserving %sMB for face alignments", self.vram)
+            tf_ratio = vram_required / vram_total
+        logger.verbose("Reserving %sMB for face alignments", vram_required)
 
-        self.model = FAN(self.model_path, ratio=tf_ratio)
+        self.model = FAN(self.model_path, ratio=tf_ratio, batch_size=self.batch_size)
+        self.batch_size = self.model.batch_size
+        logger.verbose("Processing in batches of up to %s faces", self.batch_size)
 
         self.init.set()
         logger.info("Initialized Face Alignment Network.")
 
+    def get_batch_size(self, vram_free):
+        """ Return the largest power of 2 batch size that the free VRAM will
+            support. Only powers of 2 are fed to the model to keep the number
+            of different input shapes small """
+        available = int((vram_free - self.vram) / self.vram_per_face) + 1
+        available = max(1, min(available, self.max_batch_size))
+        batch_size = 1
+        while batch_size * 2 <= available:
+            batch_size *= 2
+        logger.debug("Batch size: (vram_free: %s, batch_size: %s)", vram_free, batch_size)
+        return batch_size
+
     def align(self, *args, **kwargs):
         """ Perform alignments on detected faces """
         super().align(*args, **kwargs)
-        for item in self.get_item():
-            if item == "EOF":
-                self.finalize(item)
+        while True:
+            exhausted, batch = self.get_batch(self.batch_size)
+            if batch:
+                self.process_batch(batch)
+            if exhausted:
+                self.finalize("EOF")
                 break
-            image = item["image"][:, :, ::-1].copy()
-
-            logger.trace("Algning faces")
-            item["landmarks"] = self.process_landmarks(image, item["detected_faces"])
-            logger.trace("Algned faces: %s", item["landmarks"])
-
-            self.finalize(item)
         logger.debug("Completed Align")
 
-    def process_landmarks(self, image, detected_faces):
-        """ Align image and process landmarks """
-        logger.trace("Processing landmarks")
-        retval = list()
-        for detected_face in detected_faces:
-            center, scale = self.get_center_scale(detected_face)
-            aligned_image = self.align_image(image, center, scale)
-            landmarks = self.predict_landmarks(aligned_image, center, scale)
-            retval.append(landmarks)
-        logger.trace("Processed landmarks: %s", retval)
-        return retval
+    def process_batch(self, batch):
+        """ Crop every face in a batch of frames, predict the landmarks for
+            all of them together and put them back to their frames in order """
+        logger.trace("Processing landmarks: %s", [item["filename"] for item in batch])
+        feed = list()
+        centers = list()
+        scales = list()
+        owners = list()
+        for item in batch:
+            image = item["image"][:, :, ::-1]
+            item["landmarks"] = list()
+            for detected_face in item["detected_faces"]:
+                center, scale = self.get_center_scale(detected_face)
+                feed.append(self.align_image(image, center, scale))
+                centers.append(center)
+                scales.append(scale)
+                owners.append(item)
+
+        if feed:
+            landmarks = self.predict_landmarks(np.array(feed), centers, scales)
+            for item, face_landmarks in zip(owners, landmarks):
+                item["landmarks"].append(face_landmarks)
+
+        for item in batch:
+            logger.trace("Aligned faces: %s", item["landmarks"])
+            self.finalize(item)
 
     def get_center_scale(self, detected_face):
         """ Get the center and set scale of bounding box """
@@ -106,14 +137,20 @@ class Align(Aligner):
             center,
             scale).transpose((2, 0, 1)).astype(np.float32) / 255.0
         logger.trace("Aligned image around center")
-        return np.expand_dims(image, 0)
-
-    def predict_landmarks(self, image, center, scale):
-        """ Predict the 68 point landmarks """
-        logger.trace("Predicting Landmarks")
-        prediction = self.model.predict(image)[-1]
-        pts_img = self.get_pts_from_predict(prediction, center, scale)
-        retval = [(int(pt[0]), int(pt[1])) for pt in pts_img]
+        return image
+
+    def predict_landmarks(self, feed, centers, scales):
+        """ Predict the 68 point landmarks for a stack of aligned faces """
+        logger.trace("Predicting Landmarks: %s", feed.shape[0])
+        centers = np.array(centers)
+        scales = np.array(scales)
+        retval = list()
+        for start in range(0, feed.shape[0], self.batch_size):
+            end = start + self.batch_size
+            predictions = self.model.predict(feed[start:end])
+            pts_img = self.get_pts_from_predict(predictions, centers[start:end], scales[start:end])
+            retval.extend([[tuple(pt) for pt in face]
+                           for face in pts_img.astype("int32").tolist()])
         logger.trace("Predicted Landmarks: %s", retval)
         return retval
 
@@ -175,35 +212,43 @@ class Align(Aligner):
         logger.trace("Cropped image")
         return new_img
 
-    def get_pts_from_predict(self, var_a, center, scale):
-        """ Get points from predictor """
+    @staticmethod
+    def get_pts_from_predict(heatmaps, centers, scales):
+        """ Get points from predictor for a batch of heatmaps of shape
+            (faces, landmarks, height, width) and the center and scale of
+            each face's crop. Returns the points in the original frame with
+            shape (faces, landmarks, 2) """
         logger.trace("Obtain points from prediction")
-        var_b = var_a.reshape((var_a.shape[0],
-                               var_a.shape[1] * var_a.shape[2]))
-        var_c = var_b.argmax(1).reshape((var_a.shape[0],
-                                         1)).repeat(2,
-                                                    axis=1).astype(np.float)
-        var_c[:, 0] %= var_a.shape[2]
-        var_c[:, 1] = np.apply_along_axis(
-            lambda x: np.floor(x / var_a.shape[2]),
-            0,
-            var_c[:, 1])
-
-        for i in range(var_a.shape[0]):
-            pt_x, pt_y = int(var_c[i, 0]), int(var_c[i, 1])
-            if pt_x > 0 and pt_x < 63 and pt_y > 0 and pt_y < 63:
-                diff = np.array([var_a[i, pt_y, pt_x+1]
-                                 - var_a[i, pt_y, pt_x-1],
-                                 var_a[i, pt_y+1, pt_x]
-                                 - var_a[i, pt_y-1, pt_x]])
-
-                var_c[i] += np.sign(diff)*0.25
-
-        var_c += 0.5
-        retval = [self.transform(var_c[i], center, scale, var_a.shape[2])
-                  for i in range(var_a.shape[0])]
+        faces, points, height, width = heatmaps.shape
+        indices = heatmaps.reshape(faces, points, height * width).argmax(axis=-1)
+        pts_x = indices % width
+        pts_y = indices // width
+
+        # Move a quarter pixel towards the higher neighbour for points off the edge
+        face_idx = np.arange(faces)[:, None]
+        point_idx = np.arange(points)[None, :]
+        diff_x = (heatmaps[face_idx, point_idx, pts_y, np.minimum(pts_x + 1, width - 1)]
+                  - heatmaps[face_idx, point_idx, pts_y, np.maximum(pts_x - 1, 0)])
+        diff_y = (heatmaps[face_idx, point_idx, np.minimum(pts_y + 1, height - 1), pts_x]
+                  - heatmaps[face_idx, point_idx, np.maximum(pts_y - 1, 0), pts_x])
+        inside = (pts_x > 0) & (pts_x < width - 1) & (pts_y > 0) & (pts_y < height - 1)
+        offsets = np.sign(np.stack((diff_x, diff_y), axis=-1)) * 0.25
+        pts = np.stack((pts_x, pts_y), axis=-1).astype("float64")
+        pts += np.where(inside[..., None], offsets, 0.0)
+        pts += 0.5
+
+        # Invert the crop transform once per face and apply to all of it's points
+        hscl = 200.0 * scales
+        matrix = np.zeros((faces, 3, 3))
+        matrix[:, 0, 0] = width / hscl
+        matrix[:, 1, 1] = width / hscl
+        matrix[:, 0, 2] = width * (-centers[:, 0] / hscl + 0.5)
+        matrix[:, 1, 2] = width * (-centers[:, 1] / hscl + 0.5)
+        matrix[:, 2, 2] = 1.0
+        matrix = np.linalg.inv(matrix)
+        pts = np.concatenate((pts, np.ones((faces, points, 1))), axis=-1)
+        retval = np.matmul(matrix[:, None], pts[..., None])[..., :2, 0]
         logger.trace("Obtained points from prediction: %s", retval)
-
         return retval
 
 
@@ -212,13 +257,14 @@ class FAN():
     Converted from pyTorch via ONNX from:
     https://github.com/1adrianb/face-alignment """
 
-    def __init__(self, model_path, ratio=1.0):
+    def __init__(self, model_path, ratio=1.0, batch_size=1):
         # Must import tensorflow inside the spawned process
         # for Windows machines
         import tensorflow as tf
         self.tf = tf  # pylint: disable=invalid-name
 
         self.model_path = model_path
+        self.batch_size = batch_size
         self.graph = self.load_graph()
         self.input = self.graph.get_tensor_by_name("fa/0:0")
         self.output = self.graph.get_tensor_by_name("fa/Add_95:0")
@@ -237,18 +283,39 @@ class FAN():
         return fa_graph
 
     def set_session(self, vram_ratio):
-        """ Set the TF Session and initialize """
+        """ Set the TF Session and initialize at the full batch size.
+            Falls back to a batch size of 1 if the graph will not batch """
         # pylint: disable=not-context-manager, no-member
-        placeholder = np.zeros((1, 3, 256, 256))
         with self.graph.as_default():
             config = self.tf.ConfigProto()
             config.gpu_options.per_process_gpu_memory_fraction = vram_ratio
             session = self.tf.Session(config=config)
             with session.as_default():
-                session.run(self.output, feed_dict={self.input: placeholder})
+                try:
+                    placeholder = np.zeros((self.batch_size, 3, 256, 256))
+                    session.run(self.output, feed_dict={self.input: placeholder})
+                except (self.tf.errors.InvalidArgumentError,
+                        self.tf.errors.ResourceExhaustedError) as err:
+                    if self.batch_size == 1:
+                        raise
+                    logger.warning("Unable to batch Face Alignment Network. Processing one "
+                                   "face at a time. Original Error: %s", err)
+                    self.batch_size = 1
+                    placeholder = np.zeros((1, 3, 256, 256))
+                    session.run(self.output, feed_dict={self.input: placeholder})
         return session
 
     def predict(self, feed_item):
-        """ Predict landmarks in session """
+        """ Predict landmarks in session.
+            Batches are padded up to the next power of 2 so that only a
+            small number of input shapes are ever fed to the graph """
+        count = feed_item.shape[0]
+        padded = 1
+        while padded < count:
+            padded *= 2
+        if padded != count:
+            padding = np.zeros((padded - count, ) + feed_item.shape[1:],
+                               dtype=feed_item.dtype)
+            feed_item = np.concatenate((feed_item, padding))
         return self.session.run(self.output,
-                                feed_dict={self.input: feed_item})
+                                feed_dict={self.input: feed_item})[:count]
@@ -9,6 +9,20 @@
     {"filename": <filename of source frame>,
      "image": <source image>,
      "detected_faces": <list of dlib.rectangles>}
+
+    If a shared memory frame buffer is in use, "image" is mapped in from,
+    and removed again before output to, the "frame_slot" handle held in
+    the item. See lib.frame_buffer.FrameBuffer
+
+    If tracking is enabled, frames whose faces can be tracked from the
+    previous frame are output by get_item/get_batch directly with
+    "tracked": True, and are never passed to the plugin. Frames are then
+    handed to the plugin one at a time so that each detection is available
+    to track from. Items hold the "frame_index" of the frame in the input, so
+    that faces are only ever tracked from the frame directly before. Frames
+    that arrive with "detected_faces" already set from the detection cache
+    are output directly, and only update the tracker.
+    See lib.face_tracker.FaceTracker
     """
 
 import logging
@@ -19,8 +33,9 @@ from io import StringIO
 import cv2
 import dlib
 
+from lib.face_tracker import FaceTracker
 from lib.gpu_stats import GPUStats
-from lib.utils import rotate_landmarks
+from lib.utils import rotate_landmarks, set_process_device
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -35,10 +50,27 @@ class Detector():
         self.parent_is_pool = False
         self.init = None
 
+        # Version of the plugin's output. Increment when a change to the
+        # plugin alters the faces it detects so that stale results are not
+        # picked up from the detection cache. See lib.detect_cache
+        self.version = 1
+
         # The input and output queues for the plugin.
         # See lib.queue_manager.QueueManager for getting queues
         self.queues = {"in": None, "out": None}
 
+        # The GPU this process is pinned to. None uses the card with the
+        # most free VRAM. Set from the device kwarg
+        self.device = None
+
+        # Shared memory frame buffer. See lib.frame_buffer.FrameBuffer
+        # Images arrive as slot handles if this is set
+        self.frame_buffer = None
+
+        # Optical flow tracker for skipping detection between frames.
+        # Set from the track_interval kwarg
+        self.tracker = None
+
         # Scaling factor for image. Plugin dependent
         self.scale = 1.0
 
@@ -81,6 +113,13 @@ class Detector():
         self.init = kwargs.get("event", False)
         self.queues["in"] = kwargs["in_queue"]
         self.queues["out"] = kwargs["out_queue"]
+        self.device = kwargs.get("device", None)
+        set_process_device(self.device, kwargs.get("cpu_cores", None))
+        self.frame_buffer = kwargs.get("frame_buffer", None)
+        track_interval = kwargs.get("track_interval", 0)
+        if track_interval and track_interval > 1:
+            logger.verbose("Tracking faces. Detecting at most every %s frames", track_interval)
+            self.tracker = FaceTracker(track_interval)
 
     def detect_faces(self, *args, **kwargs):
         """ Detect faces in rgb image
@@ -120,6 +159,14 @@ class Detector():
                                           if key != "image"})
         else:
             logger.trace("Item out: %s", output)
+        if (self.tracker is not None
+                and isinstance(output, dict)
+                and not output.get("tracked", False)):
+            self.tracker.update(output["image"],
+                                output["detected_faces"],
+                                output.get("frame_index", None))
+        if self.frame_buffer is not None:
+            self.frame_buffer.detach(output)
         self.queues["out"].put(output)
 
     # <<< DETECTION IMAGE COMPILATION METHODS >>> #
@@ -242,13 +289,20 @@ class Detector():
     # << QUEUE METHODS >> #
     def get_item(self):
         """ Yield one item from the queue """
-        item = self.queues["in"].get()
-        if isinstance(item, dict):
-            logger.trace("Item in: %s", item["filename"])
-        else:
-            logger.trace("Item in: %s", item)
+        while True:
+            item = self.queues["in"].get()
+            if self.frame_buffer is not None:
+                self.frame_buffer.attach(item)
+            if isinstance(item, dict):
+                logger.trace("Item in: %s", item["filename"])
+            else:
+                logger.trace("Item in: %s", item)
+            if not self.pass_cached_item(item) and not self.track_item(item):
+                break
         if item == "EOF":
             logger.debug("In Queue Exhausted")
+            if self.tracker is not None:
+                logger.debug("Frames tracked: %s", self.tracker.tracked_count)
             # Re-put EOF into queue for other threads
             self.queues["in"].put(item)
         return item
@@ -265,7 +319,9 @@ class Detector():
             the final batch """
         exhausted = False
         batch = list()
-        for _ in range(self.batch_size):
+        # Detections must be finalized before the next frame can be tracked
+        batch_size = 1 if self.tracker is not None else self.batch_size
+        for _ in range(batch_size):
             item = self.get_item()
             if item == "EOF":
                 exhausted = True
@@ -274,6 +330,30 @@ class Detector():
         logger.trace("Returning batch size: %s", len(batch))
         return (exhausted, batch)
 
+    def pass_cached_item(self, item):
+        """ Output an item whose faces came from the detection cache, so that
+            the tracker can track from it. Returns True if the item has been
+            output, otherwise False """
+        if not isinstance(item, dict) or "detected_faces" not in item:
+            return False
+        logger.trace("Passing cached detection: '%s'", item["filename"])
+        self.finalize(item)
+        return True
+
+    def track_item(self, item):
+        """ Track the faces from the previous frame into the item's frame.
+            Returns True if the item was tracked and has been output,
+            otherwise False if it needs detecting """
+        if self.tracker is None or not isinstance(item, dict):
+            return False
+        detected_faces = self.tracker.track(item["image"], item.get("frame_index", None))
+        if detected_faces is None:
+            return False
+        item["detected_faces"] = detected_faces
+        item["tracked"] = True
+        self.finalize(item)
+        return True
+
     # <<< DLIB RECTANGLE METHODS >>> #
     @staticmethod
     def is_mmod_rectangle(d_rectangle):
@@ -290,11 +370,14 @@ class Detector():
         return d_rect
 
     # <<< MISC METHODS >>> #
-    @staticmethod
-    def get_vram_free():
-        """ Return total free VRAM on largest card """
+    def get_vram_free(self):
+        """ Return total free VRAM on the pinned card, or the largest card
+            if not pinned """
         stats = GPUStats()
-        vram = stats.get_card_most_free()
+        if self.device is None:
+            vram = stats.get_card_most_free()
+        else:
+            vram = stats.get_card(self.device)
         logger.verbose("Using device %s with %sMB free of %sMB",
                        vram["device"],
                        int(vram["free"]),
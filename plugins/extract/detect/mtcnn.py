@@ -10,7 +10,6 @@ from six import string_types, iteritems
 import cv2
 import numpy as np
 
-from lib.multithreading import MultiThread
 from ._base import Detector, dlib, logger
 
 
@@ -109,7 +108,7 @@ class Detect(Detector):
             raise ValueError("Insufficient VRAM available to continue "
                              "({}MB)".format(int(alloc)))
 
-        logger.verbose("Processing in %s threads", self.batch_size)
+        logger.verbose("Processing in batches of %s", self.batch_size)
 
         self.kwargs["pnet"] = pnet
         self.kwargs["rnet"] = rnet
@@ -119,43 +118,64 @@ class Detect(Detector):
         logger.info("Initialized MTCNN Detector.")
 
     def detect_faces(self, *args, **kwargs):
-        """ Detect faces in Multiple Threads """
+        """ Detect faces in batches of frames """
         super().detect_faces(*args, **kwargs)
-        workers = MultiThread(target=self.detect_thread, thread_count=self.batch_size)
-        workers.start()
-        workers.join()
-        sentinel = self.queues["in"].get()
-        self.queues["out"].put(sentinel)
-        logger.debug("Detecting Faces complete")
-
-    def detect_thread(self):
-        """ Detect faces in rgb image """
-        logger.debug("Launching Detect")
         while True:
-            item = self.get_item()
-            if item == "EOF":
+            exhausted, batch = self.get_batch()
+            if batch:
+                self.detect_batch(batch)
+            if exhausted:
                 break
-            logger.trace("Detecting faces: '%s'", item["filename"])
-            detect_image = self.compile_detection_image(item["image"], False, False)
-
-            for angle in self.rotation:
-                current_image, rotmat = self.rotate_image(detect_image, angle)
-                faces, points = detect_face(current_image, **self.kwargs)
-                if angle != 0 and faces.any():
-                    logger.verbose("found face(s) by rotating image %s degrees", angle)
-                if faces.any():
-                    break
+        self.queues["out"].put("EOF")
+        logger.debug("Detecting Faces complete")
 
-            detected_faces = self.process_output(faces, points, rotmat)
+    def detect_batch(self, batch):
+        """ Detect faces in a batch of frames. Frames which are the same size
+            are passed through the networks together """
+        logger.trace("Detecting faces: %s", [item["filename"] for item in batch])
+        detect_images = list()
+        scales = list()
+        for item in batch:
+            detect_images.append(self.compile_detection_image(item["image"], False, False))
+            scales.append(self.scale)
+
+        groups = dict()
+        for idx, image in enumerate(detect_images):
+            groups.setdefault(image.shape, list()).append(idx)
+        logger.trace("Batch groups: %s", {key: len(val) for key, val in groups.items()})
+
+        detected = [list() for _ in batch]
+        for indices in groups.values():
+            self.detect_group(detect_images, indices, scales, detected)
+
+        for item, detected_faces in zip(batch, detected):
             item["detected_faces"] = detected_faces
             self.finalize(item)
 
-        logger.debug("Thread Completed Detect")
+    def detect_group(self, detect_images, indices, scales, detected):
+        """ Detect faces in a group of equally sized frames, rotating the
+            frames that have no faces found through each rotation angle """
+        remaining = indices
+        for angle in self.rotation:
+            if not remaining:
+                break
+            rotated = [self.rotate_image(detect_images[idx], angle) for idx in remaining]
+            results = detect_face_batch(np.stack([image for image, _ in rotated]),
+                                        **self.kwargs)
+            not_found = list()
+            for idx, (_, rotmat), (faces, points) in zip(remaining, rotated, results):
+                if not faces.any():
+                    not_found.append(idx)
+                    continue
+                if angle != 0:
+                    logger.verbose("found face(s) by rotating image %s degrees", angle)
+                detected[idx] = self.process_output(faces, points, rotmat, scales[idx])
+            remaining = not_found
 
-    def process_output(self, faces, points, rotation_matrix):
+    def process_output(self, faces, points, rotation_matrix, scale):
         """ Compile found faces for output """
-        logger.trace("Processing Output: (faces: %s, points: %s, rotation_matrix: %s)",
-                     faces, points, rotation_matrix)
+        logger.trace("Processing Output: (faces: %s, points: %s, rotation_matrix: %s, "
+                     "scale: %s)", faces, points, rotation_matrix, scale)
         faces = self.recalculate_bounding_box(faces, points)
         faces = [dlib.rectangle(  # pylint: disable=c-extension-no-member
             int(face[0]), int(face[1]), int(face[2]), int(face[3]))
@@ -164,10 +184,10 @@ class Detect(Detector):
             faces = [self.rotate_rect(face, rotation_matrix)
                      for face in faces]
         detected = [dlib.rectangle(  # pylint: disable=c-extension-no-member
-            int(face.left() / self.scale),
-            int(face.top() / self.scale),
-            int(face.right() / self.scale),
-            int(face.bottom() / self.scale))
+            int(face.left() / scale),
+            int(face.top() / scale),
+            int(face.right() / scale),
+            int(face.bottom() / scale))
                     for face in faces]
         logger.trace("Processed Output: %s", detected)
         return detected
@@ -539,17 +559,32 @@ def detect_face(img, minsize, pnet, rnet,  # pylint: disable=too-many-arguments
     factor: the factor used to create a scaling pyramid of face sizes to
             detect in the image.
     """
-    # pylint: disable=too-many-locals,too-many-statements,too-many-branches
-    factor_count = 0
-    total_boxes = np.empty((0, 9))
-    points = np.empty(0)
-    height = img.shape[0]
-    width = img.shape[1]
+    return detect_face_batch(np.expand_dims(img, 0), minsize, pnet, rnet,
+                             onet, threshold, factor)[0]
+
+
+def detect_face_batch(images, minsize, pnet, rnet,  # pylint: disable=too-many-arguments
+                      onet, threshold, factor):
+    """Detects faces in a batch of equally sized images, and returns a list of
+    bounding boxes and points for each image.
+    images: input images stacked in an array of shape (N, height, width, 3)
+    minsize: minimum faces' size
+    pnet, rnet, onet: caffemodel
+    threshold: threshold=[th1, th2, th3], th1-3 are three steps's threshold
+    factor: the factor used to create a scaling pyramid of face sizes to
+            detect in the image.
+
+    Each pyramid scale is passed through pnet for all images at once and the
+    rnet and onet candidates from all images are batched together.
+    """
+    # pylint: disable=too-many-locals
+    num_images, height, width = images.shape[:3]
     minl = np.amin([height, width])
     var_m = 12.0 / minsize
     minl = minl * var_m
     # create scale pyramid
     scales = []
+    factor_count = 0
     while minl >= 12:
         scales += [var_m * np.power(factor, factor_count)]
         minl = minl * factor
@@ -558,30 +593,116 @@ def detect_face(img, minsize, pnet, rnet,  # pylint: disable=too-many-arguments
     # # # # # # # # # # # # #
     # first stage - fast proposal network (pnet) to obtain face candidates
     # # # # # # # # # # # # #
-    for scale in scales:
+    candidates = [list() for _ in range(num_images)]
+    for scale_id, scale in enumerate(scales):
         height_scale = int(np.ceil(height * scale))
         width_scale = int(np.ceil(width * scale))
-        im_data = imresample(img, (height_scale, width_scale))
+        im_data = np.stack([imresample(img, (height_scale, width_scale)) for img in images])
         im_data = (im_data - 127.5) * 0.0078125
-        img_x = np.expand_dims(im_data, 0)
-        img_y = np.transpose(img_x, (0, 2, 1, 3))
+        img_y = np.transpose(im_data, (0, 2, 1, 3))
         out = pnet(img_y)
         out0 = np.transpose(out[0], (0, 2, 1, 3))
         out1 = np.transpose(out[1], (0, 2, 1, 3))
+        for idx in range(num_images):
+            boxes, _ = generate_bounding_box(out1[idx, :, :, 1].copy(),
+                                             out0[idx, :, :, :].copy(),
+                                             scale, threshold[0])
+            if boxes.size > 0:
+                candidates[idx].append((boxes, np.full(boxes.shape[0], scale_id)))
 
-        boxes, _ = generate_bounding_box(out1[0, :, :, 1].copy(),
-                                         out0[0, :, :, :].copy(),
-                                         scale, threshold[0])
+    all_boxes = [pnet_candidates(candidate) for candidate in candidates]
+
+    # # # # # # # # # # # # #
+    # second stage - refinement of face candidates with rnet
+    # # # # # # # # # # # # #
+    crops, valid = crop_candidates(images, all_boxes, 24)
+    if crops.shape[0] > 0:
+        out = rnet(crops)
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+        offset = 0
+        for idx, total_boxes in enumerate(all_boxes):
+            if not valid[idx]:
+                all_boxes[idx] = np.empty((0, 5))
+                continue
+            numbox = total_boxes.shape[0]
+            if numbox == 0:
+                continue
+            m_v = out0[:, offset:offset + numbox]
+            score = out1[1, offset:offset + numbox]
+            offset += numbox
+            ipass = np.where(score > threshold[1])
+            total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(),
+                                     np.expand_dims(score[ipass].copy(), 1)])
+            m_v = m_v[:, ipass[0]]
+            if total_boxes.shape[0] > 0:
+                pick = nms(total_boxes, 0.7, 'Union')
+                total_boxes = total_boxes[pick, :]
+                total_boxes = bbreg(total_boxes, np.transpose(m_v[:, pick]))
+                total_boxes = rerec(total_boxes)
+            all_boxes[idx] = total_boxes
 
-        # inter-scale nms
-        pick = nms(boxes.copy(), 0.5, 'Union')
-        if boxes.size > 0 and pick.size > 0:
-            boxes = boxes[pick, :]
-            total_boxes = np.append(total_boxes, boxes, axis=0)
+    # # # # # # # # # # # # #
+    # third stage - further refinement and facial landmarks positions with onet
+    # # # # # # # # # # # # #
+    all_points = [np.empty(0) for _ in range(num_images)]
+    all_boxes = [np.fix(total_boxes).astype(np.int32) if total_boxes.shape[0] > 0
+                 else total_boxes for total_boxes in all_boxes]
+    crops, valid = crop_candidates(images, all_boxes, 48)
+    if crops.shape[0] > 0:
+        out = onet(crops)
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+        out2 = np.transpose(out[2])
+        offset = 0
+        for idx, total_boxes in enumerate(all_boxes):
+            if not valid[idx]:
+                all_boxes[idx] = np.empty((0, 5))
+                continue
+            numbox = total_boxes.shape[0]
+            if numbox == 0:
+                continue
+            m_v = out0[:, offset:offset + numbox]
+            points = out1[:, offset:offset + numbox]
+            score = out2[1, offset:offset + numbox]
+            offset += numbox
+            ipass = np.where(score > threshold[2])
+            points = points[:, ipass[0]]
+            total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(),
+                                     np.expand_dims(score[ipass].copy(), 1)])
+            m_v = m_v[:, ipass[0]]
+
+            box_width = total_boxes[:, 2] - total_boxes[:, 0] + 1
+            box_height = total_boxes[:, 3] - total_boxes[:, 1] + 1
+            points[0:5, :] = (np.tile(box_width, (5, 1)) * points[0:5, :] +
+                              np.tile(total_boxes[:, 0], (5, 1)) - 1)
+            points[5:10, :] = (np.tile(box_height, (5, 1)) * points[5:10, :] +
+                               np.tile(total_boxes[:, 1], (5, 1)) - 1)
+            if total_boxes.shape[0] > 0:
+                total_boxes = bbreg(total_boxes, np.transpose(m_v))
+                pick = nms(total_boxes, 0.7, 'Min')
+                total_boxes = total_boxes[pick, :]
+                points = points[:, pick]
+            all_boxes[idx] = total_boxes
+            all_points[idx] = points
+
+    return list(zip(all_boxes, all_points))
+
+
+def pnet_candidates(candidates):
+    """ Suppress and calibrate the pnet candidates from all scales for one
+        image """
+    if not candidates:
+        return np.empty((0, 9))
+    total_boxes = np.concatenate([boxes for boxes, _ in candidates])
+    # inter-scale nms for all scales at once
+    pick = nms(total_boxes, 0.5, 'Union',
+               groups=np.concatenate([scale_ids for _, scale_ids in candidates]))
+    total_boxes = total_boxes[pick, :]
 
     numbox = total_boxes.shape[0]
     if numbox > 0:
-        pick = nms(total_boxes.copy(), 0.7, 'Union')
+        pick = nms(total_boxes, 0.7, 'Union')
         total_boxes = total_boxes[pick, :]
         regw = total_boxes[:, 2]-total_boxes[:, 0]
         regh = total_boxes[:, 3]-total_boxes[:, 1]
@@ -590,91 +711,43 @@ def detect_face(img, minsize, pnet, rnet,  # pylint: disable=too-many-arguments
         qq_3 = total_boxes[:, 2]+total_boxes[:, 7] * regw
         qq_4 = total_boxes[:, 3]+total_boxes[:, 8] * regh
         total_boxes = np.transpose(np.vstack([qq_1, qq_2, qq_3, qq_4, total_boxes[:, 4]]))
-        total_boxes = rerec(total_boxes.copy())
+        total_boxes = rerec(total_boxes)
         total_boxes[:, 0:4] = np.fix(total_boxes[:, 0:4]).astype(np.int32)
-        d_y, ed_y, d_x, ed_x, var_y, e_y, var_x, e_x, tmpw, tmph = pad(total_boxes.copy(),
-                                                                       width, height)
-
-    numbox = total_boxes.shape[0]
-
-    # # # # # # # # # # # # #
-    # second stage - refinement of face candidates with rnet
-    # # # # # # # # # # # # #
-
-    if numbox > 0:
-        tempimg = np.zeros((24, 24, 3, numbox))
-        for k in range(0, numbox):
-            tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-            tmp[d_y[k] - 1:ed_y[k], d_x[k] - 1:ed_x[k], :] = img[var_y[k] - 1:e_y[k],
-                                                                 var_x[k]-1:e_x[k], :]
-            if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                tempimg[:, :, :, k] = imresample(tmp, (24, 24))
-            else:
-                return np.empty()
-        tempimg = (tempimg-127.5)*0.0078125
-        tempimg1 = np.transpose(tempimg, (3, 1, 0, 2))
-        out = rnet(tempimg1)
-        out0 = np.transpose(out[0])
-        out1 = np.transpose(out[1])
-        score = out1[1, :]
-        ipass = np.where(score > threshold[1])
-        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(),
-                                 np.expand_dims(score[ipass].copy(), 1)])
-        m_v = out0[:, ipass[0]]
-        if total_boxes.shape[0] > 0:
-            pick = nms(total_boxes, 0.7, 'Union')
-            total_boxes = total_boxes[pick, :]
-            total_boxes = bbreg(total_boxes.copy(), np.transpose(m_v[:, pick]))
-            total_boxes = rerec(total_boxes.copy())
-
-    numbox = total_boxes.shape[0]
-
-    # # # # # # # # # # # # #
-    # third stage - further refinement and facial landmarks positions with onet
-    # NB: Facial landmarks code commented out for faceswap
-    # # # # # # # # # # # # #
-
-    if numbox > 0:
-        # third stage
-        total_boxes = np.fix(total_boxes).astype(np.int32)
-        d_y, ed_y, d_x, ed_x, var_y, e_y, var_x, e_x, tmpw, tmph = pad(total_boxes.copy(),
+    return total_boxes
+
+
+def crop_candidates(images, all_boxes, size):
+    """ Crop, resize and normalize the candidate boxes for every image into
+        one batch for rnet/onet.
+
+        Returns the batch and whether each image's crops were valid. Images
+        with an invalid crop are given no candidates """
+    height, width = images.shape[1:3]
+    crops = list()
+    valid = list()
+    for img, total_boxes in zip(images, all_boxes):
+        numbox = total_boxes.shape[0]
+        if numbox == 0:
+            valid.append(True)
+            continue
+        d_y, ed_y, d_x, ed_x, var_y, e_y, var_x, e_x, tmpw, tmph = pad(total_boxes,
                                                                        width, height)
-        tempimg = np.zeros((48, 48, 3, numbox))
+        img_crops = list()
         for k in range(0, numbox):
             tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
             tmp[d_y[k] - 1:ed_y[k], d_x[k] - 1:ed_x[k], :] = img[var_y[k] - 1:e_y[k],
                                                                  var_x[k] - 1:e_x[k], :]
             if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                tempimg[:, :, :, k] = imresample(tmp, (48, 48))
+                img_crops.append(imresample(tmp, (size, size)))
             else:
-                return np.empty()
-        tempimg = (tempimg-127.5)*0.0078125
-        tempimg1 = np.transpose(tempimg, (3, 1, 0, 2))
-        out = onet(tempimg1)
-        out0 = np.transpose(out[0])
-        out1 = np.transpose(out[1])
-        out2 = np.transpose(out[2])
-        score = out2[1, :]
-        points = out1
-        ipass = np.where(score > threshold[2])
-        points = points[:, ipass[0]]
-        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(),
-                                 np.expand_dims(score[ipass].copy(), 1)])
-        m_v = out0[:, ipass[0]]
-
-        width = total_boxes[:, 2] - total_boxes[:, 0] + 1
-        height = total_boxes[:, 3] - total_boxes[:, 1] + 1
-        points[0:5, :] = (np.tile(width, (5, 1)) * points[0:5, :] +
-                          np.tile(total_boxes[:, 0], (5, 1)) - 1)
-        points[5:10, :] = (np.tile(height, (5, 1)) * points[5:10, :] +
-                           np.tile(total_boxes[:, 1], (5, 1)) - 1)
-        if total_boxes.shape[0] > 0:
-            total_boxes = bbreg(total_boxes.copy(), np.transpose(m_v))
-            pick = nms(total_boxes.copy(), 0.7, 'Min')
-            total_boxes = total_boxes[pick, :]
-            points = points[:, pick]
-
-    return total_boxes, points
+                break
+        valid.append(len(img_crops) == numbox)
+        if valid[-1]:
+            crops.extend(img_crops)
+    if not crops:
+        return np.empty((0, size, size, 3)), valid
+    crops = (np.stack(crops) - 127.5) * 0.0078125
+    return np.transpose(crops, (0, 2, 1, 3)), valid
 
 
 # function [boundingbox] = bbreg(boundingbox,reg)
@@ -685,11 +758,7 @@ def bbreg(boundingbox, reg):
 
     width = boundingbox[:, 2] - boundingbox[:, 0] + 1
     height = boundingbox[:, 3] - boundingbox[:, 1] + 1
-    b_1 = boundingbox[:, 0] + reg[:, 0] * width
-    b_2 = boundingbox[:, 1] + reg[:, 1] * height
-    b_3 = boundingbox[:, 2] + reg[:, 2] * width
-    b_4 = boundingbox[:, 3] + reg[:, 3] * height
-    boundingbox[:, 0:4] = np.transpose(np.vstack([b_1, b_2, b_3, b_4]))
+    boundingbox[:, 0:4] += reg[:, 0:4] * np.stack((width, height, width, height), axis=1)
     return boundingbox
 
 
@@ -723,38 +792,62 @@ def generate_bounding_box(imap, reg, scale, threshold):
 
 
 # function pick = nms(boxes,threshold,type)
-def nms(boxes, threshold, method):
-    """ Non_Max Suppression """
+def nms(boxes, threshold, method, groups=None, chunk_size=None):
+    """ Non_Max Suppression
+
+        Greedy suppression in descending score order. The overlaps are
+        calculated for blocks of boxes at a time against the boxes that have
+        not yet been suppressed, with the block size chosen so that the
+        overlap matrix holds at most chunk_size items.
+
+        groups: Optional group id for each box (eg. the pyramid scale that
+        the box came from). Boxes only suppress boxes within their own group
+        and picks are returned ordered by group then score, so one call
+        gives the same result as a call per group """
     # pylint: disable=too-many-locals
     if boxes.size == 0:
         return np.empty((0, 3))
-    x_1 = boxes[:, 0]
-    y_1 = boxes[:, 1]
-    x_2 = boxes[:, 2]
-    y_2 = boxes[:, 3]
-    var_s = boxes[:, 4]
+    if groups is None:
+        s_sort = np.argsort(boxes[:, 4])[::-1]
+        bounds = np.array([0, s_sort.size])
+    else:
+        group_ids, counts = np.unique(groups, return_counts=True)
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        s_sort = np.concatenate([
+            np.flatnonzero(groups == group)[np.argsort(boxes[groups == group, 4])[::-1]]
+            for group in group_ids])
+    group_end = np.repeat(bounds[1:], np.diff(bounds))
+    x_1, y_1, x_2, y_2 = (boxes[s_sort, idx] for idx in range(4))
     area = (x_2 - x_1 + 1) * (y_2 - y_1 + 1)
-    s_sort = np.argsort(var_s)
-    pick = np.zeros_like(var_s, dtype=np.int16)
-    counter = 0
-    while s_sort.size > 0:
-        i = s_sort[-1]
-        pick[counter] = i
-        counter += 1
-        idx = s_sort[0:-1]
-        xx_1 = np.maximum(x_1[i], x_1[idx])
-        yy_1 = np.maximum(y_1[i], y_1[idx])
-        xx_2 = np.minimum(x_2[i], x_2[idx])
-        yy_2 = np.minimum(y_2[i], y_2[idx])
-        width = np.maximum(0.0, xx_2-xx_1+1)
-        height = np.maximum(0.0, yy_2-yy_1+1)
+
+    numbox = s_sort.size
+    chunk_size = 2 ** 20 if chunk_size is None else chunk_size
+    block = max(1, min(chunk_size // numbox, 32))
+    suppressed = np.zeros(numbox, dtype="bool")
+    pick = list()
+    for start in range(0, numbox, block):
+        rows = start + np.flatnonzero(~suppressed[start:start + block])
+        if rows.size == 0:
+            continue
+        # Only boxes that are still in play need their overlaps calculating
+        cols = start + np.flatnonzero(~suppressed[start:group_end[rows[-1]]])
+        width = np.maximum(0.0, (np.minimum(x_2[rows, None], x_2[None, cols])
+                                 - np.maximum(x_1[rows, None], x_1[None, cols]) + 1))
+        height = np.maximum(0.0, (np.minimum(y_2[rows, None], y_2[None, cols])
+                                  - np.maximum(y_1[rows, None], y_1[None, cols]) + 1))
         inter = width * height
         if method == 'Min':
-            var_o = inter / np.minimum(area[i], area[idx])
+            var_o = inter / np.minimum(area[rows, None], area[None, cols])
         else:
-            var_o = inter / (area[i] + area[idx] - inter)
-        s_sort = s_sort[np.where(var_o <= threshold)]
-    pick = pick[0:counter]
+            var_o = inter / (area[rows, None] + area[None, cols] - inter)
+        overlapped = ~(var_o <= threshold)
+        for row_idx, row in enumerate(rows):
+            if suppressed[row]:
+                continue
+            pick.append(row)
+            hits = cols[overlapped[row_idx]]
+            suppressed[hits[(hits > row) & (hits < group_end[row])]] = True
+    pick = s_sort[np.array(pick, dtype="int64")]
     return pick
 
 
@@ -763,33 +856,20 @@ def pad(total_boxes, width, height):
     """Compute the padding coordinates (pad the bounding boxes to square)"""
     tmp_width = (total_boxes[:, 2] - total_boxes[:, 0] + 1).astype(np.int32)
     tmp_height = (total_boxes[:, 3] - total_boxes[:, 1] + 1).astype(np.int32)
-    numbox = total_boxes.shape[0]
-
-    d_x = np.ones((numbox), dtype=np.int32)
-    d_y = np.ones((numbox), dtype=np.int32)
-    ed_x = tmp_width.copy().astype(np.int32)
-    ed_y = tmp_height.copy().astype(np.int32)
-
-    dim_x = total_boxes[:, 0].copy().astype(np.int32)
-    dim_y = total_boxes[:, 1].copy().astype(np.int32)
-    e_x = total_boxes[:, 2].copy().astype(np.int32)
-    e_y = total_boxes[:, 3].copy().astype(np.int32)
-
-    tmp = np.where(e_x > width)
-    ed_x.flat[tmp] = np.expand_dims(-e_x[tmp] + width + tmp_width[tmp], 1)
-    e_x[tmp] = width
-
-    tmp = np.where(e_y > height)
-    ed_y.flat[tmp] = np.expand_dims(-e_y[tmp] + height + tmp_height[tmp], 1)
-    e_y[tmp] = height
-
-    tmp = np.where(dim_x < 1)
-    d_x.flat[tmp] = np.expand_dims(2 - dim_x[tmp], 1)
-    dim_x[tmp] = 1
 
-    tmp = np.where(dim_y < 1)
-    d_y.flat[tmp] = np.expand_dims(2 - dim_y[tmp], 1)
-    dim_y[tmp] = 1
+    dim_x = total_boxes[:, 0].astype(np.int32)
+    dim_y = total_boxes[:, 1].astype(np.int32)
+    e_x = total_boxes[:, 2].astype(np.int32)
+    e_y = total_boxes[:, 3].astype(np.int32)
+
+    ed_x = np.where(e_x > width, width - e_x + tmp_width, tmp_width)
+    ed_y = np.where(e_y > height, height - e_y + tmp_height, tmp_height)
+    d_x = np.where(dim_x < 1, 2 - dim_x, 1).astype(np.int32)
+    d_y = np.where(dim_y < 1, 2 - dim_y, 1).astype(np.int32)
+    np.minimum(e_x, width, out=e_x)
+    np.minimum(e_y, height, out=e_y)
+    np.maximum(dim_x, 1, out=dim_x)
+    np.maximum(dim_y, 1, out=dim_y)
 
     return d_y, ed_y, d_x, ed_x, dim_y, e_y, dim_x, e_x, tmp_width, tmp_height
 
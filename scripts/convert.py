@@ -2,39 +2,55 @@
 """ The script to run the convert process of faceswap """
 
 import logging
+import multiprocessing as mp
 import re
 import os
 import sys
-from pathlib import Path
+from multiprocessing.pool import ThreadPool
 
-import cv2
 from tqdm import tqdm
 
-from scripts.fsmedia import Alignments, Images, PostProcess, Utils
+from scripts.fsmedia import Alignments, Images, Output, PostProcess, Utils
 from lib.faces_detect import DetectedFace
-from lib.multithreading import BackgroundGenerator, SpawnProcess
+from lib.face_hashes import FaceHashes
+from lib.logger import LOG_QUEUE, set_root_logger
+from lib.multithreading import BackgroundGenerator, SpawnProcess, pool_imap
 from lib.queue_manager import queue_manager
-from lib.utils import get_folder, get_image_paths, hash_image_file
+from lib.utils import get_folder, get_image_dimensions, get_image_paths
 
 from plugins.plugin_loader import PluginLoader
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+_patch_converter = None  # pylint: disable=invalid-name
 
 
 class Convert():
-    """ The convert process. """
+    """ The convert process.
+
+        Runs as a pipeline of stages joined by bounded queues:
+            - Frames are loaded by a pool of threads
+            - Faces are swapped in batches by the model in this process
+            - Swapped faces are patched onto their frames, and image output
+              is encoded, by a pool of processes
+            - Frames are saved in order by a background writer """
+    # Number of threads for loading frames
+    loaders = 4
+
     def __init__(self, arguments):
         logger.debug("Initializing %s: (args: %s)", self.__class__.__name__, arguments)
         self.args = arguments
-        self.output_dir = get_folder(self.args.output_dir)
         self.extract_faces = False
         self.faces_count = 0
 
         self.images = Images(self.args)
+        self.output = Output(self.args, fps=self.images.fps)
         self.alignments = Alignments(self.args, False)
 
         # Update Legacy alignments
-        Legacy(self.alignments, self.images.input_images, arguments.input_aligned_dir)
+        Legacy(self.alignments,
+               self.images.input_images,
+               arguments.input_aligned_dir,
+               frame_dims=self.images.video_dims)
 
         self.post_process = PostProcess(arguments)
         self.verify_output = False
@@ -56,9 +72,21 @@ class Convert():
         converter = self.load_converter(model)
 
         batch = BackgroundGenerator(self.prepare_images(), 1)
-
-        for item in batch.iterator():
-            self.convert(converter, item)
+        processes = max(mp.cpu_count() - 1, 1)
+        logger.verbose("Patching frames in %s processes", processes)
+
+        self.output.start_writer(maxsize=processes * 2)
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(processes=processes,
+                      initializer=init_patcher,
+                      initargs=(self.args.loglevel,
+                                LOG_QUEUE,
+                                self.args.converter,
+                                self.get_converter_args())) as pool:
+            converted = self.convert(converter, self.batch_frames(batch.iterator()))
+            for filename, image in pool_imap(pool, patch_frame, converted, processes * 2):
+                self.output.queue_save(filename, image)
+        self.output.close()
 
         if self.extract_faces:
             queue_manager.terminate_queues()
@@ -116,46 +144,84 @@ class Convert():
 
         return model
 
-    def load_converter(self, model):
-        """ Load the requested converter for conversion """
+    def get_converter_args(self):
+        """ Return the kwargs to load the requested converter with """
         args = self.args
-        conv = args.converter
+        return dict(trainer=args.trainer,
+                    blur_size=args.blur_size,
+                    seamless_clone=args.seamless_clone,
+                    sharpen_image=args.sharpen_image,
+                    mask_type=args.mask_type,
+                    erosion_kernel_size=args.erosion_kernel_size,
+                    match_histogram=args.match_histogram,
+                    smooth_mask=args.smooth_mask,
+                    avg_color_adjust=args.avg_color_adjust,
+                    draw_transparent=args.draw_transparent)
 
-        converter = PluginLoader.get_converter(conv)(
+    def load_converter(self, model):
+        """ Load the requested converter for conversion """
+        converter = PluginLoader.get_converter(self.args.converter)(
             model.converter(False),
-            trainer=args.trainer,
-            blur_size=args.blur_size,
-            seamless_clone=args.seamless_clone,
-            sharpen_image=args.sharpen_image,
-            mask_type=args.mask_type,
-            erosion_kernel_size=args.erosion_kernel_size,
-            match_histogram=args.match_histogram,
-            smooth_mask=args.smooth_mask,
-            avg_color_adjust=args.avg_color_adjust,
-            draw_transparent=args.draw_transparent)
+            **self.get_converter_args())
 
         return converter
 
-    def prepare_images(self):
-        """ Prepare the images for conversion """
-        filename = ""
+    def get_frames(self):
+        """ Yield the filename of each frame to be output, with whether it
+            is outside of the frame ranges. Frames outside of the frame ranges
+            are not yielded if they are to be discarded """
         for filename in tqdm(self.images.input_images,
                              total=self.images.images_found,
                              file=sys.stdout):
 
-            if (self.args.discard_frames and
-                    self.opts.check_skipframe(filename) == "discard"):
+            skip = self.opts.check_skipframe(filename)
+            if self.args.discard_frames and skip == "discard":
                 continue
+            if not skip and not self.extract_faces:
+                if not self.check_alignments(os.path.basename(filename)):
+                    continue
+            yield filename, skip
+
+    def load_frame(self, item):
+        """ Load a frame for the loader pool. Frames outside of the frame
+            ranges that are going from a folder to a folder are copied as is,
+            so they are read as the file's bytes rather than decoded """
+        filename, skip = item
+        if skip and not self.images.is_video and not self.output.is_video:
+            with open(filename, "rb") as in_file:
+                return filename, skip, in_file.read()
+        return filename, skip, self.images.load_one_image(filename)
+
+    def load_frames(self):
+        """ Yield each frame to be converted, in order. Images are loaded in a
+            pool of threads. Video frames are decoded sequentially """
+        frames = self.get_frames()
+        if self.images.is_video:
+            try:
+                for item in frames:
+                    yield self.load_frame(item)
+            finally:
+                self.images.close_video()
+            return
+        pool = ThreadPool(processes=self.loaders)
+        try:
+            for item in pool_imap(pool, self.load_frame, frames, self.loaders * 2):
+                yield item
+        finally:
+            pool.terminate()
 
+    def prepare_images(self):
+        """ Prepare the images for conversion """
+        for filename, skip, image in self.load_frames():
             frame = os.path.basename(filename)
-            if self.extract_faces:
-                convert_item = self.detect_faces(filename)
+            if skip:
+                # Frames outside of the frame ranges are written out unchanged, so their
+                # faces are not needed
+                detected_faces = list()
+            elif self.extract_faces:
+                detected_faces = self.detect_faces(filename, image)
             else:
-                convert_item = self.alignments_faces(filename, frame)
-
-            if not convert_item:
-                continue
-            image, detected_faces = convert_item
+                detected_faces = self.alignments_faces(frame, image)
 
             faces_count = len(detected_faces)
             if faces_count != 0:
@@ -171,28 +237,24 @@ class Convert():
 
             yield filename, image, detected_faces
 
-    def detect_faces(self, filename):
+    @staticmethod
+    def detect_faces(filename, image):
         """ Extract the face from a frame (If not alignments file found) """
-        image = self.images.load_one_image(filename)
         queue_manager.get_queue("load").put((filename, image))
         item = queue_manager.get_queue("align").get()
         detected_faces = item["detected_faces"]
-        return image, detected_faces
+        return detected_faces
 
-    def alignments_faces(self, filename, frame):
+    def alignments_faces(self, frame, image):
         """ Get the face from alignments file """
-        if not self.check_alignments(frame):
-            return None
-
         faces = self.alignments.get_faces_in_frame(frame)
-        image = self.images.load_one_image(filename)
         detected_faces = list()
 
         for rawface in faces:
             face = DetectedFace()
             face.from_alignment(rawface, image=image)
             detected_faces.append(face)
-        return image, detected_faces
+        return detected_faces
 
     def check_alignments(self, frame):
         """ If we have no alignments for this image, skip it """
@@ -202,32 +264,89 @@ class Convert():
                        "skipping".format(frame))
         return have_alignments
 
-    def convert(self, converter, item):
-        """ Apply the conversion transferring faces onto frames """
-        try:
-            filename, image, faces = item
-            skip = self.opts.check_skipframe(filename)
-
-            if not skip:
-                for face in faces:
-                    image = self.convert_one_face(converter, image, face)
-                filename = str(self.output_dir / Path(filename).name)
-                cv2.imwrite(filename, image)  # pylint: disable=no-member
-        except Exception as err:
-            logger.error("Failed to convert image: '%s'. Reason: %s", filename, err)
-            raise
-
-    def convert_one_face(self, converter, image, face):
-        """ Perform the conversion on the given frame for a single face """
+    def batch_frames(self, items):
+        """ Group consecutive frames so that their faces can be swapped in
+            batched model predictions. A group is cut once it holds batch size
+            faces or frames, which bounds the frames held in memory """
+        batch = list()
+        faces_count = 0
+        for item in items:
+            batch.append(item)
+            faces_count += len(item[2])
+            if faces_count >= self.args.batch_size or len(batch) >= self.args.batch_size:
+                logger.trace("Frame batch: (frames: %s, faces: %s)", len(batch), faces_count)
+                yield batch
+                batch = list()
+                faces_count = 0
+        if batch:
+            logger.trace("Frame batch: (frames: %s, faces: %s)", len(batch), faces_count)
+            yield batch
+
+    def convert(self, converter, batches):
+        """ Swap the faces for each batch of frames.
+
+            The faces of every frame in the batch are aligned first and then
+            swapped together by the model. Yields the items for the patch pool
+            to transfer the faces onto each frame """
         # TODO: This switch between 64 and 128 is a hack for now.
         # We should have a separate cli option for size
         size = 128 if (self.args.trainer.strip().lower()
                        in ('gan128', 'originalhighres')) else 64
-
-        image = converter.patch_image(image,
-                                      face,
-                                      size)
-        return image
+        filename = ""
+        for items in batches:
+            try:
+                frames = list()
+                for filename, image, faces in items:
+                    prepared = [converter.prepare_face(image, face, size) for face in faces]
+                    frames.append((filename, image, prepared))
+
+                predictions = self.predict(converter,
+                                           [face.pop("feed")
+                                            for _, _, prepared in frames
+                                            for face in prepared])
+            except Exception as err:
+                logger.error("Failed to convert image: '%s'. Reason: %s", filename, err)
+                raise
+
+            for filename, image, prepared in frames:
+                yield {"filename": filename,
+                       "image": image,
+                       "faces": [(face, next(predictions)) for face in prepared],
+                       "encode": not self.output.is_video and not isinstance(image, bytes)}
+
+    def predict(self, converter, feeds):
+        """ Yield the model output for each face, predicting in batches of at
+            most batch size faces """
+        batch_size = self.args.batch_size
+        for start in range(0, len(feeds), batch_size):
+            logger.trace("Predicting faces: %s", len(feeds[start:start + batch_size]))
+            for prediction in converter.predict(feeds[start:start + batch_size]):
+                yield prediction
+
+
+def init_patcher(loglevel, log_queue, converter, converter_args):
+    """ Load the converter, without a model, into a patch pool process """
+    global _patch_converter  # pylint: disable=global-statement,invalid-name
+    set_root_logger(loglevel, log_queue)
+    logger.debug("Initializing patcher: (converter: '%s')", converter)
+    _patch_converter = PluginLoader.get_converter(converter)(None, **converter_args)
+
+
+def patch_frame(item):
+    """ Patch the swapped faces onto a frame in a patch pool process. Returns
+        the filename and output frame, encoded if it is for an output folder """
+    filename = item["filename"]
+    image = item["image"]
+    try:
+        if item["faces"]:
+            image = _patch_converter.apply_faces(image, item["faces"])
+        if item["encode"]:
+            image = Output.encode(filename, image)
+    except Exception as err:
+        logger.error("Failed to convert image: '%s'. Reason: %s", filename, err)
+        raise
+    logger.trace("Patched frame: '%s'", filename)
+    return filename, image
 
 
 class OptionalActions():
@@ -272,8 +391,7 @@ class OptionalActions():
         else:
             file_list = [path for path in get_image_paths(input_aligned_dir)]
             logger.info("Getting Face Hashes for selected Aligned Images")
-            for face in tqdm(file_list, desc="Hashing Faces"):
-                face_hashes.append(hash_image_file(face))
+            face_hashes = list(FaceHashes(input_aligned_dir).get_hashes(file_list).values())
             logger.debug("Face Hashes: %s", (len(face_hashes)))
             if not face_hashes:
                 logger.error("Aligned directory is empty, no faces will be converted!")
@@ -316,10 +434,12 @@ class Legacy():
         and remove the 'r' parameter
         - Add face hashes to alignments file
         """
-    def __init__(self, alignments, frames, faces_dir):
+    def __init__(self, alignments, frames, faces_dir, frame_dims=None):
         self.alignments = alignments
         self.frames = {os.path.basename(frame): frame
                        for frame in frames}
+        # The dimensions of every frame for video input, where the frames are not files
+        self.frame_dims = frame_dims
         self.process(faces_dir)
 
     def process(self, faces_dir):
@@ -344,20 +464,24 @@ class Legacy():
 
     def add_dimensions(self, no_dims):
         """ Add width and height of original frame to alignments """
-        for no_dim in tqdm(no_dims, desc="Adding Frame Dimensions"):
-            if no_dim not in self.frames.keys():
-                continue
-            filename = self.frames[no_dim]
-            dims = cv2.imread(filename).shape[:2]  # pylint: disable=no-member
-            self.alignments.add_dimensions(no_dim, dims)
+        no_dims = [no_dim for no_dim in no_dims if no_dim in self.frames.keys()]
+        filenames = [self.frames[no_dim] for no_dim in no_dims]
+        if self.frame_dims is not None:
+            dimensions = dict.fromkeys(filenames, self.frame_dims)
+        else:
+            dimensions = get_image_dimensions(filenames, desc="Reading Frame Dimensions")
+        for no_dim in no_dims:
+            self.alignments.add_dimensions(no_dim, dimensions[self.frames[no_dim]])
 
     def rotate_landmarks(self, rotated):
         """ Rotate the landmarks """
-        for rotate_item in tqdm(rotated, desc="Rotating Landmarks"):
+        frames = list()
+        for rotate_item in rotated:
             if rotate_item not in self.frames.keys():
                 logger.debug("Skipping missing frame: '%s'", rotate_item)
                 continue
-            self.alignments.rotate_existing_landmarks(rotate_item)
+            frames.append(rotate_item)
+        self.alignments.rotate_legacy_landmarks(frames)
 
     def add_hashes(self, hashes, faces_dir):
         """ Add Face Hashes to the alignments file """
@@ -371,11 +495,16 @@ class Legacy():
             orig_frame = filename[:filename.rfind("_")] + extension
             all_faces.setdefault(orig_frame, dict())[int(index)] = os.path.join(faces_dir, face)
 
+        face_paths = [face_path
+                      for frame in hashes if frame in all_faces.keys()
+                      for face_path in all_faces[frame].values()]
+        face_hashes = FaceHashes(faces_dir).get_hashes(face_paths)
+
         for frame in tqdm(hashes):
             if frame not in all_faces.keys():
                 logger.warning("Skipping missing frame: '%s'", frame)
                 continue
             hash_faces = all_faces[frame]
             for index, face_path in hash_faces.items():
-                hash_faces[index] = hash_image_file(face_path)
+                hash_faces[index] = face_hashes[face_path]
             self.alignments.add_face_hashes(frame, hash_faces)
@@ -3,12 +3,17 @@
 
 import logging
 import os
+import queue as Queue
 import sys
+from collections import deque
 from pathlib import Path
 
+import psutil
 from tqdm import tqdm
 
+from lib.detect_cache import DetectCache
 from lib.faces_detect import DetectedFace
+from lib.frame_buffer import FrameBuffer
 from lib.gpu_stats import GPUStats
 from lib.multithreading import MultiThread, PoolProcess, SpawnProcess
 from lib.queue_manager import queue_manager, QueueEmpty
@@ -30,9 +35,13 @@ class Extract():
         self.images = Images(self.args)
         self.alignments = Alignments(self.args, True)
         self.plugins = Plugins(self.args)
+        if self.images.images_found != 0:
+            self.plugins.add_frame_buffer(
+                self.images.load_one_image(self.images.input_images[0]))
 
         self.post_process = PostProcess(arguments)
 
+        self.face_writer = None
         self.verify_output = False
         self.save_interval = None
         if hasattr(self.args, "save_interval"):
@@ -45,10 +54,13 @@ class Extract():
         Utils.set_verbosity()
 #        queue_manager.debug_monitor(1)
         self.threaded_io("load")
-        save_thread = self.threaded_io("save")
+        self.face_writer = FaceWriter()
         self.run_extraction()
-        save_thread.join()
+        self.face_writer.close()
+        # The face writer adds the hashes to the alignments in place
+        self.alignments.invalidate_indexes()
         self.alignments.save()
+        self.plugins.save_detect_cache()
         Utils.finalize(self.images.images_found,
                        self.alignments.faces_count,
                        self.verify_output)
@@ -59,8 +71,6 @@ class Extract():
         io_args = tuple() if io_args is None else (io_args, )
         if task == "load":
             func = self.load_images
-        elif task == "save":
-            func = self.save_faces
         elif task == "reload":
             func = self.reload_images
         io_thread = MultiThread(func, *io_args, thread_count=1)
@@ -70,9 +80,10 @@ class Extract():
     def load_images(self):
         """ Load the images """
         logger.debug("Load Images: Start")
-        load_queue = queue_manager.get_queue("load")
-        for filename, image in self.images.load():
-            if load_queue.shutdown.is_set():
+        # Skipped frames still take up an index, so that faces are never
+        # tracked across them
+        for frame_index, (filename, image) in enumerate(self.images.load()):
+            if queue_manager.shutdown.is_set():
                 logger.debug("Load Queue: Stop signal received. Terminating")
                 break
             imagename = os.path.basename(filename)
@@ -80,17 +91,17 @@ class Extract():
                 logger.trace("Skipping image: '%s'", filename)
                 continue
             item = {"filename": filename,
-                    "image": image}
-            load_queue.put(item)
-        load_queue.put("EOF")
+                    "image": image,
+                    "frame_index": frame_index}
+            self.plugins.put_frame(item, "load")
+        self.plugins.put_eof("load")
         logger.debug("Load Images: Complete")
 
     def reload_images(self, detected_faces):
         """ Reload the images and pair to detected face """
         logger.debug("Reload Images: Start. Detected Faces Count: %s", len(detected_faces))
-        load_queue = queue_manager.get_queue("detect")
         for filename, image in self.images.load():
-            if load_queue.shutdown.is_set():
+            if queue_manager.shutdown.is_set():
                 logger.debug("Reload Queue: Stop signal received. Terminating")
                 break
             logger.trace("Reloading image: '%s'", filename)
@@ -99,36 +110,12 @@ class Extract():
                 logger.warning("Couldn't find faces for: %s", filename)
                 continue
             detect_item["image"] = image
-            load_queue.put(detect_item)
-        load_queue.put("EOF")
+            self.plugins.put_frame(detect_item, "detect")
+        self.plugins.put_eof("detect")
         logger.debug("Reload Images: Complete")
 
-    @staticmethod
-    def save_faces():
-        """ Save the generated faces """
-        logger.debug("Save Faces: Start")
-        save_queue = queue_manager.get_queue("save")
-        while True:
-            if save_queue.shutdown.is_set():
-                logger.debug("Save Queue: Stop signal received. Terminating")
-                break
-            item = save_queue.get()
-            if item == "EOF":
-                break
-            filename, face = item
-
-            logger.trace("Saving face: '%s'", filename)
-            try:
-                with open(filename, "wb") as out_file:
-                    out_file.write(face)
-            except Exception as err:  # pylint: disable=broad-except
-                logger.error("Failed to save image '%s'. Original Error: %s", filename, err)
-                continue
-        logger.debug("Save Faces: Complete")
-
     def run_extraction(self):
         """ Run Face Detection """
-        save_queue = queue_manager.get_queue("save")
         to_process = self.process_item_count()
         frame_no = 0
         size = self.args.size if hasattr(self.args, "size") else 256
@@ -150,6 +137,7 @@ class Extract():
 
             filename = faces["filename"]
 
+            self.plugins.cache_detection(faces)
             self.align_face(faces, align_eyes, size, filename)
             self.post_process.do_actions(faces)
 
@@ -161,15 +149,18 @@ class Extract():
             if not self.verify_output and faces_count > 1:
                 self.verify_output = True
 
-            self.output_faces(filename, faces, save_queue)
+            self.output_faces(filename, faces)
+            self.plugins.release_frame(faces)
 
             frame_no += 1
             if frame_no == self.save_interval:
-                self.alignments.save()
+                # Hashes are added to the alignments as the faces are written
+                self.face_writer.flush()
+                self.alignments.invalidate_indexes()
+                self.alignments.checkpoint()
+                self.plugins.save_detect_cache()
                 frame_no = 0
 
-        save_queue.put("EOF")
-
     def process_item_count(self):
         """ Return the number of items to be processedd """
         processed = sum(os.path.basename(frame) in self.alignments.data.keys()
@@ -202,6 +193,7 @@ class Extract():
                 break
 
             del detected["image"]
+            self.plugins.release_frame(detected)
             filename = detected["filename"]
 
             detected_faces[filename] = detected
@@ -227,8 +219,8 @@ class Extract():
                                 "face": detected_face})
         faces["detected_faces"] = final_faces
 
-    def output_faces(self, filename, faces, save_queue):
-        """ Output faces to save thread """
+    def output_faces(self, filename, faces):
+        """ Output faces to the face writer """
         final_faces = list()
         for idx, detected_face in enumerate(faces["detected_faces"]):
             output_file = detected_face["file_location"]
@@ -236,25 +228,131 @@ class Extract():
             out_filename = "{}_{}{}".format(str(output_file), str(idx), extension)
 
             face = detected_face["face"]
-            resized_face = face.aligned_face
-
-            face.hash, img = hash_encode_image(resized_face, extension)
-            save_queue.put((out_filename, img))
-            final_faces.append(face.to_alignment())
+            alignment = face.to_alignment()
+            self.face_writer.put(out_filename, face.aligned_face, alignment)
+            final_faces.append(alignment)
         self.alignments.data[os.path.basename(filename)] = final_faces
+        self.alignments.invalidate_indexes()
+
+
+class FaceWriter():
+    """ Encode, hash and save extracted faces in a pool of threads.
+
+        Faces are taken from a bounded queue in batches, so the extraction
+        loop blocks when the writers fall behind. Each face's hash is added
+        to it's alignment once the face has been encoded, so call flush
+        before saving the alignments """
+    def __init__(self, thread_count=None, batch_size=8):
+        self.thread_count = thread_count if thread_count else min(8, psutil.cpu_count())
+        logger.debug("Initializing %s: (thread_count: %s, batch_size: %s)",
+                     self.__class__.__name__, self.thread_count, batch_size)
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(maxsize=self.thread_count * batch_size * 2)
+        self.threads = MultiThread(self.save_faces, thread_count=self.thread_count)
+        self.threads.start()
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def put(self, filename, face, alignment):
+        """ Queue a face to be saved. The face's hash is added to the
+            given alignment when it is saved """
+        logger.trace("Queueing face: '%s'", filename)
+        self.queue.put((filename, face, alignment))
+
+    def flush(self):
+        """ Block until every face queued so far has been saved """
+        logger.debug("Flushing face writer")
+        self.queue.join()
+
+    def close(self):
+        """ Save any remaining faces and stop the threads """
+        logger.debug("Closing face writer")
+        self.queue.put("EOF")
+        self.threads.join()
+
+    def get_batch(self):
+        """ Return a batch of faces, blocking for the first face only, and
+            whether the queue is exhausted """
+        batch = list()
+        exhausted = False
+        item = self.queue.get()
+        while True:
+            if item == "EOF":
+                # Re-put EOF for the other threads
+                self.queue.task_done()
+                self.queue.put(item)
+                exhausted = True
+                break
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                break
+            try:
+                item = self.queue.get(block=False)
+            except Queue.Empty:
+                break
+        return batch, exhausted
+
+    def save_faces(self):
+        """ Encode, hash and write batches of faces until EOF is received """
+        logger.debug("Save Faces: Start")
+        while True:
+            if queue_manager.shutdown.is_set():
+                logger.debug("Save Queue: Stop signal received. Terminating")
+                break
+            batch, exhausted = self.get_batch()
+            try:
+                self.save_batch(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if exhausted:
+                break
+        logger.debug("Save Faces: Complete")
+
+    @staticmethod
+    def save_batch(batch):
+        """ Encode and hash a batch of faces, then write them out """
+        encoded = list()
+        for filename, face, alignment in batch:
+            alignment["hash"], img = hash_encode_image(face, os.path.splitext(filename)[1])
+            encoded.append((filename, img))
+        for filename, img in encoded:
+            logger.trace("Saving face: '%s'", filename)
+            try:
+                with open(filename, "wb") as out_file:
+                    out_file.write(img)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error("Failed to save image '%s'. Original Error: %s", filename, err)
 
 
 class Plugins():
-    """ Detector and Aligner Plugins and queues """
+    """ Detector and Aligner Plugins and queues
+
+        Frames are sharded across one or more workers, each of which is a
+        detector and aligner process pair with it's own queues, pinned to it's
+        own GPU or set of CPU cores. Frames are dealt to the workers in
+        consecutive chunks and merged back into frame order on output.
+
+        A worker's tracker never tracks across the gap between it's chunks, as
+        the frame indexes are not consecutive, so when tracking the chunks are
+        sized to a whole number of track intervals """
     def __init__(self, arguments):
         logger.debug("Initializing %s", self.__class__.__name__)
         self.args = arguments
         self.detector = self.load_detector()
         self.aligner = self.load_aligner()
         self.is_parallel = self.set_parallel_processing()
-
-        self.process_detect = None
-        self.process_align = None
+        self.detect_cache = self.load_detect_cache()
+        self.track_interval = self.get_track_interval()
+        self.workers = self.set_workers()
+        # Consecutive frames dealt to each worker in turn
+        self.chunk_size = self.get_chunk_size()
+        self.frames_dealt = 0
+        # (filename, worker) of each frame put, in the order they should be output
+        self.frame_order = deque()
+
+        self.process_detect = list()
+        self.process_align = list()
+        self.frame_buffer = None
         self.add_queues()
         logger.debug("Initialized %s", self.__class__.__name__)
 
@@ -288,13 +386,137 @@ class Plugins():
             return False
         return True
 
+    def set_workers(self):
+        """ Return the GPU and CPU cores to pin each worker to.
+
+            By default there is one worker per GPU. On CPU only hosts there is
+            one worker for every 4 cores (up to 4 workers), each pinned to
+            it's own share of the cores. A single worker is not pinned """
+        requested = self.args.workers if hasattr(self.args, "workers") else 0
+        unpinned = [{"device": None, "cpu_cores": None}]
+        if self.detector.parent_is_pool:
+            if requested > 1:
+                logger.warning("The '%s' detector already runs in multiple processes. "
+                               "Using 1 worker", self.args.detector)
+            return unpinned
+
+        device_count = GPUStats().device_count
+        if hasattr(os, "sched_getaffinity"):
+            cpu_cores = sorted(os.sched_getaffinity(0))
+        else:
+            cpu_cores = list(range(psutil.cpu_count()))
+        if requested > 0:
+            count = requested
+        elif device_count > 0:
+            count = device_count
+        else:
+            count = max(1, min(4, len(cpu_cores) // 4))
+        logger.debug("Workers: (requested: %s, device_count: %s, cpu_cores: %s, workers: %s)",
+                     requested, device_count, len(cpu_cores), count)
+        if count == 1:
+            return unpinned
+
+        workers = list()
+        cores_per_worker = len(cpu_cores) // count
+        for idx in range(count):
+            device = idx % device_count if device_count > 0 else None
+            cores = None
+            if device_count == 0 and cores_per_worker > 0 and hasattr(os, "sched_setaffinity"):
+                end = len(cpu_cores) if idx == count - 1 else (idx + 1) * cores_per_worker
+                cores = cpu_cores[idx * cores_per_worker:end]
+            logger.verbose("Worker %s: (GPU: %s, CPU cores: %s)",
+                           idx, "None" if device is None else device, cores)
+            workers.append({"device": device, "cpu_cores": cores})
+        logger.info("Extracting with %s workers", count)
+        return workers
+
+    def get_chunk_size(self, min_size=16):
+        """ Return the number of consecutive frames to deal to each worker.
+            When tracking, chunks start on a detection so must be a multiple of
+            the track interval to not add detections """
+        if not self.track_interval or len(self.workers) == 1:
+            return min_size
+        retval = self.track_interval * -(-min_size // self.track_interval)
+        logger.debug("Chunk size: %s", retval)
+        return retval
+
+    @staticmethod
+    def queue_name(task, worker):
+        """ Return the name of a worker's queue for the given task """
+        return "{}_{}".format(task, worker)
+
     def add_queues(self):
         """ Add the required processing queues to Queue Manager """
-        for task in ("load", "detect", "align", "save"):
-            size = 0
-            if task == "load" or (not self.is_parallel and task == "detect"):
-                size = 100
-            queue_manager.add_queue(task, maxsize=size)
+        workers = len(self.workers)
+        for worker in range(workers):
+            for task in ("load", "detect", "align"):
+                size = 0
+                if task == "load" or (not self.is_parallel and task == "detect"):
+                    size = max(100 // workers, self.chunk_size)
+                queue_manager.add_queue(self.queue_name(task, worker), maxsize=size)
+
+    def put_frame(self, item, task):
+        """ Put a frame to the "load" (detector) or "detect" (aligner) queue
+            of the worker it is dealt to and record it's output position.
+
+            Frames with a cached detection bypass the detector, unless faces
+            are being tracked, when the detector needs them to track from """
+        worker = (self.frames_dealt // self.chunk_size) % len(self.workers)
+        self.frames_dealt += 1
+        if task == "load" and self.get_cached_detection(item) and not self.track_interval:
+            task = "detect"
+        self.frame_order.append((item["filename"], worker))
+        queue_manager.get_queue(self.queue_name(task, worker)).put(self.to_frame_buffer(item))
+
+    def put_eof(self, task):
+        """ Put EOF to the given task's queue for every worker.
+
+            Frames bypassing the detector are put before the load queue's EOF,
+            so always reach the detect queue ahead of the detector's EOF """
+        for worker in range(len(self.workers)):
+            queue_manager.get_queue(self.queue_name(task, worker)).put("EOF")
+        self.frames_dealt = 0
+
+    def add_frame_buffer(self, sample_image):
+        """ Add a shared memory frame buffer for passing frames to the detector
+            and aligner processes, sized from the given sample frame.
+
+            Frames which don't fit in a slot, or which arrive when all slots are
+            in use, are sent through the queues as normal """
+        if self.detector.parent_is_pool:
+            logger.debug("Detector runs in a process pool. Not adding frame buffer")
+            return
+        if sample_image is None:
+            logger.debug("No sample image. Not adding frame buffer")
+            return
+        slot_size = sample_image.nbytes
+        # Enough slots for full load queues plus frames in flight in each
+        # worker, capped to a quarter of the available system RAM
+        max_slots = int(psutil.virtual_memory().available * 0.25) // slot_size
+        slots = min(100 + 32 * len(self.workers), max_slots)
+        if slots < 1:
+            logger.debug("Not enough free RAM for frame buffer")
+            return
+        logger.verbose("Holding up to %s frames in shared memory (%sMB)",
+                       slots, int(slots * slot_size / (1024 * 1024)))
+        self.frame_buffer = FrameBuffer(slots, slot_size)
+
+    def to_frame_buffer(self, item):
+        """ Move the image of a queue item into the frame buffer, if it is
+            available, replacing the image with the slot handle """
+        if self.frame_buffer is None or item["image"] is None:
+            return item
+        handle = self.frame_buffer.put(item["image"])
+        if handle is not None:
+            item["frame_slot"] = handle
+            del item["image"]
+        return item
+
+    def release_frame(self, item):
+        """ Release an item's frame buffer slot once the frame is finished with """
+        if self.frame_buffer is None:
+            return
+        self.frame_buffer.release_item(item)
 
     def load_detector(self):
         """ Set global arguments and load detector plugin """
@@ -311,6 +533,49 @@ class Plugins():
 
         return detector
 
+    def load_detect_cache(self):
+        """ Load the detection cache for the input location and selected
+            detector settings """
+        if hasattr(self.args, "no_detect_cache") and self.args.no_detect_cache:
+            logger.debug("Detection cache disabled")
+            return None
+        if os.path.isdir(self.args.input_dir):
+            folder = self.args.input_dir
+        else:
+            folder = os.path.dirname(self.args.input_dir)
+        params = None
+        if self.args.detector == "mtcnn":
+            params = self.detector.validate_kwargs(self.get_mtcnn_kwargs())
+        return DetectCache(folder, self.detector, params=params)
+
+    def get_cached_detection(self, item):
+        """ Add the cached detected faces to the item and return True if the
+            frame is in the detection cache, otherwise return False """
+        if self.detect_cache is None:
+            return False
+        detected_faces = self.detect_cache.get(item["filename"], item["image"])
+        if detected_faces is None:
+            return False
+        item["detected_faces"] = detected_faces
+        return True
+
+    def cache_detection(self, item):
+        """ Add newly detected faces for an item to the detection cache.
+            Tracked faces are not detector output so are not cached, but are
+            dropped from the cache misses awaiting results """
+        if self.detect_cache is None:
+            return
+        if item.get("tracked", False):
+            self.detect_cache.discard(item["filename"])
+            return
+        self.detect_cache.add(item["filename"], item["detected_faces"])
+
+    def save_detect_cache(self):
+        """ Save the detection cache """
+        if self.detect_cache is None:
+            return
+        self.detect_cache.save()
+
     def load_aligner(self):
         """ Set global arguments and load aligner plugin """
         aligner_name = self.args.aligner.replace("-", "_").lower()
@@ -322,15 +587,24 @@ class Plugins():
         return aligner
 
     def launch_aligner(self):
-        """ Launch the face aligner """
-        logger.debug("Launching Aligner")
-        out_queue = queue_manager.get_queue("align")
-        kwargs = {"in_queue": queue_manager.get_queue("detect"),
+        """ Launch the face aligner for each worker """
+        for worker in range(len(self.workers)):
+            self.launch_worker_aligner(worker)
+
+    def launch_worker_aligner(self, worker):
+        """ Launch the face aligner for the given worker """
+        logger.debug("Launching Aligner: %s", worker)
+        out_queue = queue_manager.get_queue(self.queue_name("align", worker))
+        kwargs = {"in_queue": queue_manager.get_queue(self.queue_name("detect", worker)),
                   "out_queue": out_queue}
+        kwargs.update(self.workers[worker])
+        if self.frame_buffer is not None:
+            kwargs["frame_buffer"] = self.frame_buffer
 
-        self.process_align = SpawnProcess(self.aligner.run, **kwargs)
-        event = self.process_align.event
-        self.process_align.start()
+        process = SpawnProcess(self.aligner.run, **kwargs)
+        self.process_align.append(process)
+        event = process.event
+        process.start()
 
         # Wait for Aligner to take it's VRAM
         # The first ever load of the model for FAN has reportedly taken
@@ -347,25 +621,38 @@ class Plugins():
         logger.debug("Launched Aligner")
 
     def launch_detector(self):
-        """ Launch the face detector """
-        logger.debug("Launching Detector")
-        out_queue = queue_manager.get_queue("detect")
-        kwargs = {"in_queue": queue_manager.get_queue("load"),
+        """ Launch the face detector for each worker """
+        for worker in range(len(self.workers)):
+            self.launch_worker_detector(worker)
+
+    def launch_worker_detector(self, worker):
+        """ Launch the face detector for the given worker """
+        logger.debug("Launching Detector: %s", worker)
+        out_queue = queue_manager.get_queue(self.queue_name("detect", worker))
+        kwargs = {"in_queue": queue_manager.get_queue(self.queue_name("load", worker)),
                   "out_queue": out_queue}
+        kwargs.update(self.workers[worker])
 
         if self.args.detector == "mtcnn":
             mtcnn_kwargs = self.detector.validate_kwargs(
                 self.get_mtcnn_kwargs())
             kwargs["mtcnn_kwargs"] = mtcnn_kwargs
 
+        if self.frame_buffer is not None:
+            kwargs["frame_buffer"] = self.frame_buffer
+
+        if self.track_interval:
+            kwargs["track_interval"] = self.track_interval
+
         mp_func = PoolProcess if self.detector.parent_is_pool else SpawnProcess
-        self.process_detect = mp_func(self.detector.run, **kwargs)
+        process = mp_func(self.detector.run, **kwargs)
+        self.process_detect.append(process)
 
         event = None
-        if hasattr(self.process_detect, "event"):
-            event = self.process_detect.event
+        if hasattr(process, "event"):
+            event = process.event
 
-        self.process_detect.start()
+        process.start()
 
         if event is None:
             logger.debug("Launched Detector")
@@ -381,6 +668,20 @@ class Plugins():
 
         logger.debug("Launched Detector")
 
+    def get_track_interval(self):
+        """ Return the maximum number of frames between detections if
+            tracking has been requested and is supported by the detector """
+        if not hasattr(self.args, "track_interval") or not self.args.track_interval:
+            return 0
+        if self.args.track_interval < 2:
+            logger.warning("Track interval must be at least 2. Not tracking faces")
+            return 0
+        if self.detector.parent_is_pool:
+            logger.warning("Face tracking is not supported for the '%s' detector. Not "
+                           "tracking faces", self.args.detector)
+            return 0
+        return self.args.track_interval
+
     def get_mtcnn_kwargs(self):
         """ Add the mtcnn arguments into a kwargs dictionary """
         mtcnn_threshold = [float(thr.strip())
@@ -390,18 +691,45 @@ class Plugins():
                 "factor": self.args.mtcnn_scalefactor}
 
     def detect_faces(self, extract_pass="detect"):
-        """ Detect faces from in an image """
+        """ Detect faces from in an image.
+
+            Output from all workers is merged back into the order the frames
+            were put in """
         logger.debug("Running Detection. Pass: '%s'", extract_pass)
-        if self.is_parallel or extract_pass == "align":
-            out_queue = queue_manager.get_queue("align")
+        task = "align"
         if not self.is_parallel and extract_pass == "detect":
-            out_queue = queue_manager.get_queue("detect")
+            task = "detect"
+        out_queues = [queue_manager.get_queue(self.queue_name(task, worker))
+                      for worker in range(len(self.workers))]
+        finished = set()
+        # Items which have arrived ahead of their turn
+        held = dict()
 
         while True:
+            if self.frame_order:
+                filename, worker = self.frame_order[0]
+                if filename in held:
+                    self.frame_order.popleft()
+                    faces = held.pop(filename)
+                    if self.frame_buffer is not None:
+                        self.frame_buffer.attach(faces)
+                    yield faces
+                    continue
+                if worker in finished:
+                    logger.warning("No output received for: '%s'", filename)
+                    self.frame_order.popleft()
+                    continue
+            elif len(finished) == len(out_queues):
+                break
+            else:
+                worker = min(set(range(len(out_queues))) - finished)
+
             try:
-                faces = out_queue.get(True, 1)
+                faces = out_queues[worker].get(True, 1)
                 if faces == "EOF":
-                    break
+                    logger.debug("Worker complete: %s", worker)
+                    finished.add(worker)
+                    continue
                 if isinstance(faces, dict) and faces.get("exception"):
                     pid = faces["exception"][0]
                     t_back = faces["exception"][1].getvalue()
@@ -409,6 +737,5 @@ class Plugins():
                     raise Exception(err)
             except QueueEmpty:
                 continue
-
-            yield faces
+            held[faces["filename"]] = faces
         logger.debug("Detection Complete")
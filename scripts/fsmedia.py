@@ -7,15 +7,18 @@
 
 import logging
 import os
+import queue as Queue
 from pathlib import Path
 
 import cv2
 import numpy as np
+from tqdm import tqdm
 
 from lib.aligner import Extract as AlignerExtract
 from lib.alignments import Alignments as AlignmentsBase
 from lib.face_filter import FaceFilter as FilterFunc
-from lib.utils import (camel_case_split, get_folder, get_image_paths,
+from lib.multithreading import MultiThread
+from lib.utils import (_video_extensions, camel_case_split, get_folder, get_image_paths,
                        set_system_verbosity)
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -30,6 +33,14 @@ class Utils():
         """ Set the system output verbosity """
         set_system_verbosity()
 
+    @staticmethod
+    def is_video(path):
+        """ Return whether the given path is a video file """
+        retval = (path is not None
+                  and os.path.splitext(str(path))[1].lower() in _video_extensions)
+        logger.trace("Path: '%s', is_video: %s", path, retval)
+        return retval
+
     @staticmethod
     def finalize(images_found, num_faces_detected, verify_output):
         """ Finalize the image processing """
@@ -65,6 +76,10 @@ class Alignments(AlignmentsBase):
         if self.args.alignments_path:
             logger.debug("Alignments File provided: '%s'", self.args.alignments_path)
             folder, filename = os.path.split(str(self.args.alignments_path))
+        elif Utils.is_video(self.args.input_dir):
+            logger.debug("Alignments from Input Video: '%s'", self.args.input_dir)
+            folder, filename = os.path.split(str(self.args.input_dir))
+            filename = "{}_alignments".format(os.path.splitext(filename)[0])
         else:
             logger.debug("Alignments from Input Folder: '%s'", self.args.input_dir)
             folder = str(self.args.input_dir)
@@ -99,18 +114,22 @@ class Alignments(AlignmentsBase):
 
         if not skip_existing and not skip_faces:
             logger.debug("No skipping selected. Returning empty dictionary")
+            self.set_journal_aside()
             return data
 
-        if not self.have_alignments_file and (skip_existing or skip_faces):
+        if (not self.have_alignments_file
+                and not self.have_journal
+                and (skip_existing or skip_faces)):
             logger.warning("Skip Existing/Skip Faces selected, but no alignments file found!")
             return data
 
-        try:
-            with open(self.file, self.serializer.roptions) as align:
-                data = self.serializer.unmarshal(align.read())
-        except IOError as err:
-            logger.error("Error: '%s' not read: %s", self.file, err.strerror)
-            exit(1)
+        if self.have_alignments_file:
+            try:
+                data = self.serializer.load(self.file)
+            except IOError as err:
+                logger.error("Error: '%s' not read: %s", self.file, err.strerror)
+                exit(1)
+        data = self.load_journal(data)
 
         if skip_faces:
             # Remove items from algnments that have no faces so they will
@@ -125,10 +144,21 @@ class Alignments(AlignmentsBase):
 
 
 class Images():
-    """ Holds the full frames/images """
+    """ Holds the full frames/images
+
+        The input can be a folder of images or a video file. Video frames are
+        decoded on the fly and named by their 1 based frame index in the same
+        format as "effmpeg extract" (<video name>_<index>.png) so that
+        alignments keys are stable between the two """
     def __init__(self, arguments):
         logger.debug("Initializing %s", self.__class__.__name__)
         self.args = arguments
+        self.is_video = Utils.is_video(self.args.input_dir)
+        self.fps = None
+        # The (height, width) shared by every frame of a video input
+        self.video_dims = None
+        self.vid_reader = None
+        self.vid_position = 0
         self.input_images = self.get_input_images()
         self.images_found = len(self.input_images)
         logger.debug("Initialized %s", self.__class__.__name__)
@@ -136,16 +166,61 @@ class Images():
     def get_input_images(self):
         """ Return the list of images that are to be processed """
         if not os.path.exists(self.args.input_dir):
-            logger.error("Input directory %s not found.", self.args.input_dir)
+            logger.error("Input location %s not found.", self.args.input_dir)
             exit(1)
 
-        logger.info("Input Directory: %s", self.args.input_dir)
-        input_images = get_image_paths(self.args.input_dir)
+        if self.is_video:
+            logger.info("Input Video: %s", self.args.input_dir)
+            input_images = self.get_video_frames()
+        else:
+            logger.info("Input Directory: %s", self.args.input_dir)
+            input_images = get_image_paths(self.args.input_dir)
 
         return input_images
 
+    def get_video_frames(self):
+        """ Return the list of frame names for a video file. The frame count in
+            the video's header is only an estimate, so the frames are counted by
+            reading to the end of the video, as load_video does """
+        reader = cv2.VideoCapture(self.args.input_dir)  # pylint: disable=no-member
+        if not reader.isOpened():
+            logger.error("Unable to open video: '%s'", self.args.input_dir)
+            exit(1)
+        # pylint: disable=no-member
+        estimate = int(reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = reader.get(cv2.CAP_PROP_FPS)
+        self.video_dims = (int(reader.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                           int(reader.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        frame_count = 0
+        for _ in tqdm(iter(reader.grab, False),
+                      desc="Counting Video Frames",
+                      total=estimate if estimate > 0 else None):
+            frame_count += 1
+        # Hold the reader open for loading the frames. It rewinds on the first request
+        self.vid_reader = reader
+        self.vid_position = frame_count + 1
+        logger.debug("Video frames: %s (header: %s), fps: %s, dimensions: %s",
+                     frame_count, estimate, self.fps, self.video_dims)
+        return [self.video_frame_name(idx) for idx in range(1, frame_count + 1)]
+
+    def video_frame_name(self, index):
+        """ Return the full path of a video frame's name for the given 1 based
+            frame index """
+        vidname = os.path.basename(self.args.input_dir)
+        filename = "{}_{:05d}.png".format(vidname, index)
+        return os.path.join(os.path.dirname(self.args.input_dir), filename)
+
+    @staticmethod
+    def video_frame_index(filename):
+        """ Return the 1 based frame index from a video frame's name """
+        return int(os.path.splitext(filename)[0].rsplit("_", 1)[-1])
+
     def load(self):
         """ Load an image and yield it with it's filename """
+        if self.is_video:
+            for filename, image in self.load_video():
+                yield filename, image
+            return
         for filename in self.input_images:
             logger.trace("Loading image: '%s'", filename)
             try:
@@ -155,12 +230,162 @@ class Images():
                 continue
             yield filename, image
 
-    @staticmethod
-    def load_one_image(filename):
+    def load_video(self):
+        """ Decode the video sequentially and yield each frame with it's name.
+            The video reader is released once the video has been read """
+        reader = self.get_video_reader(1)
+        index = 0
+        try:
+            while True:
+                success, image = reader.read()
+                if not success:
+                    break
+                index += 1
+                self.vid_position = index + 1
+                filename = self.video_frame_name(index)
+                logger.trace("Loading video frame: '%s'", filename)
+                yield filename, image
+        finally:
+            self.close_video()
+        logger.debug("Loaded video frames: %s", index)
+
+    def load_one_image(self, filename):
         """ load requested image """
         logger.trace("Loading image: '%s'", filename)
+        if self.is_video:
+            return self.load_one_video_frame(filename)
         return cv2.imread(filename)  # pylint: disable=no-member
 
+    def load_one_video_frame(self, filename):
+        """ Load the requested video frame. The reader is held open so that
+            sequential requests only decode the next frame rather than
+            seeking. Call close_video when done """
+        index = self.video_frame_index(filename)
+        success, image = self.get_video_reader(index).read()
+        self.vid_position = index + 1
+        if not success:
+            logger.warning("Unable to read frame %s from video", index)
+            return None
+        return image
+
+    def get_video_reader(self, index):
+        """ Return the held video reader, opening it if required, positioned
+            to read the given 1 based frame index next """
+        # pylint: disable=no-member
+        if self.vid_reader is None:
+            logger.debug("Opening video reader: '%s'", self.args.input_dir)
+            self.vid_reader = cv2.VideoCapture(self.args.input_dir)
+            self.vid_position = 1
+        if index != self.vid_position:
+            logger.trace("Seeking to frame %s", index)
+            self.vid_reader.set(cv2.CAP_PROP_POS_FRAMES, index - 1)
+            self.vid_position = index
+        return self.vid_reader
+
+    def close_video(self):
+        """ Release the held video reader. It is reopened if another frame is
+            requested """
+        if self.vid_reader is None:
+            return
+        logger.debug("Releasing video reader: '%s'", self.args.input_dir)
+        self.vid_reader.release()
+        self.vid_reader = None
+
+
+class Output():
+    """ Holds the output for converted frames. Writes to a folder of
+        images, or streams to a video file if the output location has a
+        video extension """
+    # Default codecs for the supported video containers
+    fourcc = {".avi": "XVID", ".flv": "FLV1", ".mkv": "XVID", ".mov": "mp4v",
+              ".mp4": "mp4v", ".mpeg": "PIM1", ".webm": "VP80"}
+
+    def __init__(self, arguments, fps=None):
+        logger.debug("Initializing %s: (fps: %s)", self.__class__.__name__, fps)
+        self.args = arguments
+        self.is_video = Utils.is_video(self.args.output_dir)
+        if self.is_video:
+            self.output_dir = get_folder(os.path.dirname(self.args.output_dir))
+        else:
+            self.output_dir = get_folder(self.args.output_dir)
+        self.fps = fps if fps else 25.0
+        self.writer = None
+        self.queue = None
+        self.thread = None
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def save(self, filename, image):
+        """ Save a frame to the output folder or video. Frames for an output
+            folder can be passed in already encoded (see encode) """
+        if not self.is_video:
+            filename = str(self.output_dir / Path(filename).name)
+            logger.trace("Saving image: '%s'", filename)
+            if isinstance(image, bytes):
+                with open(filename, "wb") as out_file:
+                    out_file.write(image)
+            else:
+                cv2.imwrite(filename, image)  # pylint: disable=no-member
+            return
+        if self.writer is None:
+            self.writer = self.get_video_writer(image)
+        logger.trace("Writing frame to video: '%s'", filename)
+        self.writer.write(image)
+
+    def get_video_writer(self, image):
+        """ Open the video writer sized to the given frame """
+        # pylint: disable=no-member
+        extension = os.path.splitext(self.args.output_dir)[1].lower()
+        fourcc = cv2.VideoWriter_fourcc(*self.fourcc.get(extension, "mp4v"))
+        height, width = image.shape[:2]
+        logger.info("Output Video: %s (%sx%s @ %sfps)",
+                    self.args.output_dir, width, height, self.fps)
+        return cv2.VideoWriter(self.args.output_dir, fourcc, self.fps, (width, height))
+
+    @staticmethod
+    def encode(filename, image):
+        """ Return the image encoded to bytes in the format of the filename's
+            extension, ready to be saved to an output folder """
+        extension = os.path.splitext(filename)[1]
+        return cv2.imencode(extension, image)[1].tobytes()  # pylint: disable=no-member
+
+    # <<< BACKGROUND WRITER >>> #
+    def start_writer(self, maxsize=16):
+        """ Save frames passed to queue_save in a background thread, in the
+            order that they are queued """
+        logger.debug("Starting writer: (maxsize: %s)", maxsize)
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.thread = MultiThread(self.write_queued)
+        self.thread.start()
+
+    def queue_save(self, filename, image):
+        """ Queue a frame to be saved by the background writer """
+        self.queue.put((filename, image))
+
+    def write_queued(self):
+        """ Save queued frames until the queue is closed. If a save fails
+            the remaining frames are drained, so that convert does not block,
+            and the error is raised when the writer is closed """
+        item = self.queue.get()
+        try:
+            while item is not None:
+                self.save(*item)
+                item = self.queue.get()
+        finally:
+            while item is not None:
+                item = self.queue.get()
+
+    def close(self):
+        """ Flush the background writer and close the video writer """
+        if self.thread is not None:
+            logger.debug("Closing background writer")
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.writer is not None:
+            logger.debug("Closing video writer")
+            self.writer.release()
+            self.writer = None
+
 
 class PostProcess():
     """ Optional post processing tasks """
@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+""" Tests for faceswap. Run with pytest from the faceswap folder """
+
+# The custom log levels must be registered before any module level loggers are created
+import lib.logger  # noqa: F401 pylint: disable=unused-import
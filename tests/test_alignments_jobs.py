@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+""" Tests for the alignments tool jobs
+
+    Run as a module to time merging and removing frames at two sizes:
+        python -m tests.test_alignments_jobs """
+
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from lib import Serializer
+from tools.lib_alignments.jobs import Merge, RemoveAlignments
+from tools.lib_alignments.media import AlignmentData
+
+
+def make_alignments(frames, faces_per_frame=2, prefix=""):
+    """ Return alignments data with a unique hash for every face """
+    return {"{}frame_{:05d}.png".format(prefix, frame):
+            [{"x": idx, "w": 10, "y": frame, "h": 10, "landmarksXY": [[idx, frame]],
+              "hash": "{}{:05d}_{}".format(prefix, frame, idx)}
+             for idx in range(faces_per_frame)]
+            for frame in range(frames)}
+
+
+def write_alignments(folder, filename, data):
+    """ Write alignments data to a json file and return it's full path """
+    path = os.path.join(str(folder), filename)
+    Serializer.get_serializer("json").save(path, data)
+    return path
+
+
+def get_merge(folder, sources):
+    """ Return a Merge job for the given source files into a new main file """
+    main_file = write_alignments(folder, "alignments.json", make_alignments(4))
+    return Merge(AlignmentData(main_file, None), SimpleNamespace(alignments_file2=sources))
+
+
+def test_merge_corrupt_source_raises(tmpdir):
+    """ A source that can't be parsed raises rather than hanging the merge """
+    good = write_alignments(tmpdir, "good.json", make_alignments(4, prefix="good_"))
+    corrupt = os.path.join(str(tmpdir), "corrupt.json")
+    with open(corrupt, "w") as out_file:
+        out_file.write('{"frame_00000.png": [{"x": ')
+    merge = get_merge(tmpdir, [good, corrupt])
+    with pytest.raises(ValueError):
+        merge.process()
+
+
+def test_merge_missing_source_raises(tmpdir):
+    """ A source that disappears after the job starts exits rather than hanging
+        the merge """
+    good = write_alignments(tmpdir, "good.json", make_alignments(4, prefix="good_"))
+    missing = write_alignments(tmpdir, "missing.json", make_alignments(4, prefix="missing_"))
+    merge = get_merge(tmpdir, [good, missing])
+    os.remove(missing)
+    with pytest.raises(SystemExit):
+        merge.process()
+
+
+def get_indexes(alignments):
+    """ Return the face hash index, frame name index and face count, building them
+        if they don't exist """
+    alignments.get_full_frame_name("")
+    return (dict(alignments.hashes_to_frame),
+            dict(alignments._stem_index),  # pylint: disable=protected-access
+            alignments.faces_count)
+
+
+def test_indexes_match_rebuild(tmpdir):
+    """ The indexes kept up to date by merging and removing faces are the same as
+        indexes rebuilt from scratch """
+    source = make_alignments(6, faces_per_frame=3)
+    # Faces that already exist, new faces for existing frames and frames that
+    # share a name with an existing frame but not the extension
+    for frame in range(2, 6):
+        source["frame_{:05d}.png".format(frame)][2]["hash"] = "new_{}".format(frame)
+    for frame in (1, 3, 8):
+        source["frame_{:05d}.jpg".format(frame)] = make_alignments(
+            1, prefix="jpg_{}_".format(frame))["jpg_{}_frame_00000.png".format(frame)]
+    merge = get_merge(tmpdir, [write_alignments(tmpdir, "source.json", source)])
+    alignments = merge.alignments
+    get_indexes(alignments)
+    merge.process()
+
+    frames_dir = tmpdir.mkdir("frames")
+    for frame in ("frame_00000.png", "frame_00001.jpg", "frame_00002.png",
+                  "frame_00003.png", "frame_00004.png", "frame_00005.png", "frame_00008.jpg"):
+        frames_dir.join(frame).write("")
+    RemoveAlignments(alignments, SimpleNamespace(job="remove-frames",
+                                                 frames_dir=str(frames_dir))).process()
+    alignments.delete_face_at_index("frame_00002.png", 0)
+    alignments.delete_face_at_index("frame_00002.png", 5)
+    alignments.delete_frame("frame_00003.png")
+    alignments.add_face("frame_00009.png", {"hash": "added"})
+    alignments.filter_hashes(["00000_1", "new_4"], filter_out=True)
+
+    updated = get_indexes(alignments)
+    alignments.invalidate_indexes()
+    assert updated == get_indexes(alignments)
+
+
+def benchmark(frames=20000):
+    """ Print the time taken to merge two large alignments files and remove half of
+        the frames of the result """
+    folder = tempfile.mkdtemp()
+    try:
+        main_file = write_alignments(folder, "alignments.json", make_alignments(frames))
+        source = write_alignments(folder, "source.json", make_alignments(frames, prefix="src_"))
+        frames_dir = os.path.join(folder, "frames")
+        os.mkdir(frames_dir)
+        for frame in range(0, frames, 2):
+            open(os.path.join(frames_dir, "frame_{:05d}.png".format(frame)), "w").close()
+        alignments = AlignmentData(main_file, None)
+        start = time.time()
+        Merge(alignments, SimpleNamespace(alignments_file2=[source])).process()
+        merged = time.time()
+        RemoveAlignments(alignments, SimpleNamespace(job="remove-frames",
+                                                     frames_dir=frames_dir)).process()
+        removed = time.time()
+    finally:
+        shutil.rmtree(folder)
+    print("{} frames: merge {:.2f}s, remove frames {:.2f}s".format(
+        frames, merged - start, removed - merged))
+
+
+if __name__ == "__main__":
+    # Doubling the frames should roughly double the times
+    for count in (10000, 20000):
+        benchmark(count)
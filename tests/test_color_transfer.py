@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+""" Tests for the color transfer between swapped and original faces
+
+    The vectorized average color adjustment and the lookup table histogram
+    matching are checked against the original implementations. Run as a
+    module to benchmark each against the original:
+        python -m tests.test_color_transfer """
+
+from timeit import timeit
+
+import numpy as np
+
+from lib.color_transfer import adjust_avg_color, color_hist_match
+
+
+def baseline_adjust_avg_color(old_face, new_face):
+    """ The original per pixel average color adjustment """
+    for i in range(new_face.shape[-1]):
+        old_avg = old_face[:, :, i].mean()
+        new_avg = new_face[:, :, i].mean()
+        diff_int = (int)(old_avg - new_avg)
+        for int_h in range(new_face.shape[0]):
+            for int_w in range(new_face.shape[1]):
+                # Numpy < 2 promoted the uint8 pixel to a python int here
+                temp = (int(new_face[int_h, int_w, i]) + diff_int)
+                if temp < 0:
+                    new_face[int_h, int_w, i] = 0
+                elif temp > 255:
+                    new_face[int_h, int_w, i] = 255
+                else:
+                    new_face[int_h, int_w, i] = temp
+
+
+def baseline_hist_match(source, template, mask=None):
+    """ The original single channel histogram match. The mask was applied but
+        the masked images were never used, so the mask had no effect """
+    # pylint: disable=unused-variable,too-many-locals
+    masked_source = source
+    masked_template = template
+
+    if mask is not None:
+        masked_source = source * mask
+        masked_template = template * mask
+
+    oldshape = source.shape
+    source = source.ravel()
+    template = template.ravel()
+    masked_source = masked_source.ravel()
+    masked_template = masked_template.ravel()
+    s_values, bin_idx, s_counts = np.unique(source, return_inverse=True,
+                                            return_counts=True)
+    t_values, t_counts = np.unique(template, return_counts=True)
+
+    s_quantiles = np.cumsum(s_counts).astype(np.float64)
+    s_quantiles /= s_quantiles[-1]
+    t_quantiles = np.cumsum(t_counts).astype(np.float64)
+    t_quantiles /= t_quantiles[-1]
+    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+
+    return interp_t_values[bin_idx].reshape(oldshape)
+
+
+def baseline_color_hist_match(src_im, tar_im, mask=None):
+    """ The original three channel histogram match """
+    matched_r = baseline_hist_match(src_im[:, :, 0], tar_im[:, :, 0], mask)
+    matched_g = baseline_hist_match(src_im[:, :, 1], tar_im[:, :, 1], mask)
+    matched_b = baseline_hist_match(src_im[:, :, 2], tar_im[:, :, 2], mask)
+    return np.stack((matched_r, matched_g, matched_b), axis=2).astype(src_im.dtype)
+
+
+def masked_hist_match(src_im, tar_im, mask):
+    """ Histogram match with the histograms counted over the pixels where the
+        binary mask is set, remapping every pixel of the source """
+    matched = np.empty_like(src_im)
+    selected = mask[..., 0] > 0
+    for channel in range(src_im.shape[-1]):
+        source = src_im[..., channel]
+        s_sorted = np.sort(source[selected])
+        t_values, t_counts = np.unique(tar_im[..., channel][selected], return_counts=True)
+        t_quantiles = np.cumsum(t_counts) / t_counts.sum()
+        s_quantiles = np.searchsorted(s_sorted, source, side="right") / s_sorted.size
+        matched[..., channel] = np.interp(s_quantiles, t_quantiles, t_values)
+    return matched
+
+
+def get_face(rng, size, offset=0):
+    """ Return a random uint8 face, with a random region blacked out or
+        saturated, whose levels are shifted by the given offset """
+    face = np.clip(rng.normal(128 + offset, rng.uniform(10, 80), (size, size, 3)), 0, 255)
+    top, left = rng.randint(0, size // 2, 2)
+    face[top:top + size // 3, left:left + size // 3] = rng.choice([0, 255])
+    return face.astype("uint8")
+
+
+def get_mask(rng, faces, size):
+    """ Return random binary (faces, size, size, 1) masks, each with at least
+        one pixel set """
+    masks = (rng.rand(faces, size, size, 1) < rng.uniform(0.2, 0.8)).astype("float32")
+    masks[:, size // 2, size // 2] = 1.0
+    return masks
+
+
+def test_adjust_avg_color_matches_baseline():
+    """ The vectorized adjustment gives the same face as the original """
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        size = rng.randint(8, 48)
+        old_face = get_face(rng, size, offset=rng.randint(-100, 100))
+        new_face = get_face(rng, size)
+        expected = new_face.copy()
+        baseline_adjust_avg_color(old_face, expected)
+        adjust_avg_color(old_face, new_face)
+        assert np.array_equal(new_face, expected)
+
+
+def test_color_hist_match_matches_baseline():
+    """ Without a mask, single faces and batches give the same faces as the
+        original """
+    rng = np.random.RandomState(1)
+    for _ in range(20):
+        size = rng.randint(8, 96)
+        src = np.stack([get_face(rng, size) for _ in range(3)])
+        tar = np.stack([get_face(rng, size, offset=rng.randint(-100, 100)) for _ in range(3)])
+        expected = np.stack([baseline_color_hist_match(*faces) for faces in zip(src, tar)])
+        assert np.array_equal(color_hist_match(src[0], tar[0]), expected[0])
+        assert np.array_equal(color_hist_match(src, tar), expected)
+
+
+def test_color_hist_match_mask():
+    """ The original ignored the mask, so a mask that selects every pixel gives
+        the same faces as the original. Any other mask only counts the pixels
+        it selects for the histograms """
+    rng = np.random.RandomState(2)
+    for _ in range(20):
+        size = rng.randint(8, 96)
+        src = np.stack([get_face(rng, size) for _ in range(3)])
+        tar = np.stack([get_face(rng, size, offset=rng.randint(-100, 100)) for _ in range(3)])
+        masks = get_mask(rng, 3, size)
+        full = np.ones_like(masks)
+        expected = np.stack([baseline_color_hist_match(src_im, tar_im, mask)
+                             for src_im, tar_im, mask in zip(src, tar, masks)])
+        assert np.array_equal(color_hist_match(src, tar, full), expected)
+
+        expected = np.stack([masked_hist_match(*faces) for faces in zip(src, tar, masks)])
+        assert np.array_equal(color_hist_match(src, tar, masks), expected)
+        # Weights are relative, so scaling the mask changes nothing
+        assert np.array_equal(color_hist_match(src, tar, masks * 0.5), expected)
+
+
+def benchmark_avg_color(size=256, number=10):
+    """ Print the time taken to adjust the average color of a face with each
+        implementation """
+    rng = np.random.RandomState(0)
+    old_face = get_face(rng, size, offset=50)
+    new_face = get_face(rng, size)
+    baseline = timeit(lambda: baseline_adjust_avg_color(old_face, new_face.copy()),
+                      number=number) / number
+    vectorized = timeit(lambda: adjust_avg_color(old_face, new_face.copy()),
+                        number=number) / number
+    print("Adjusting a {0}x{0} face: baseline {1:.1f}ms, vectorized {2:.2f}ms ({3:.0f}x)".format(
+        size, baseline * 1000, vectorized * 1000, baseline / vectorized))
+
+
+def benchmark_hist_match(faces=3, size=256, number=10):
+    """ Print the time taken to match the histograms of a frame's faces with each
+        implementation """
+    rng = np.random.RandomState(0)
+    src = np.stack([get_face(rng, size) for _ in range(faces)])
+    tar = np.stack([get_face(rng, size, offset=50) for _ in range(faces)])
+    baseline = timeit(lambda: [baseline_color_hist_match(*faces) for faces in zip(src, tar)],
+                      number=number) / number
+    batched = timeit(lambda: color_hist_match(src, tar), number=number) / number
+    print("Matching {} faces: baseline {:.1f}ms, lookup table {:.1f}ms ({:.0f}x)".format(
+        faces, baseline * 1000, batched * 1000, baseline / batched))
+
+
+if __name__ == "__main__":
+    benchmark_avg_color()
+    benchmark_hist_match()
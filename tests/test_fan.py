@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+""" Tests for the FAN aligner's heatmap decoding
+
+    The batched decoding is checked against the original per face, per point
+    implementation. Run as a module to benchmark the two:
+        python -m tests.test_fan """
+
+from timeit import timeit
+
+import numpy as np
+
+from plugins.extract.align.fan import Align
+
+
+def baseline_transform(point, center, scale, resolution):
+    """ The original single point crop transform """
+    pnt = np.array([point[0], point[1], 1.0])
+    hscl = 200.0 * scale
+    eye = np.eye(3)
+    eye[0, 0] = resolution / hscl
+    eye[1, 1] = resolution / hscl
+    eye[0, 2] = resolution * (-center[0] / hscl + 0.5)
+    eye[1, 2] = resolution * (-center[1] / hscl + 0.5)
+    eye = np.linalg.inv(eye)
+    return np.matmul(eye, pnt)[0:2]
+
+
+def baseline_get_pts_from_predict(var_a, center, scale):
+    """ The original decoding of the heatmaps of a single face """
+    var_b = var_a.reshape((var_a.shape[0],
+                           var_a.shape[1] * var_a.shape[2]))
+    var_c = var_b.argmax(1).reshape((var_a.shape[0],
+                                     1)).repeat(2,
+                                                axis=1).astype("float64")
+    var_c[:, 0] %= var_a.shape[2]
+    var_c[:, 1] = np.apply_along_axis(
+        lambda x: np.floor(x / var_a.shape[2]),
+        0,
+        var_c[:, 1])
+
+    for i in range(var_a.shape[0]):
+        pt_x, pt_y = int(var_c[i, 0]), int(var_c[i, 1])
+        if pt_x > 0 and pt_x < 63 and pt_y > 0 and pt_y < 63:
+            diff = np.array([var_a[i, pt_y, pt_x+1]
+                             - var_a[i, pt_y, pt_x-1],
+                             var_a[i, pt_y+1, pt_x]
+                             - var_a[i, pt_y-1, pt_x]])
+
+            var_c[i] += np.sign(diff)*0.25
+
+    var_c += 0.5
+    return [baseline_transform(var_c[i], center, scale, var_a.shape[2])
+            for i in range(var_a.shape[0])]
+
+
+def get_batch(rng, faces, points=68, size=64):
+    """ Return random heatmaps, with some maxima forced onto the edges, and
+        random centers and scales """
+    heatmaps = rng.rand(faces, points, size, size).astype("float32")
+    for face in range(faces):
+        for point in rng.choice(points, 8, replace=False):
+            pt_x, pt_y = rng.choice([0, 1, size - 2, size - 1, rng.randint(size)], 2)
+            heatmaps[face, point, pt_y, pt_x] = 2.0
+    centers = rng.uniform(-50, 1500, (faces, 2))
+    scales = rng.uniform(0.2, 5.0, faces)
+    return heatmaps, centers, scales
+
+
+def test_get_pts_from_predict_matches_baseline():
+    """ The batched decoding gives the same points and the same integer
+        landmarks as the original """
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        heatmaps, centers, scales = get_batch(rng, rng.randint(1, 6))
+        points = Align.get_pts_from_predict(heatmaps, centers, scales)
+        landmarks = points.astype("int32").tolist()
+        for face, heatmap in enumerate(heatmaps):
+            expected = baseline_get_pts_from_predict(heatmap, centers[face], scales[face])
+            assert np.allclose(points[face], expected)
+            assert landmarks[face] == [[int(pt[0]), int(pt[1])] for pt in expected]
+
+
+def benchmark(faces=64, number=5):
+    """ Print the time taken to decode a batch of faces with each implementation """
+    heatmaps, centers, scales = get_batch(np.random.RandomState(0), faces)
+    baseline = timeit(lambda: [baseline_get_pts_from_predict(heatmap, center, scale)
+                               for heatmap, center, scale in zip(heatmaps, centers, scales)],
+                      number=number) / number
+    batched = timeit(lambda: Align.get_pts_from_predict(heatmaps, centers, scales),
+                     number=number) / number
+    print("Decoding {} faces: baseline {:.1f}ms, batched {:.1f}ms ({:.0f}x)".format(
+        faces, baseline * 1000, batched * 1000, baseline / batched))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+""" Tests for the MTCNN detector's box processing
+
+    The vectorized non-max suppression, padding and box regression are
+    checked against the original implementations. Run as a module to
+    benchmark non-max suppression:
+        python -m tests.test_mtcnn """
+
+from timeit import timeit
+
+import numpy as np
+
+from plugins.extract.detect.mtcnn import bbreg, nms, pad
+
+
+def baseline_bbreg(boundingbox, reg):
+    """ The original box regression """
+    if reg.shape[1] == 1:
+        reg = np.reshape(reg, (reg.shape[2], reg.shape[3]))
+
+    width = boundingbox[:, 2] - boundingbox[:, 0] + 1
+    height = boundingbox[:, 3] - boundingbox[:, 1] + 1
+    b_1 = boundingbox[:, 0] + reg[:, 0] * width
+    b_2 = boundingbox[:, 1] + reg[:, 1] * height
+    b_3 = boundingbox[:, 2] + reg[:, 2] * width
+    b_4 = boundingbox[:, 3] + reg[:, 3] * height
+    boundingbox[:, 0:4] = np.transpose(np.vstack([b_1, b_2, b_3, b_4]))
+    return boundingbox
+
+
+def baseline_nms(boxes, threshold, method):
+    """ The original one box at a time non-max suppression """
+    # pylint: disable=too-many-locals
+    if boxes.size == 0:
+        return np.empty((0, 3))
+    x_1 = boxes[:, 0]
+    y_1 = boxes[:, 1]
+    x_2 = boxes[:, 2]
+    y_2 = boxes[:, 3]
+    var_s = boxes[:, 4]
+    area = (x_2 - x_1 + 1) * (y_2 - y_1 + 1)
+    s_sort = np.argsort(var_s)
+    pick = np.zeros_like(var_s, dtype=np.int16)
+    counter = 0
+    while s_sort.size > 0:
+        i = s_sort[-1]
+        pick[counter] = i
+        counter += 1
+        idx = s_sort[0:-1]
+        xx_1 = np.maximum(x_1[i], x_1[idx])
+        yy_1 = np.maximum(y_1[i], y_1[idx])
+        xx_2 = np.minimum(x_2[i], x_2[idx])
+        yy_2 = np.minimum(y_2[i], y_2[idx])
+        width = np.maximum(0.0, xx_2-xx_1+1)
+        height = np.maximum(0.0, yy_2-yy_1+1)
+        inter = width * height
+        if method == 'Min':
+            var_o = inter / np.minimum(area[i], area[idx])
+        else:
+            var_o = inter / (area[i] + area[idx] - inter)
+        s_sort = s_sort[np.where(var_o <= threshold)]
+    pick = pick[0:counter]
+    return pick
+
+
+def baseline_pad(total_boxes, width, height):
+    """ The original box padding """
+    tmp_width = (total_boxes[:, 2] - total_boxes[:, 0] + 1).astype(np.int32)
+    tmp_height = (total_boxes[:, 3] - total_boxes[:, 1] + 1).astype(np.int32)
+    numbox = total_boxes.shape[0]
+
+    d_x = np.ones((numbox), dtype=np.int32)
+    d_y = np.ones((numbox), dtype=np.int32)
+    ed_x = tmp_width.copy().astype(np.int32)
+    ed_y = tmp_height.copy().astype(np.int32)
+
+    dim_x = total_boxes[:, 0].copy().astype(np.int32)
+    dim_y = total_boxes[:, 1].copy().astype(np.int32)
+    e_x = total_boxes[:, 2].copy().astype(np.int32)
+    e_y = total_boxes[:, 3].copy().astype(np.int32)
+
+    tmp = np.where(e_x > width)
+    ed_x.flat[tmp] = np.expand_dims(-e_x[tmp] + width + tmp_width[tmp], 1)
+    e_x[tmp] = width
+
+    tmp = np.where(e_y > height)
+    ed_y.flat[tmp] = np.expand_dims(-e_y[tmp] + height + tmp_height[tmp], 1)
+    e_y[tmp] = height
+
+    tmp = np.where(dim_x < 1)
+    d_x.flat[tmp] = np.expand_dims(2 - dim_x[tmp], 1)
+    dim_x[tmp] = 1
+
+    tmp = np.where(dim_y < 1)
+    d_y.flat[tmp] = np.expand_dims(2 - dim_y[tmp], 1)
+    dim_y[tmp] = 1
+
+    return d_y, ed_y, d_x, ed_x, dim_y, e_y, dim_x, e_x, tmp_width, tmp_height
+
+
+def get_boxes(rng, count, width=640, height=480):
+    """ Return random, heavily overlapping (x1, y1, x2, y2, score) boxes, some
+        of which run off the edges of the frame """
+    centers = rng.uniform(-20, (width + 20, height + 20), (count, 2))
+    sizes = rng.uniform(12, 120, (count, 1))
+    return np.hstack((centers - sizes / 2, centers + sizes / 2, rng.rand(count, 1)))
+
+
+def test_nms_matches_baseline():
+    """ The same boxes are picked in the same order for any chunk size """
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        boxes = get_boxes(rng, rng.randint(1, 400))
+        threshold = rng.uniform(0.3, 0.8)
+        for method in ("Union", "Min"):
+            expected = baseline_nms(boxes, threshold, method)
+            for chunk_size in (None, 1, 97, 5000):
+                picked = nms(boxes, threshold, method, chunk_size=chunk_size)
+                assert np.array_equal(picked, expected)
+
+
+def test_grouped_nms_matches_baseline():
+    """ Grouped suppression matches a call per group, in group order """
+    rng = np.random.RandomState(1)
+    for _ in range(50):
+        boxes = get_boxes(rng, rng.randint(1, 400))
+        groups = rng.randint(0, 5, len(boxes))
+        expected = np.concatenate([
+            np.flatnonzero(groups == group)[baseline_nms(boxes[groups == group], 0.5, "Union")]
+            for group in np.unique(groups)])
+        for chunk_size in (None, 1, 97):
+            picked = nms(boxes, 0.5, "Union", groups=groups, chunk_size=chunk_size)
+            assert np.array_equal(picked, expected)
+
+
+def test_nms_empty():
+    """ No boxes gives an empty pick """
+    assert nms(np.empty((0, 5)), 0.5, "Union").size == 0
+
+
+def test_pad_matches_baseline():
+    """ Padding gives the same coordinates as the original """
+    rng = np.random.RandomState(2)
+    for _ in range(100):
+        boxes = get_boxes(rng, rng.randint(1, 200))
+        for result, expected in zip(pad(boxes, 640, 480), baseline_pad(boxes, 640, 480)):
+            assert np.array_equal(result, expected)
+
+
+def test_bbreg_matches_baseline():
+    """ Box regression gives the same boxes as the original """
+    rng = np.random.RandomState(3)
+    for _ in range(100):
+        boxes = get_boxes(rng, rng.randint(1, 200))
+        reg = rng.uniform(-0.3, 0.3, (len(boxes), 4))
+        assert np.allclose(bbreg(boxes.copy(), reg), baseline_bbreg(boxes.copy(), reg))
+
+
+def benchmark(count=2000, number=3):
+    """ Print the time taken to suppress a set of boxes with each implementation """
+    boxes = get_boxes(np.random.RandomState(0), count)
+    baseline = timeit(lambda: baseline_nms(boxes, 0.5, "Union"), number=number) / number
+    vectorized = timeit(lambda: nms(boxes, 0.5, "Union"), number=number) / number
+    print("NMS of {} boxes: baseline {:.1f}ms, vectorized {:.1f}ms ({:.1f}x)".format(
+        count, baseline * 1000, vectorized * 1000, baseline / vectorized))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -2,7 +2,7 @@
 """ Command Line Arguments for tools """
 from lib.cli import FaceSwapArgs
 from lib.cli import (ContextFullPaths, DirFullPaths,
-                     FileFullPaths, SaveFileFullPaths)
+                     FileFullPaths, FilesFullPaths, SaveFileFullPaths)
 from lib.utils import _image_extensions
 
 
@@ -46,7 +46,7 @@ class AlignmentsArgs(FaceSwapArgs):
                     frames_dir + align_eyes +
                     "\n'merge': Merge multiple alignment files into one."
                     "\n\tSpecify the main alignments file with the -a flag"
-                    "\n\tand the file to be merged with the -a2 flag."
+                    "\n\tand the file(s) to be merged with the -a2 flag."
                     "\n'missing-alignments': Identify frames that do not"
                     "\n\texist in the alignments file." + output_opts +
                     frames_dir +
@@ -98,7 +98,9 @@ class AlignmentsArgs(FaceSwapArgs):
                     "\n\tOptionally pass in a faces folder (-fc) to also"
                     "\n\trename extracted faces."
                     "\n'spatial' - Perform spatial and temporal filtering to"
-                    "\n\tsmooth alignments (EXPERIMENTAL!)"})
+                    "\n\tsmooth alignments. Faces are linked between frames"
+                    "\n\tby position, so remove false positives first"
+                    "\n\t(EXPERIMENTAL!)"})
         argument_list.append({"opts": ("-a", "--alignments_file"),
                               "action": FileFullPaths,
                               "dest": "alignments_file",
@@ -107,13 +109,14 @@ class AlignmentsArgs(FaceSwapArgs):
                               "help": "Full path to the alignments "
                                       "file to be processed."})
         argument_list.append({"opts": ("-a2", "--alignments_file2"),
-                              "action": FileFullPaths,
+                              "action": FilesFullPaths,
                               "dest": "alignments_file2",
                               "required": False,
                               "filetypes": "alignments",
-                              "help": "Full path to the alignments file to "
+                              "help": "Full path to the alignments file(s) to "
                                       "be merged into the main alignments "
-                                      "file (merge only)"})
+                                      "file. Multiple files can be added "
+                                      "space separated (merge only)"})
         argument_list.append({"opts": ("-fc", "-faces_folder"),
                               "action": DirFullPaths,
                               "dest": "faces_dir",
@@ -125,9 +128,12 @@ class AlignmentsArgs(FaceSwapArgs):
                                       "that faces were extracted from."})
         argument_list.append({"opts": ("-fmt", "--alignment_format"),
                               "type": str,
-                              "choices": ("json", "pickle", "yaml"),
+                              "choices": ("json", "pickle", "yaml", "npz"),
                               "help": "The file format to save the alignment "
-                                      "data in. Defaults to same as source."})
+                                      "data in. Defaults to same as source. "
+                                      "'npz' is a compact binary format which "
+                                      "loads quickly and is memory mapped, "
+                                      "for very large alignments files."})
         argument_list.append({
             "opts": ("-o", "--output"),
             "type": str,
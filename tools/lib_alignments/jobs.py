@@ -3,16 +3,23 @@
 # TODO merge alignments
 
 import logging
+import mmap
 import os
 import pickle
 import struct
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import chain
+from math import hypot
 
 import numpy as np
 from scipy import signal
 from sklearn import decomposition
 from tqdm import tqdm
 
+from lib.face_hashes import FaceHashes
+from lib.multithreading import BackgroundGenerator
+from lib.utils import get_image_dimensions
 from . import AlignmentData, Annotate, ExtractedFaces, Faces, Frames
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -325,6 +332,7 @@ class Extract():
         frame_name = frame["frame_name"]
         extension = os.path.splitext(frame_fullname)[1]
         faces = self.select_valid_faces(frame_fullname)
+        hashes = dict()
 
         for idx, face in enumerate(faces):
             output = "{}_{}{}".format(frame_name, str(idx), extension)
@@ -335,8 +343,10 @@ class Extract():
                 f_hash = self.extracted_faces.save_face_with_hash(output,
                                                                   extension,
                                                                   face.aligned_face)
-                self.alignments.data[frame_fullname][idx]["hash"] = f_hash
+                hashes[idx] = f_hash
             face_count += 1
+        if hashes:
+            self.alignments.add_face_hashes(frame_fullname, hashes)
         return face_count
 
     def select_valid_faces(self, frame):
@@ -355,29 +365,60 @@ class Extract():
 
 
 class Merge():
-    """ Merge two alignments files into one """
+    """ Merge any number of alignments files into the main alignments file
+
+        Faces are de-duplicated by hash. The files are merged in the order
+        given, so where the same frame appears in more than one file, its new
+        faces are appended in that order """
     def __init__(self, alignments, arguments):
+        logger.debug("Initializing %s: (arguments: %s)", self.__class__.__name__, arguments)
         self.alignments = alignments
-        self.alignments2 = AlignmentData(arguments.alignments_file2, "json")
+        self.sources = self.get_sources(arguments.alignments_file2)
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def get_sources(self, filenames):
+        """ Return the alignments files to be merged, checking that they exist """
+        if not filenames:
+            logger.error("No alignments files to merge provided (-a2)")
+            exit(0)
+        sources = list()
+        for filename in filenames:
+            AlignmentData.check_file_exists(filename)
+            if os.path.abspath(filename) == os.path.abspath(self.alignments.file):
+                logger.warning("Not merging the main alignments file into itself: '%s'",
+                               filename)
+                continue
+            sources.append(filename)
+        logger.debug("Sources: %s", sources)
+        return sources
+
+    def load_sources(self):
+        """ Load each of the alignments files to be merged in turn """
+        for filename in self.sources:
+            yield AlignmentData(filename, None)
 
     def process(self):
         """Process the alignments file merge """
         logger.info("[MERGE ALIGNMENTS]")  # Tidy up cli output
         skip_count = 0
         merge_count = 0
-        for _, src_alignments, _, frame in tqdm(self.alignments2.yield_faces(),
-                                                desc="Merging Alignments",
-                                                total=self.alignments2.frames_count):
-            for idx, alignment in enumerate(src_alignments):
-                if not alignment.get("hash", None):
-                    logger.warning("Alignment '%s':%s has no Hash! Skipping", frame, idx)
-                    skip_count += 1
-                    continue
-                if self.check_exists(frame, alignment, idx):
-                    skip_count += 1
-                    continue
-                self.merge_alignment(frame, alignment, idx)
-                merge_count += 1
+        # The next file is loaded in the background whilst the current one is merged
+        sources = BackgroundGenerator(self.load_sources(), prefetch=1)
+        for source in sources.iterator():
+            for _, src_alignments, _, frame in tqdm(
+                    source.yield_faces(),
+                    desc="Merging {}".format(os.path.basename(source.file)),
+                    total=source.frames_count):
+                for idx, alignment in enumerate(src_alignments):
+                    if not alignment.get("hash", None):
+                        logger.warning("Alignment '%s':%s has no Hash! Skipping", frame, idx)
+                        skip_count += 1
+                        continue
+                    if self.check_exists(frame, alignment, idx):
+                        skip_count += 1
+                        continue
+                    self.merge_alignment(frame, alignment, idx)
+                    merge_count += 1
         logger.info("Alignments Merged: %s", merge_count)
         logger.info("Alignments Skipped: %s", skip_count)
         if merge_count != 0:
@@ -401,7 +442,7 @@ class Merge():
         """ Merge the source alignment into the destination """
         logger.debug("Merging alignment: (frame: %s, src_idx: %s, hash: %s)",
                      frame, idx, alignment["hash"])
-        self.alignments.data.setdefault(frame, list()).append(alignment)
+        self.alignments.add_face(frame, alignment)
 
     def set_destination_filename(self):
         """ Set the destination filename """
@@ -416,9 +457,13 @@ class Reformat():
     def __init__(self, alignments, arguments):
         logger.debug("Initializing %s: (arguments: %s)", self.__class__.__name__, arguments)
         self.alignments = alignments
+        self.faces_dir = None
         if self.alignments.file == "dfl.json":
             logger.debug("Loading DFL faces")
-            self.faces = Faces(arguments.faces_dir)
+            self.faces_dir = arguments.faces_dir
+            if not self.faces_dir or not os.path.isdir(self.faces_dir):
+                logger.error("ERROR: The Faces folder %s could not be found", self.faces_dir)
+                exit(0)
         logger.debug("Initialized %s", self.__class__.__name__)
 
     def process(self):
@@ -426,49 +471,62 @@ class Reformat():
         logger.info("[REFORMAT ALIGNMENTS]")  # Tidy up cli output
         if self.alignments.file == "dfl.json":
             self.alignments.data = self.load_dfl()
-            self.alignments.file = self.alignments.get_location(self.faces.folder, "alignments")
+            self.alignments.file = self.alignments.get_location(self.faces_dir, "alignments")
         self.alignments.save()
 
     def load_dfl(self):
-        """ Load alignments from DeepFaceLab and format for Faceswap """
+        """ Load alignments from DeepFaceLab and format for Faceswap.
+
+            The DFL alignments are read from the pngs without decoding them,
+            and only the faces that hold alignments are hashed """
         alignments = dict()
-        for face in tqdm(self.faces.file_list_sorted, desc="Converting DFL Faces"):
-            if face["face_extension"] != ".png":
-                logger.verbose("'%s' is not a png. Skipping", face["face_fullname"])
+        filenames = list()
+        for face in sorted(os.listdir(self.faces_dir), key=lambda x: os.path.splitext(x)[0]):
+            if not Faces.valid_extension(face):
                 continue
-            f_hash = face["face_hash"]
-            fullpath = os.path.join(self.faces.folder, face["face_fullname"])
-            dfl = self.get_dfl_alignment(fullpath)
-
-            if not dfl:
+            if os.path.splitext(face)[1] != ".png":
+                logger.verbose("'%s' is not a png. Skipping", face)
                 continue
-
-            self.convert_dfl_alignment(dfl, f_hash, alignments)
+            filenames.append(os.path.join(self.faces_dir, face))
+
+        # Reading the alignments is bound by I/O, so read from several files at once
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            dfl_alignments = list(tqdm(executor.map(self.get_dfl_alignment, filenames),
+                                       desc="Reading DFL Alignments",
+                                       total=len(filenames)))
+        faces = [(filename, dfl)
+                 for filename, dfl in zip(filenames, dfl_alignments)
+                 if dfl]
+        hashes = FaceHashes(self.faces_dir).get_hashes([filename for filename, _ in faces],
+                                                       desc="Reading Face Hashes")
+
+        for filename, dfl in tqdm(faces, desc="Converting DFL Faces"):
+            self.convert_dfl_alignment(dfl, hashes[filename], alignments)
         return alignments
 
     @staticmethod
     def get_dfl_alignment(filename):
-        """ Process the alignment of one face """
-        with open(filename, "rb") as dfl:
-            header = dfl.read(8)
-            if header != b"\x89PNG\r\n\x1a\n":
+        """ Process the alignment of one face. The file is memory mapped and
+            only the chunk headers and the alignments chunk are read """
+        if os.path.getsize(filename) < 8:
+            logger.error("No Valid PNG header: %s", filename)
+            return None
+        with open(filename, "rb") as dfl, \
+                mmap.mmap(dfl.fileno(), 0, access=mmap.ACCESS_READ) as png:
+            if png[:8] != b"\x89PNG\r\n\x1a\n":
                 logger.error("No Valid PNG header: %s", filename)
                 return None
-            while True:
-                chunk_start = dfl.tell()
-                chunk_hdr = dfl.read(8)
-                if not chunk_hdr:
-                    break
-                chunk_length, chunk_name = struct.unpack("!I4s", chunk_hdr)
-                dfl.seek(chunk_start, os.SEEK_SET)
+            chunk_start = 8
+            while chunk_start + 8 <= len(png):
+                chunk_length, chunk_name = struct.unpack_from("!I4s", png, chunk_start)
                 if chunk_name == b"fcWp":
-                    chunk = dfl.read(chunk_length + 12)
-                    retval = pickle.loads(chunk[8:-4])
+                    retval = pickle.loads(png[chunk_start + 8:chunk_start + 8 + chunk_length])
                     logger.trace("Loaded DFL Alignment: (filename: '%s', alignment: %s",
                                  filename, retval)
                     return retval
-                dfl.seek(chunk_length+12, os.SEEK_CUR)
+                chunk_start += chunk_length + 12
             logger.error("Couldn't find DFL alignments: %s", filename)
+        return None
 
     @staticmethod
     def convert_dfl_alignment(dfl_alignments, f_hash, alignments):
@@ -499,7 +557,7 @@ class RemoveAlignments():
         """ Set the correct items to process """
         retval = None
         if self.type == "frames":
-            retval = list(Frames(arguments.frames_dir).items.keys())
+            retval = set(Frames(arguments.frames_dir).items.keys())
         elif self.type == "faces":
             retval = Faces(arguments.faces_dir)
         return retval
@@ -541,7 +599,7 @@ class RemoveAlignments():
             logger.trace("Not deleting frame: '%s'", frame)
             return 0
         logger.debug("Deleting frame: '%s'", frame)
-        del self.alignments.data[frame]
+        self.alignments.delete_frame(frame)
         return 1
 
     def remove_faces(self):
@@ -617,18 +675,18 @@ class Legacy():
 
     def add_dimensions(self, no_dims):
         """ Add width and height of original frame to alignments """
-        for no_dim in tqdm(no_dims, desc="Adding Frame Dimensions"):
-            if no_dim not in self.frames.items.keys():
-                continue
-            dims = self.frames.load_image(no_dim).shape[:2]
-            self.alignments.add_dimensions(no_dim, dims)
+        no_dims = [no_dim for no_dim in no_dims if no_dim in self.frames.items.keys()]
+        dimensions = get_image_dimensions([os.path.join(self.frames.folder, no_dim)
+                                           for no_dim in no_dims],
+                                          desc="Reading Frame Dimensions")
+        for no_dim in no_dims:
+            self.alignments.add_dimensions(no_dim,
+                                           dimensions[os.path.join(self.frames.folder, no_dim)])
 
     def rotate_landmarks(self, rotated):
         """ Rotate the landmarks """
-        for rotate_item in tqdm(rotated, desc="Rotating Landmarks"):
-            if rotate_item not in self.frames.items.keys():
-                continue
-            self.alignments.rotate_existing_landmarks(rotate_item)
+        self.alignments.rotate_legacy_landmarks([rotate_item for rotate_item in rotated
+                                                 if rotate_item in self.frames.items.keys()])
 
     def add_hashes(self, hashes):
         """ Add Face Hashes to the alignments file """
@@ -679,9 +737,12 @@ class Rename():
             Done in 2 iterations as two files cannot share the same name """
         logger.trace("Renaming faces for frame: '%s'", frame_fullname)
         temp_ext = ".temp_move"
-        frame_faces = [(f_hash, details[1])
-                       for f_hash, details in self.alignments.hashes_to_frame.items()
-                       if details[0] == frame_fullname]
+        hashes_to_frame = self.alignments.hashes_to_frame
+        frame_faces = [(face["hash"], idx)
+                       for idx, face in enumerate(
+                           self.alignments.get_faces_in_frame(frame_fullname))
+                       if hashes_to_frame.get(face.get("hash", None),
+                                              None) == (frame_fullname, idx)]
         rename_count = 0
         for f_hash, idx in frame_faces:
             face_name, face_ext = self.faces.items[f_hash]
@@ -762,6 +823,8 @@ class Sort():
             logger.trace("Sorting alignments for frame: '%s'", frame)
             self.alignments.data[key] = sorted_alignments
             reindexed += 1
+        if reindexed:
+            self.alignments.invalidate_indexes()
         logger.info("%s Frames had their faces reindexed", reindexed)
         return reindexed
 
@@ -769,13 +832,26 @@ class Sort():
 class Spatial():
     """ Apply spatial temporal filtering to landmarks
         Adapted from:
-        https://www.kaggle.com/selfishgene/animating-and-smoothing-3d-facial-keypoints/notebook """
+        https://www.kaggle.com/selfishgene/animating-and-smoothing-3d-facial-keypoints/notebook
+
+        Faces are linked into tracks across frames by the position of their
+        bounding boxes. A shape model is fit over every face, then each face is
+        projected onto the model, reconstructed and smoothed along its track """
+    # Frames a track can go without a face before it is ended
+    max_gap = 5
+    # Maximum movement of a face's center between linked faces, relative to face size
+    max_shift = 0.5
+    # Number of faces to fit and filter with the shape model at a time
+    chunk_size = 50000
 
     def __init__(self, alignments, arguments):
         logger.debug("Initializing %s: (arguments: %s)", self.__class__.__name__, arguments)
         self.arguments = arguments
         self.alignments = alignments
-        self.mappings = dict()
+        # (frame, face index) for each row of the landmarks
+        self.faces = list()
+        # Landmarks rows of the faces in each track, in frame order
+        self.tracks = list()
         self.normalized = dict()
         self.shapes_model = None
         logger.debug("Initialized %s", self.__class__.__name__)
@@ -783,12 +859,14 @@ class Spatial():
     def process(self):
         """ Perform spatial filtering """
         logger.info("[SPATIO-TEMPORAL FILTERING]")  # Tidy up cli output
-        logger.info("NB: The process only processes the alignments for the first "
-                    "face it finds for any given frame. For best results only run this when "
-                    "there is only a single face in the alignments file and all false positives "
-                    "have been removed")
+        logger.info("NB: Faces are linked between frames by their position. For best results "
+                    "remove all false positives from the alignments file before running")
 
-        self.normalize()
+        landmarks = self.compile()
+        if not self.faces:
+            logger.error("No faces with 68 point landmarks found. Exiting")
+            return
+        self.normalize(landmarks)
         self.shape_model()
         landmarks = self.spatially_filter()
         landmarks = self.temporally_smooth(landmarks)
@@ -802,75 +880,123 @@ class Spatial():
     # define shape normalization utility functions
     @staticmethod
     def normalize_shapes(shapes_im_coords):
-        """ Normalize a 2D or 3D shape """
+        """ Normalize an array of (faces, points, dims) shapes in place """
         logger.debug("Normalize shapes")
-        (num_pts, num_dims, _) = shapes_im_coords.shape
-
         # calc mean coords and subtract from shapes
-        mean_coords = shapes_im_coords.mean(axis=0)
-        shapes_centered = np.zeros(shapes_im_coords.shape)
-        shapes_centered = shapes_im_coords - np.tile(mean_coords, [num_pts, 1, 1])
+        mean_coords = shapes_im_coords.mean(axis=1, keepdims=True)
+        shapes_im_coords -= mean_coords
 
         # calc scale factors and divide shapes
-        scale_factors = np.sqrt((shapes_centered**2).sum(axis=1)).mean(axis=0)
-        shapes_normalized = np.zeros(shapes_centered.shape)
-        shapes_normalized = shapes_centered / np.tile(scale_factors, [num_pts, num_dims, 1])
+        scale_factors = np.sqrt((shapes_im_coords ** 2).sum(axis=2)).mean(axis=1)
+        scale_factors[scale_factors == 0] = 1
+        scale_factors = scale_factors[:, np.newaxis, np.newaxis]
+        shapes_im_coords /= scale_factors
 
-        logger.debug("Normalized shapes: (shapes_normalized: %s, scale_factors: %s, mean_coords: "
-                     "%s", shapes_normalized, scale_factors, mean_coords)
-        return shapes_normalized, scale_factors, mean_coords
+        logger.debug("Normalized shapes: (scale_factors: %s, mean_coords: %s",
+                     scale_factors.shape, mean_coords.shape)
+        return shapes_im_coords, scale_factors, mean_coords
 
     @staticmethod
     def normalized_to_original(shapes_normalized, scale_factors, mean_coords):
-        """ Transform a normalized shape back to original image coordinates """
+        """ Transform normalized shapes back to original image coordinates in place """
         logger.debug("Normalize to original")
-        (num_pts, num_dims, _) = shapes_normalized.shape
-
         # move back to the correct scale
-        shapes_centered = shapes_normalized * np.tile(scale_factors, [num_pts, num_dims, 1])
+        shapes_normalized *= scale_factors
         # move back to the correct location
-        shapes_im_coords = shapes_centered + np.tile(mean_coords, [num_pts, 1, 1])
-
-        logger.debug("Normalized to original: %s", shapes_im_coords)
-        return shapes_im_coords
-
-    def normalize(self):
-        """ Compile all original and normalized alignments """
-        logger.debug("Normalize")
-        count = sum(1 for val in self.alignments.data.values() if val)
-        landmarks_all = np.zeros((68, 2, int(count)))
-
-        end = 0
-        for key in tqdm(sorted(self.alignments.data.keys()), desc="Compiling"):
-            val = self.alignments.data[key]
-            if not val:
+        shapes_normalized += mean_coords
+        return shapes_normalized
+
+    def compile(self):
+        """ Compile the landmarks of every face into a (faces, 68, 2) array and
+            link the faces into tracks """
+        logger.debug("Compile")
+        points = list()
+        active = list()
+        for position, frame in enumerate(tqdm(sorted(self.alignments.data.keys()),
+                                              desc="Compiling")):
+            faces = list()
+            for idx, face in enumerate(self.alignments.data[frame]):
+                if len(face.get("landmarksXY", list())) != 68:
+                    logger.verbose("Skipping face without 68 point landmarks: (frame: '%s', "
+                                   "index: %s)", frame, idx)
+                    continue
+                faces.append({"row": len(self.faces),
+                              "center": (face["x"] + face["w"] / 2, face["y"] + face["h"] / 2),
+                              "size": max(face["w"], face["h"])})
+                self.faces.append((frame, idx))
+                points.append(face["landmarksXY"])
+            active = [track for track in active if position - track["position"] <= self.max_gap]
+            active.extend(self.link_faces(faces, active, position))
+        self.tracks = [np.array(track["rows"]) for track in self.tracks]
+        logger.verbose("Compiled %s faces into %s tracks", len(self.faces), len(self.tracks))
+        # Flattening the nested lists is quicker than having numpy parse their structure
+        return np.fromiter(chain.from_iterable(chain.from_iterable(points)),
+                           dtype="float64",
+                           count=len(points) * 68 * 2).reshape(-1, 68, 2)
+
+    def link_faces(self, faces, active, position):
+        """ Add each face in a frame to the nearest active track, closest first.
+            Faces that are not near to a track start a new track, which is returned """
+        pairs = sorted((hypot(face["center"][0] - track["center"][0],
+                              face["center"][1] - track["center"][1]), f_idx, t_idx)
+                       for f_idx, face in enumerate(faces)
+                       for t_idx, track in enumerate(active))
+        linked_faces = set()
+        linked_tracks = set()
+        for distance, f_idx, t_idx in pairs:
+            face, track = faces[f_idx], active[t_idx]
+            if (f_idx in linked_faces
+                    or t_idx in linked_tracks
+                    or distance > self.max_shift * max(face["size"], track["size"])):
+                continue
+            track["rows"].append(face["row"])
+            track.update(center=face["center"], size=face["size"], position=position)
+            linked_faces.add(f_idx)
+            linked_tracks.add(t_idx)
+
+        new_tracks = list()
+        for f_idx, face in enumerate(faces):
+            if f_idx in linked_faces:
                 continue
-            # We should only be normalizing a single face, so just take
-            # the first landmarks found
-            landmarks = np.array(val[0]["landmarksXY"]).reshape(68, 2, 1)
-            start = end
-            end = start + landmarks.shape[2]
-            # store in one big array
-            landmarks_all[:, :, start:end] = landmarks
-            # make sure we keep track of the mapping to the original frame
-            self.mappings[start] = key
-
-        # normalize shapes
-        normalized_shape = self.normalize_shapes(landmarks_all)
+            track = {"rows": [face["row"]],
+                     "center": face["center"],
+                     "size": face["size"],
+                     "position": position}
+            self.tracks.append(track)
+            new_tracks.append(track)
+        return new_tracks
+
+    def normalize(self, landmarks):
+        """ Normalize all of the compiled landmarks """
+        logger.debug("Normalize")
+        normalized_shape = self.normalize_shapes(landmarks)
         self.normalized["landmarks"] = normalized_shape[0]
         self.normalized["scale_factors"] = normalized_shape[1]
         self.normalized["mean_coords"] = normalized_shape[2]
-        logger.debug("Normalized: %s", self.normalized)
+        logger.debug("Normalized")
+
+    def get_chunks(self):
+        """ Return the row slices to fit and filter the landmarks in """
+        num_faces = len(self.faces)
+        num_chunks = -(-num_faces // self.chunk_size)
+        bounds = np.linspace(0, num_faces, num_chunks + 1).astype(int)
+        return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
 
     def shape_model(self):
         """ build 2D shape model """
         logger.debug("Shape model")
-        landmarks_norm = self.normalized["landmarks"]
-        num_components = 20
-        normalized_shapes_tbl = np.reshape(landmarks_norm, [68*2, landmarks_norm.shape[2]]).T
-        self.shapes_model = decomposition.PCA(n_components=num_components,
-                                              whiten=True,
-                                              random_state=1).fit(normalized_shapes_tbl)
+        landmarks_norm = self.normalized["landmarks"].reshape(-1, 68 * 2)
+        num_components = min(20, landmarks_norm.shape[0])
+        if landmarks_norm.shape[0] <= self.chunk_size:
+            self.shapes_model = decomposition.PCA(n_components=num_components,
+                                                  whiten=True,
+                                                  random_state=1).fit(landmarks_norm)
+        else:
+            # Fit large files in chunks to limit memory use
+            self.shapes_model = decomposition.IncrementalPCA(n_components=num_components,
+                                                             whiten=True)
+            for chunk in tqdm(self.get_chunks(), desc="Fitting Shape Model"):
+                self.shapes_model.partial_fit(landmarks_norm[chunk])
         explained = self.shapes_model.explained_variance_ratio_.sum()
         logger.info("Total explained percent by PCA model with %s components is %s%%",
                     num_components, round(100 * explained, 1))
@@ -881,45 +1007,40 @@ class Spatial():
             (project and reconstruct) """
         logger.debug("Spatially Filter")
         landmarks_norm = self.normalized["landmarks"]
-        # convert to matrix form
-        landmarks_norm_table = np.reshape(landmarks_norm, [68 * 2, landmarks_norm.shape[2]]).T
+        landmarks_norm_table = landmarks_norm.reshape(-1, 68 * 2)
         # project onto shapes model and reconstruct
-        landmarks_norm_table_rec = self.shapes_model.inverse_transform(
-            self.shapes_model.transform(landmarks_norm_table))
-        # convert back to shapes (numKeypoint, num_dims, numFrames)
-        landmarks_norm_rec = np.reshape(landmarks_norm_table_rec.T,
-                                        [68, 2, landmarks_norm.shape[2]])
+        for chunk in self.get_chunks():
+            landmarks_norm_table[chunk] = self.shapes_model.inverse_transform(
+                self.shapes_model.transform(landmarks_norm_table[chunk]))
         # transform back to image coords
-        retval = self.normalized_to_original(landmarks_norm_rec,
+        retval = self.normalized_to_original(landmarks_norm,
                                              self.normalized["scale_factors"],
                                              self.normalized["mean_coords"])
-
-        logger.debug("Spatially Filtered: %s", retval)
+        logger.debug("Spatially Filtered: %s", retval.shape)
         return retval
 
-    @staticmethod
-    def temporally_smooth(landmarks):
-        """ apply temporal filtering on the 2D points """
+    def temporally_smooth(self, landmarks):
+        """ apply temporal filtering on the 2D points along each track """
         logger.debug("Temporally Smooth")
         filter_half_length = 2
-        temporal_filter = np.ones((1, 1, 2 * filter_half_length + 1))
+        temporal_filter = np.ones((2 * filter_half_length + 1, 1, 1))
         temporal_filter = temporal_filter / temporal_filter.sum()
 
-        start_tileblock = np.tile(landmarks[:, :, 0][:, :, np.newaxis], [1, 1, filter_half_length])
-        end_tileblock = np.tile(landmarks[:, :, -1][:, :, np.newaxis], [1, 1, filter_half_length])
-        landmarks_padded = np.dstack((start_tileblock, landmarks, end_tileblock))
-
-        retval = signal.convolve(landmarks_padded, temporal_filter, mode='valid', method='fft')
-        logger.debug("Temporally Smoothed: %s", retval)
-        return retval
+        for rows in self.tracks:
+            track = landmarks[rows]
+            start_tileblock = np.repeat(track[:1], filter_half_length, axis=0)
+            end_tileblock = np.repeat(track[-1:], filter_half_length, axis=0)
+            track_padded = np.concatenate((start_tileblock, track, end_tileblock))
+            landmarks[rows] = signal.convolve(track_padded, temporal_filter, mode="valid")
+        logger.debug("Temporally Smoothed: %s", landmarks.shape)
+        return landmarks
 
     def update_alignments(self, landmarks):
         """ Update smoothed landmarks back to alignments """
         logger.debug("Update alignments")
-        for idx, frame in tqdm(self.mappings.items(), desc="Updating"):
-            logger.trace("Updating: (frame: %s)", frame)
-            landmarks_update = landmarks[:, :, idx].astype(int)
-            landmarks_xy = landmarks_update.reshape(68, 2).tolist()
-            self.alignments.data[frame][0]["landmarksXY"] = landmarks_xy
-            logger.trace("Updated: (frame: '%s', landmarks: %s)", frame, landmarks_xy)
+        landmarks = landmarks.astype(int)
+        # Converting to lists a face at a time frees the old landmarks as the new ones are
+        # created, which stops the garbage collector from repeatedly scanning the alignments
+        for row, (frame, idx) in enumerate(tqdm(self.faces, desc="Updating")):
+            self.alignments.data[frame][idx]["landmarksXY"] = landmarks[row].tolist()
         logger.debug("Updated alignments")
@@ -4,13 +4,13 @@
 
 import logging
 import os
-from tqdm import tqdm
 
 import cv2
 
 from lib.alignments import Alignments
 from lib.faces_detect import DetectedFace
-from lib.utils import _image_extensions, hash_image_file, hash_encode_image
+from lib.face_hashes import FaceHashes
+from lib.utils import _image_extensions, hash_encode_image
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -57,7 +57,8 @@ class AlignmentData(Alignments):
         extensions = {".json": "json",
                       ".p": "pickle",
                       ".yml": "yaml",
-                      ".yaml": "yaml"}
+                      ".yaml": "yaml",
+                      ".npz": "npz"}
         dst_fmt = None
         file_ext = os.path.splitext(self.file)[1].lower()
         logger.debug("File extension: '%s'", file_ext)
@@ -157,12 +158,14 @@ class Faces(MediaLoader):
     def process_folder(self):
         """ Iterate through the faces dir pulling out various information """
         logger.info("Loading file list from %s", self.folder)
-        for face in tqdm(os.listdir(self.folder), desc="Reading Face Hashes"):
-            if not self.valid_extension(face):
-                continue
+        faces = [face for face in os.listdir(self.folder) if self.valid_extension(face)]
+        hashes = FaceHashes(self.folder).get_hashes(
+            [os.path.join(self.folder, face) for face in faces],
+            desc="Reading Face Hashes")
+        for face in faces:
             filename = os.path.splitext(face)[0]
             file_extension = os.path.splitext(face)[1]
-            face_hash = hash_image_file(os.path.join(self.folder, face))
+            face_hash = hashes[os.path.join(self.folder, face)]
             retval = {"face_fullname": face,
                       "face_name": filename,
                       "face_extension": file_extension,